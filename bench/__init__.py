@@ -0,0 +1,45 @@
+"""Benchmarks for the uploader, run from the repository root.
+
+The uploader reads its config when it is imported, so `prepare_root` must be
+called before anything from `mupl` is imported."""
+import importlib.util
+import json
+import os
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import Optional
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def prepare_root(root: "Path", paths: "dict", options: "Optional[dict]" = None) -> "Path":
+    """Write a config for the benchmark into root and point the uploader at it."""
+    with open(REPO_ROOT.joinpath("mupl", "utils", "defaults.json"), "r", encoding="utf-8") as json_file:
+        config = json.load(json_file)
+
+    config["paths"].update(paths)
+    config["options"].update(options or {})
+    config["credentials"] = {
+        "mangadex_username": "bench",
+        "mangadex_password": "bench",
+        "client_id": "bench",
+        "client_secret": "bench",
+    }
+
+    root.mkdir(parents=True, exist_ok=True)
+    config_path = root.joinpath("config.json")
+    config_path.write_text(json.dumps(config, indent=4), encoding="utf-8")
+    os.environ["MUPL_ROOT"] = str(root)
+    # Translations are loaded relative to the working directory
+    os.chdir(REPO_ROOT)
+    return config_path
+
+
+def load_uploader() -> "ModuleType":
+    """Import the mupl.py script, which is shadowed by the mupl package."""
+    spec = importlib.util.spec_from_file_location("mupl_script", REPO_ROOT.joinpath("mupl.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,227 @@
+"""End-to-end load suite, uploading a generated library to the local test api.
+
+    python -m bench.e2e --chapters 200 --output e2e.json
+    python -m bench.e2e --chapters 200 --baseline e2e.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from bench import REPO_ROOT, prepare_root
+from bench.library import LibrarySpec, generate_library
+from mupl.testing.mock_api import MockApiConfig, MockApiServer
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Metrics where a higher value is better, the others should go down
+HIGHER_IS_BETTER = {"chapters_per_minute", "mb_per_second"}
+# Allowed change from the baseline before a metric counts as a regression
+DEFAULT_THRESHOLDS = {
+    "chapters_per_minute": 0.1,
+    "mb_per_second": 0.1,
+    "requests_per_chapter": 0.05,
+    "retries": 0.25,
+    "peak_rss_mb": 0.2,
+    "time_to_first_commit": 0.25,
+}
+
+
+def get_peak_rss_mb() -> "Optional[float]":
+    """Peak resident memory of the finished child processes."""
+    if resource is None:
+        return None
+    # Kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return peak_rss / divisor
+
+
+def run_upload(config_root: "Path", threaded: "bool", timeout: "float") -> "subprocess.CompletedProcess":
+    command = [sys.executable, str(REPO_ROOT.joinpath("mupl.py"))]
+    if not threaded:
+        # The flag turns the threaded upload off
+        command.append("--threaded")
+
+    return subprocess.run(
+        command,
+        cwd=REPO_ROOT,
+        env=dict(os.environ, MUPL_ROOT=str(config_root)),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        timeout=timeout,
+    )
+
+
+def get_metrics(stats: "dict", chapters: "int", started: "float", elapsed: "float") -> "Dict[str, Optional[float]]":
+    commits = stats["commits"]
+    committed = len(commits)
+    total_requests = sum(stats["requests"].values())
+
+    return {
+        "chapters": chapters,
+        "committed": committed,
+        "elapsed": elapsed,
+        "chapters_per_minute": committed / elapsed * 60 if elapsed else 0.0,
+        "mb_per_second": stats["bytes_received"] / (1024 * 1024) / elapsed if elapsed else 0.0,
+        "requests_per_chapter": total_requests / committed if committed else None,
+        # Every 429/5xx answer and failed image is sent again by the uploader
+        "retries": stats["injected_errors"] + stats["failed_images"],
+        "peak_rss_mb": get_peak_rss_mb(),
+        "time_to_first_commit": min(x["time"] for x in commits) - started if commits else None,
+    }
+
+
+def compare(metrics: "dict", baseline: "dict", thresholds: "Dict[str, float]") -> "List[str]":
+    """Print the change from the baseline, returning the regressed metrics."""
+    regressions = []
+    for name, threshold in thresholds.items():
+        value, baseline_value = metrics.get(name), baseline.get(name)
+        if value is None or baseline_value is None:
+            continue
+
+        if name in HIGHER_IS_BETTER:
+            regressed = value < baseline_value * (1 - threshold)
+        else:
+            regressed = value > baseline_value * (1 + threshold)
+            # Counts can't grow from zero by a ratio
+            if baseline_value == 0:
+                regressed = value > 0
+
+        if regressed:
+            regressions.append(name)
+        status = "REGRESSION" if regressed else "ok"
+        print(f"{name:<22} {baseline_value:10.2f} -> {value:10.2f}  {status}")
+    return regressions
+
+
+def parse_thresholds(values: "List[str]") -> "Dict[str, float]":
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for value in values:
+        name, _, threshold = value.partition("=")
+        if name not in DEFAULT_THRESHOLDS:
+            raise argparse.ArgumentTypeError(f"Unknown metric {name}.")
+        thresholds[name] = float(threshold)
+    return thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the end-to-end upload load suite.")
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--width", type=int, default=400)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--layout", choices=["flat", "nested", "both"], default="both")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sequential", action="store_true", help="Upload the images of a batch one by one.")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--bandwidth", type=int, default=0)
+    parser.add_argument("--error-rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate-5xx", type=float, default=0.0)
+    parser.add_argument("--partial-failure-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--output", type=Path, help="Save the metrics as json.")
+    parser.add_argument("--baseline", type=Path, help="Compare with saved metrics.")
+    parser.add_argument(
+        "--threshold",
+        action="append",
+        default=[],
+        metavar="METRIC=RATIO",
+        help="Allowed change of a metric from the baseline, e.g. chapters_per_minute=0.1",
+    )
+    vargs = parser.parse_args()
+    thresholds = parse_thresholds(vargs.threshold)
+
+    server = MockApiServer(
+        config=MockApiConfig(
+            latency=vargs.latency,
+            bandwidth=vargs.bandwidth,
+            error_rate_429=vargs.error_rate_429,
+            error_rate_5xx=vargs.error_rate_5xx,
+            partial_failure_rate=vargs.partial_failure_rate,
+            seed=vargs.seed,
+        )
+    ).start()
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="mupl-e2e-") as temp_dir:
+            root = Path(temp_dir)
+            library = generate_library(
+                root.joinpath("library"),
+                LibrarySpec(
+                    chapters=vargs.chapters,
+                    pages=vargs.pages,
+                    layout=vargs.layout,
+                    width=vargs.width,
+                    height=vargs.height,
+                    seed=vargs.seed,
+                ),
+            )
+            config_root = root.joinpath("config")
+            prepare_root(
+                config_root,
+                {
+                    "mangadex_api_url": server.api_url,
+                    "mangadex_auth_url": server.auth_url,
+                    "uploads_folder": str(library.uploads_folder),
+                    "uploaded_files": str(library.root.joinpath("uploaded")),
+                },
+                {"ratelimit_time": 1, "retry_pass_delay": 1},
+            )
+            config_root.joinpath("name_id_map.json").write_text(
+                json.dumps(library.names_to_ids, indent=4), encoding="utf-8"
+            )
+
+            started = time.time()
+            result = run_upload(config_root, not vargs.sequential, vargs.timeout)
+            elapsed = time.time() - started
+    finally:
+        server.stop()
+
+    metrics = get_metrics(server.state.to_dict(), len(library.chapters), started, elapsed)
+    report = {
+        "workload": {
+            "chapters": vargs.chapters,
+            "pages": vargs.pages,
+            "layout": vargs.layout,
+            "sequential": vargs.sequential,
+            "latency": vargs.latency,
+            "bandwidth": vargs.bandwidth,
+            "error_rate_429": vargs.error_rate_429,
+            "error_rate_5xx": vargs.error_rate_5xx,
+            "partial_failure_rate": vargs.partial_failure_rate,
+            "seed": vargs.seed,
+        },
+        "metrics": metrics,
+    }
+    print(json.dumps(metrics, indent=4))
+
+    if result.returncode != 0 or metrics["committed"] < metrics["chapters"]:
+        print(result.stdout[-5000:])
+        print(f"Uploaded {metrics['committed']} of {metrics['chapters']} chapters, exit code {result.returncode}.")
+        sys.exit(1)
+
+    if vargs.output:
+        vargs.output.write_text(json.dumps(report, indent=4), encoding="utf-8")
+
+    if vargs.baseline:
+        baseline = json.loads(vargs.baseline.read_text(encoding="utf-8"))
+        if baseline.get("workload") != report["workload"]:
+            print("The baseline was recorded with a different workload.")
+        if compare(metrics, baseline["metrics"], thresholds):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Generator for synthetic `to_upload` trees.
+
+    python -m bench.library /tmp/library --chapters 50 --pages 20 --layout both
+"""
+import argparse
+import io
+import json
+import random
+import zipfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List
+
+from PIL import Image
+
+TITLES = ["hyakkano", "Oshi no Ko", "Kaguya-sama", "Sono Bisque Doll", "Dandadan"]
+GROUPS = ["XuN", "Scan Group", "Tsundoku Scans"]
+LANGUAGES = ["en", "pt-br", "es-la"]
+
+
+@dataclass
+class LibrarySpec:
+    chapters: int = 20
+    pages: int = 12
+    # "flat" zip/cbz files, "nested" language/group/title/volume/chapter folders or "both"
+    layout: str = "both"
+    formats: "List[str]" = field(default_factory=lambda: ["WEBP", "PNG", "JPEG"])
+    width: int = 800
+    height: int = 1200
+    # Share of chapters with an animated webp page and with an overlong strip page
+    animated_ratio: float = 0.1
+    strip_ratio: float = 0.1
+    strip_height: int = 12000
+    # Pages outside the chapters for the conversion and splitting benchmarks,
+    # webp pages of each kind converted for upload and overlong strips
+    webp_pages: int = 6
+    strips: int = 3
+    seed: int = 0
+
+
+@dataclass
+class Library:
+    root: "Path"
+    uploads_folder: "Path"
+    names_to_ids: "Dict[str, Dict[str, str]]"
+    flat_chapters: "List[Path]" = field(default_factory=list)
+    nested_chapters: "List[Path]" = field(default_factory=list)
+    webp_pages: "List[Path]" = field(default_factory=list)
+    strips: "List[Path]" = field(default_factory=list)
+
+    @property
+    def chapters(self) -> "List[Path]":
+        return self.flat_chapters + self.nested_chapters
+
+
+def make_id(rng: "random.Random") -> "str":
+    hex_id = "%032x" % rng.getrandbits(128)
+    return f"{hex_id[:8]}-{hex_id[8:12]}-{hex_id[12:16]}-{hex_id[16:20]}-{hex_id[20:]}"
+
+
+def make_page(
+    rng: "random.Random",
+    image_format: "str",
+    width: "int",
+    height: "int",
+    animated: "bool" = False,
+    transparent: "bool" = False,
+) -> "bytes":
+    """Create a page with some noise so the encoders do real work."""
+    colour = tuple(rng.randrange(256) for _ in range(3))
+    image = Image.new("RGB", (width, height), colour)
+    noise = Image.effect_noise((width, min(height, 256)), 64).convert("RGB")
+    image.paste(noise, (0, 0))
+
+    output = io.BytesIO()
+    if animated:
+        frames = [image, Image.new("RGB", (width, height), colour[::-1])]
+        frames[0].save(output, "WEBP", save_all=True, append_images=frames[1:], duration=100)
+    elif transparent:
+        # Partly transparent, so the encoder keeps the alpha channel
+        image.putalpha(192)
+        image.save(output, image_format)
+    elif image_format == "PNG" and rng.random() < 0.5:
+        # Transparent pages, webp versions of these are converted to png
+        image.convert("RGBA").save(output, image_format)
+    else:
+        image.save(output, image_format)
+    return output.getvalue()
+
+
+def make_chapter_pages(spec: "LibrarySpec", rng: "random.Random") -> "Dict[str, bytes]":
+    extensions = {"WEBP": "webp", "PNG": "png", "JPEG": "jpg"}
+    animated = rng.random() < spec.animated_ratio
+    strip = rng.random() < spec.strip_ratio
+
+    pages = {}
+    for page_number in range(spec.pages):
+        image_format = rng.choice(spec.formats)
+        height = spec.height
+        if strip and page_number == 0:
+            image_format, height = "JPEG", spec.strip_height
+        page_animated = animated and page_number == 1
+        if page_animated:
+            image_format = "WEBP"
+        page_name = f"{page_number + 1:03d}.{extensions[image_format]}"
+        pages[page_name] = make_page(rng, image_format, spec.width // 4 if strip and page_number == 0 else spec.width, height, page_animated)
+    return pages
+
+
+def generate_library(root: "Path", spec: "LibrarySpec") -> "Library":
+    """Create a `to_upload` folder and a name-to-id map under root."""
+    rng = random.Random(spec.seed)
+    uploads_folder = root.joinpath("to_upload")
+    uploads_folder.mkdir(parents=True, exist_ok=True)
+    names_to_ids = {
+        "manga": {title: make_id(rng) for title in TITLES},
+        "group": {group: make_id(rng) for group in GROUPS},
+    }
+    library = Library(root=root, uploads_folder=uploads_folder, names_to_ids=names_to_ids)
+
+    for chapter_index in range(spec.chapters):
+        title = TITLES[chapter_index % len(TITLES)]
+        group = GROUPS[chapter_index % len(GROUPS)]
+        language = LANGUAGES[chapter_index % len(LANGUAGES)]
+        chapter_number = chapter_index // len(TITLES) + 1
+        volume_number = (chapter_number - 1) // 10 + 1
+        pages = make_chapter_pages(spec, rng)
+
+        nested = spec.layout == "nested" or (spec.layout == "both" and chapter_index % 2)
+        if nested:
+            chapter_path = uploads_folder.joinpath(
+                f"[{language}]", group, title, f"v{volume_number:02d}", f"{chapter_number:04d}"
+            )
+            chapter_path.mkdir(parents=True, exist_ok=True)
+            for page_name, page_data in pages.items():
+                chapter_path.joinpath(page_name).write_bytes(page_data)
+            library.nested_chapters.append(chapter_path)
+        else:
+            extension = "cbz" if chapter_index % 3 else "zip"
+            chapter_path = uploads_folder.joinpath(
+                f"{title} [{language}] - c{chapter_number:03d} (v{volume_number:02d}) [{group}].{extension}"
+            )
+            with zipfile.ZipFile(chapter_path, "w", zipfile.ZIP_STORED) as chapter_zip:
+                for page_name, page_data in pages.items():
+                    chapter_zip.writestr(page_name, page_data)
+            library.flat_chapters.append(chapter_path)
+
+    # Animated webp pages are converted to gif, transparent ones to png and the others to jpeg
+    pages_folder = root.joinpath("webp_pages")
+    pages_folder.mkdir(parents=True, exist_ok=True)
+    for page_index in range(spec.webp_pages):
+        kind = page_index % 3
+        page_path = pages_folder.joinpath(f"{page_index + 1:03d}.webp")
+        page_path.write_bytes(
+            make_page(rng, "WEBP", spec.width, spec.height, animated=kind == 0, transparent=kind == 1)
+        )
+        library.webp_pages.append(page_path)
+
+    strips_folder = root.joinpath("strips")
+    strips_folder.mkdir(parents=True, exist_ok=True)
+    for strip_index in range(spec.strips):
+        strip_path = strips_folder.joinpath(f"{strip_index + 1:03d}.jpg")
+        strip_path.write_bytes(make_page(rng, "JPEG", spec.width // 4, spec.strip_height))
+        library.strips.append(strip_path)
+
+    root.joinpath("name_id_map.json").write_text(json.dumps(names_to_ids, indent=4), encoding="utf-8")
+    return library
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic to_upload tree.")
+    parser.add_argument("root", type=Path)
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=12)
+    parser.add_argument("--layout", choices=["flat", "nested", "both"], default="both")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--animated-ratio", type=float, default=0.1)
+    parser.add_argument("--strip-ratio", type=float, default=0.1)
+    parser.add_argument("--webp-pages", type=int, default=6)
+    parser.add_argument("--strips", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    vargs = parser.parse_args()
+
+    library = generate_library(
+        vargs.root,
+        LibrarySpec(
+            chapters=vargs.chapters,
+            pages=vargs.pages,
+            layout=vargs.layout,
+            width=vargs.width,
+            height=vargs.height,
+            animated_ratio=vargs.animated_ratio,
+            strip_ratio=vargs.strip_ratio,
+            webp_pages=vargs.webp_pages,
+            strips=vargs.strips,
+            seed=vargs.seed,
+        ),
+    )
+    print(f"Generated {len(library.chapters)} chapters in {library.uploads_folder}")
+
+
+if __name__ == "__main__":
+    main()
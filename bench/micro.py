@@ -0,0 +1,227 @@
+"""Microbenchmarks for the local stages of an upload: file name parsing, the
+upload folder scan, page discovery, webp conversion and strip splitting.
+Conversion and splitting are also timed on their own, on generated webp
+pages of each kind and overlong strips.
+
+    python -m bench.micro --chapters 40 --output bench.json
+    python -m bench.micro --baseline bench.json
+"""
+import argparse
+import io
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from bench import prepare_root
+from bench.library import LibrarySpec, generate_library
+
+# Slower than the baseline by this ratio counts as a regression
+DEFAULT_THRESHOLD = 1.2
+
+
+def measure(
+    function: "Callable[[], object]",
+    repeat: "int",
+    setup: "Optional[Callable[[], object]]" = None,
+) -> "Dict[str, float]":
+    """Time the function, the setup isn't counted."""
+    timings: "List[float]" = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(library, repeat: "int") -> "Dict[str, Dict[str, float]]":
+    # Imported after the config for the benchmark is written
+    from bench import load_uploader
+    from mupl.file_validator import FILE_NAME_REGEX, FileProcesser
+    from mupl.image_validator import ImageProcessor, ImageProcessorBase
+    from mupl.name_id_map import NameIdMap
+    from mupl.utils.config import context
+    from PIL import Image
+
+    uploader = load_uploader()
+    names_to_ids = NameIdMap(library.names_to_ids)
+    allow_ext = [".png", ".jpg", ".jpeg", ".webp"]
+    results = {}
+
+    flat_names = [path.name for path in library.flat_chapters]
+    results["file_name_regex"] = measure(
+        lambda: [FILE_NAME_REGEX.match(name) for name in flat_names], repeat
+    )
+
+    def parse_names():
+        for path in library.flat_chapters:
+            FileProcesser(path, names_to_ids).process_zip_name()
+        for path in library.nested_chapters:
+            FileProcesser(path, names_to_ids).process_zip_name_extanded()
+
+    results["parse_names"] = measure(parse_names, repeat)
+
+    def remove_scan_index():
+        context.scan_index_path.unlink(missing_ok=True)
+
+    scan = lambda: uploader.get_zips_to_upload(names_to_ids, allow_ext, quiet=True)
+    results["scan_cold"] = measure(scan, repeat, setup=remove_scan_index)
+    scan()
+    results["scan_warm"] = measure(scan, repeat)
+
+    results["page_manifest"] = measure(
+        lambda: [ImageProcessorBase.get_page_manifest(path) for path in library.chapters],
+        repeat,
+    )
+
+    def get_processors() -> "List[ImageProcessor]":
+        processors = []
+        for path in library.chapters:
+            file_name_obj = FileProcesser(path, names_to_ids)
+            processors.append(ImageProcessor(file_name_obj, path.is_dir()))
+        return processors
+
+    results["valid_images"] = measure(get_processors, repeat)
+
+    processors = get_processors()
+
+    def read_for_upload():
+        for processor in processors:
+            for image in processor.info_list:
+                processor._get_bytes_for_upload(image)
+
+    results["read_for_upload"] = measure(read_for_upload, repeat)
+
+    webp_pages = [path.read_bytes() for path in library.webp_pages]
+
+    def webp_convert():
+        # The same steps as reading a webp page for upload
+        for image_bytes in webp_pages:
+            new_format = ImageProcessorBase.get_new_format_for_webp(image_bytes)
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image.save(io.BytesIO(), new_format)
+
+    if webp_pages:
+        results["webp_convert"] = measure(webp_convert, repeat)
+
+    # Splitting removes the strip, so every run gets fresh copies
+    split_folder = library.root.joinpath("split_strips")
+
+    def copy_strips():
+        shutil.rmtree(split_folder, ignore_errors=True)
+        split_folder.mkdir()
+        for path in library.strips:
+            shutil.copy2(path, split_folder.joinpath(path.name))
+
+    def split_strips():
+        for path in library.strips:
+            uploader.cup_images(
+                str(split_folder.joinpath(path.name)),
+                str(split_folder.joinpath("temp")),
+                str(split_folder),
+                allow_ext,
+            )
+
+    if library.strips:
+        results["cup_images"] = measure(split_strips, repeat, setup=copy_strips)
+    shutil.rmtree(split_folder, ignore_errors=True)
+
+    # Splitting changes the chapter, so every run gets fresh copies
+    strip_copies = library.root.joinpath("strip_copies")
+
+    def copy_nested_chapters():
+        shutil.rmtree(strip_copies, ignore_errors=True)
+        for index, path in enumerate(library.nested_chapters):
+            shutil.copytree(path, strip_copies.joinpath(str(index)))
+
+    def check_images():
+        for path in strip_copies.iterdir():
+            uploader.check_images(str(path), allow_ext)
+
+    if library.nested_chapters:
+        results["check_images"] = measure(check_images, repeat, setup=copy_nested_chapters)
+    shutil.rmtree(strip_copies, ignore_errors=True)
+
+    for processor in processors:
+        if processor.myzip is not None:
+            processor.myzip.close()
+    return results
+
+
+def compare(results: "dict", baseline: "dict", threshold: "float") -> "List[str]":
+    """Print the change from the baseline, returning the regressed benchmarks."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median"] / max(baseline[name]["median"], 1e-9)
+        status = "REGRESSION" if ratio > threshold else "ok"
+        if ratio > threshold:
+            regressions.append(name)
+        print(f"{name:<18} {ratio:6.2f}x  {status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the uploader microbenchmarks.")
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=12)
+    parser.add_argument("--layout", choices=["flat", "nested", "both"], default="both")
+    parser.add_argument("--webp-pages", type=int, default=6)
+    parser.add_argument("--strips", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Save the results as json.")
+    parser.add_argument("--baseline", type=Path, help="Compare with saved results.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    vargs = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="mupl-bench-") as temp_dir:
+        root = Path(temp_dir)
+        library = generate_library(
+            root.joinpath("library"),
+            LibrarySpec(
+                chapters=vargs.chapters,
+                pages=vargs.pages,
+                layout=vargs.layout,
+                webp_pages=vargs.webp_pages,
+                strips=vargs.strips,
+                seed=vargs.seed,
+            ),
+        )
+        prepare_root(
+            root.joinpath("config"),
+            {
+                "uploads_folder": str(library.uploads_folder),
+                "uploaded_files": str(library.root.joinpath("uploaded")),
+                "name_id_map_file": str(library.root.joinpath("name_id_map.json")),
+            },
+        )
+        results = run_benchmarks(library, vargs.repeat)
+
+    for name, result in results.items():
+        print(f"{name:<18} median {result['median'] * 1000:9.2f} ms  min {result['min'] * 1000:9.2f} ms")
+
+    if vargs.output:
+        vargs.output.write_text(json.dumps(results, indent=4), encoding="utf-8")
+
+    if vargs.baseline:
+        baseline = json.loads(vargs.baseline.read_text(encoding="utf-8"))
+        if compare(results, baseline, vargs.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
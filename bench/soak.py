@@ -0,0 +1,180 @@
+"""Soak test, uploading thousands of chapters to the local test api while
+sampling the memory of the uploader to check that it stays flat.
+
+The uploader waits twice the rate limit time between chapters, so the default
+2000 chapters take a bit over an hour.
+
+    python -m bench.soak --chapters 2000 --output soak.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from bench import REPO_ROOT, prepare_root
+from bench.library import LibrarySpec, generate_library
+from mupl.testing.mock_api import MockApiConfig, MockApiServer
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Elapsed seconds, committed chapters and resident memory in MB
+Sample = Tuple[float, int, float]
+
+
+def get_rss_mb(pid: "int") -> "Optional[float]":
+    """Resident memory of a running process."""
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            pass
+    return None
+
+
+def get_growth(samples: "List[Sample]", chapters: "int", warmup: "float") -> "dict":
+    """Memory growth after the warmup chapters: the difference between the first
+    and last tenth of the samples and the fitted slope per 1000 chapters."""
+    steady = [x for x in samples if x[1] >= chapters * warmup]
+    if len(steady) < 10:
+        return {"samples": len(steady), "growth_mb": None, "mb_per_1000_chapters": None}
+
+    window = max(len(steady) // 10, 1)
+    first_mb = sum(x[2] for x in steady[:window]) / window
+    last_mb = sum(x[2] for x in steady[-window:]) / window
+
+    mean_committed = sum(x[1] for x in steady) / len(steady)
+    mean_rss = sum(x[2] for x in steady) / len(steady)
+    variance = sum((x[1] - mean_committed) ** 2 for x in steady)
+    slope = (
+        sum((x[1] - mean_committed) * (x[2] - mean_rss) for x in steady) / variance
+        if variance
+        else 0.0
+    )
+    return {
+        "samples": len(steady),
+        "first_mb": first_mb,
+        "last_mb": last_mb,
+        "peak_mb": max(x[2] for x in samples),
+        "growth_mb": last_mb - first_mb,
+        "mb_per_1000_chapters": slope * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the memory of the uploader stays flat over many chapters.")
+    parser.add_argument("--chapters", type=int, default=2000)
+    parser.add_argument("--pages", type=int, default=4)
+    parser.add_argument("--width", type=int, default=300)
+    parser.add_argument("--height", type=int, default=450)
+    parser.add_argument("--layout", choices=["flat", "nested", "both"], default="both")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory-budget", type=int, default=512, help="memory_budget option of the uploader in MB.")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between the memory samples.")
+    parser.add_argument("--warmup", type=float, default=0.1, help="Share of the chapters uploaded before measuring.")
+    parser.add_argument("--max-growth", type=float, default=32.0, help="Allowed memory growth in MB after the warmup.")
+    parser.add_argument("--timeout", type=float, default=6 * 3600)
+    parser.add_argument("--output", type=Path, help="Save the samples and the growth as json.")
+    vargs = parser.parse_args()
+
+    if get_rss_mb(os.getpid()) is None:
+        print("Can't read the memory of a process here, install psutil.")
+        sys.exit(1)
+
+    server = MockApiServer(config=MockApiConfig(latency=0.0, seed=vargs.seed)).start()
+    samples: "List[Sample]" = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="mupl-soak-") as temp_dir:
+            root = Path(temp_dir)
+            library = generate_library(
+                root.joinpath("library"),
+                LibrarySpec(
+                    chapters=vargs.chapters,
+                    pages=vargs.pages,
+                    layout=vargs.layout,
+                    width=vargs.width,
+                    height=vargs.height,
+                    strip_ratio=0.0,
+                    seed=vargs.seed,
+                ),
+            )
+            config_root = root.joinpath("config")
+            prepare_root(
+                config_root,
+                {
+                    "mangadex_api_url": server.api_url,
+                    "mangadex_auth_url": server.auth_url,
+                    "uploads_folder": str(library.uploads_folder),
+                    "uploaded_files": str(library.root.joinpath("uploaded")),
+                },
+                {"ratelimit_time": 1, "retry_pass_delay": 1, "memory_budget": vargs.memory_budget},
+            )
+            config_root.joinpath("name_id_map.json").write_text(
+                json.dumps(library.names_to_ids, indent=4), encoding="utf-8"
+            )
+
+            started = time.time()
+            process = subprocess.Popen(
+                [sys.executable, str(REPO_ROOT.joinpath("mupl.py"))],
+                cwd=REPO_ROOT,
+                env=dict(os.environ, MUPL_ROOT=str(config_root)),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                while process.poll() is None:
+                    elapsed = time.time() - started
+                    if elapsed > vargs.timeout:
+                        process.kill()
+                        break
+                    rss_mb = get_rss_mb(process.pid)
+                    with server.state.lock:
+                        committed = len(server.state.commits)
+                    if rss_mb is not None:
+                        samples.append((elapsed, committed, rss_mb))
+                        if len(samples) % 60 == 0:
+                            print(f"{elapsed:8.0f}s {committed:6} chapters {rss_mb:8.1f} MB")
+                    time.sleep(vargs.interval)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+    finally:
+        server.stop()
+
+    committed = len(server.state.commits)
+    growth = get_growth(samples, vargs.chapters, vargs.warmup)
+    report = dict(growth, chapters=vargs.chapters, committed=committed, exit_code=process.returncode)
+    print(json.dumps(report, indent=4))
+    if vargs.output:
+        vargs.output.write_text(json.dumps(dict(report, rss=samples), indent=4), encoding="utf-8")
+
+    if process.returncode != 0 or committed < vargs.chapters:
+        print(f"Uploaded {committed} of {vargs.chapters} chapters, exit code {process.returncode}.")
+        sys.exit(1)
+    if growth["growth_mb"] is None:
+        print("Not enough memory samples after the warmup, upload more chapters.")
+        sys.exit(1)
+    if growth["growth_mb"] > vargs.max_growth:
+        print(f"The memory grew by {growth['growth_mb']:.1f} MB after the warmup, more than {vargs.max_growth} MB.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
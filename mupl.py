@@ -4,21 +4,42 @@ import json
 import time
 import locale
 import shutil
+import signal
 import asyncio
 import logging
+import zipfile
 import argparse
-from PIL import Image
+import threading
 from pathlib import Path
 from datetime import datetime
 from colorama import Fore, Style
-from typing import Optional, List
-
-import natsort
+from typing import Optional, List, Dict, Tuple
 
 from mupl.file_validator import FileProcesser
+from mupl.http import RequestError
+from mupl.http.bandwidth import upload_bandwidth
+from mupl.http.breaker import circuit_breakers
 from mupl.http.client import HTTPClient
+from mupl.http.metrics import http_metrics
+from mupl.id_validator import IdValidator
+from mupl.image_validator import ImageProcessorBase
+from mupl.http.stats import UploadStats
+from mupl.name_id_map import NameIdMap, add_to_name_id_map, load_name_id_map
+from mupl.name_resolver import NameResolver, Resolution
+from mupl.planner import UploadPlan
+from mupl.scheduler import get_series_priorities
+from mupl.scan_index import ScanIndex
+from mupl.uploader.archiver import archiver
+from mupl.uploader.leases import chapter_leases
+from mupl.uploader.jobs import JobQueue, JobState
 from mupl.uploader.uploader import ChapterUploader
-from mupl.utils.config import config, RATELIMIT_TIME, root_path, VERBOSE, translate_message
+from mupl.utils import start_logging
+from mupl.utils.config import context
+from mupl.utils.events import EventType, JsonLinesSink, TerminalSink, emit, event_bus
+from mupl.utils.memory import memory_budget, sample_peak_rss
+from mupl.utils.profiling import PROFILE_MODES, profiler
+from mupl.utils.tracing import span, tracer
+from mupl.watcher import UploadFolderWatcher
 
 logger = logging.getLogger("mupl")
 
@@ -28,85 +49,242 @@ height_max = 10000
 # Number of desired parts
 num_parts = 5
 
-default_locale = locale.getdefaultlocale()
-if default_locale[0]:
-    locale.setlocale(locale.LC_TIME, default_locale[0])
-else:
-    locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
+# Image files checked for the height limit
+image_extensions = ['.png', '.jpg', '.jpeg', '.webp']
+
+# Dates in the user's locale, or in English where it isn't installed
+for time_locale in ('', 'en_US.UTF-8'):
+    try:
+        locale.setlocale(locale.LC_TIME, time_locale)
+        break
+    except locale.Error:
+        # Minimal systems and containers may not have the locale installed
+        logger.debug(f"Locale {time_locale or 'of the user'} isn't available.")
 
 def cup_images(image, output_folder, path, allow_ext):
+    """Split a tall image into parts, the image is only removed once every part is saved."""
+    from PIL import Image
+
     os.makedirs(output_folder, exist_ok=True)
-    
-    # Open the image
-    image_size = Image.open(image)
-    
-    # Get the dimensions of the image
-    width, height = image_size.size
-    
-    # Height of each part
-    height_part = height // num_parts
-    
-    # Loop to crop the image into parts
-    for i in range(num_parts):
-        # Set the cropping coordinates for the current part
-        left = 0
-        top = i * height_part
-        right = width
-        bottom = (i + 1) * height_part
-
-        # Crop the current part
-        current_part = image_size.crop((left, top, right, bottom))
-
-        # Save the current part with the desired name
-        filename = os.path.basename(image)
-        name, extension = os.path.splitext(filename)
-        part_path = os.path.join(output_folder, f"{name}-{i}.jpg")
-        current_part.save(part_path)
-
-        # Close the image of the current part
-        current_part.close()
-    
+    filename = os.path.basename(image)
+    name, extension = os.path.splitext(filename)
+    part_paths = []
+
+    try:
+        with Image.open(image) as image_size:
+            # Get the dimensions of the image
+            width, height = image_size.size
+
+            # Height of each part
+            height_part = height // num_parts
+
+            # Loop to crop the image into parts
+            for i in range(num_parts):
+                # Set the cropping coordinates for the current part
+                left = 0
+                top = i * height_part
+                right = width
+                bottom = (i + 1) * height_part
+
+                # Crop the current part and save it with the desired name
+                part_path = os.path.join(output_folder, f"{name}-{i}.jpg")
+                part_paths.append(part_path)
+                with image_size.crop((left, top, right, bottom)) as current_part:
+                    current_part.save(part_path)
+    except Exception:
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        raise
+
     os.remove(image)
-    
+
     output_files = [f for f in os.listdir(output_folder) if f.lower().endswith(tuple(allow_ext))]
     for image in output_files:
         output_pathfile = os.path.join(output_folder, image)
         shutil.move(output_pathfile, path)
 
 
-def check_images(path, allow_ext):
+def check_images(path, allow_ext) -> "bool":
+    """Split the images taller than the limit, return whether any was split.
+    Images that can't be read or split are left as they are."""
+    from PIL import Image
+
     image_files = [f for f in os.listdir(path) if f.lower().endswith(tuple(allow_ext))]
     input_images = [os.path.join(path, image) for image in image_files]
     output_folder = os.path.join(path, "temp")
-    
+
     images_over_limit = []
-    try:
-        for image in input_images:
-            image_size = Image.open(image)
-            height = image_size.height
-            image_size.close()
-            if height > height_max:
-                images_over_limit.append(image)
-    except:
-        pass
-
-    if images_over_limit:
-        for image in images_over_limit:
+    for image in input_images:
+        try:
+            with Image.open(image) as image_size:
+                height = image_size.height
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logger.warning(f"Couldn't read the height of {image}: {e}")
+            continue
+        if height > height_max:
+            images_over_limit.append(image)
+
+    split = False
+    for image in images_over_limit:
+        try:
             cup_images(image, output_folder, path, allow_ext)
-        
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logger.error(f"Couldn't split {image}: {e}")
+        else:
+            split = True
+
     if os.path.exists(output_folder):
-        os.rmdir(output_folder)
+        try:
+            os.rmdir(output_folder)
+        except OSError as e:
+            logger.warning(f"Couldn't remove {output_folder}: {e}")
+    return split
+
+
+def split_tall_images(file_name_obj: "FileProcesser"):
+    """Split the tall images of a chapter folder that finished being copied."""
+    to_upload = file_name_obj.to_upload
+    if not to_upload.is_dir() or not chapter_leases.claim(to_upload):
+        return
+    try:
+        with span("split", chapter=to_upload.name):
+            split = check_images(to_upload, image_extensions)
+    finally:
+        chapter_leases.release(to_upload)
+
+    if split:
+        file_name_obj.page_manifest = ImageProcessorBase.get_page_manifest(to_upload)
+
+
+def process_upload_source(
+    to_upload: "Path",
+    names_to_ids: "dict",
+    scan_index: "ScanIndex",
+    allow_ext: "List[str]",
+    extended: "bool",
+    report_missing: "bool" = True,
+    split_images: "bool" = True,
+) -> "Tuple[FileProcesser, bool]":
+    """Process a chapter file or folder, reusing the scan index entry if the source didn't change.
+    Without split_images, tall images are left to split_tall_images once the folder is copied."""
+    signature = scan_index.signature(to_upload)
+    scan_entry = scan_index.get(to_upload, signature)
+    # Not indexed until its images are checked
+    unchecked = scan_entry is None and to_upload.is_dir() and not split_images
+
+    # Images were already checked for the indexed state of the source,
+    # splitting them is left to the host uploading it
+    if scan_entry is None and to_upload.is_dir() and split_images and chapter_leases.claim(to_upload):
+        try:
+            with span("split", chapter=to_upload.name):
+                check_images(to_upload, allow_ext)
+        finally:
+            chapter_leases.release(to_upload)
+        signature = scan_index.signature(to_upload)
+
+    with span("parse_name", chapter=to_upload.name):
+        zip_obj = FileProcesser(to_upload, names_to_ids, report_missing)
+        if extended:
+            zip_name_process = zip_obj.process_zip_name_extanded()
+        else:
+            zip_name_process = zip_obj.process_zip_name()
 
+    metadata = zip_obj.get_metadata()
+    pages = None if scan_entry is None else scan_entry.pages
+    if zip_name_process and pages is None:
+        try:
+            with span("page_manifest", chapter=to_upload.name):
+                pages = ImageProcessorBase.get_page_manifest(to_upload)
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.error(f"Couldn't read the pages of {to_upload}: {e}")
+
+    if not unchecked and (scan_entry is None or scan_entry.pages != pages or scan_entry.metadata != metadata):
+        scan_index.update(to_upload, signature, metadata, pages)
+
+    zip_obj.page_manifest = pages
+    return zip_obj, zip_name_process
+
+
+def apply_name_resolutions(names_to_ids: "dict", resolutions: "List[Resolution]"):
+    """Add the resolved names to the name-to-id map and report the others."""
+    resolved: "Dict[str, Dict[str, str]]" = {}
+    for resolution in resolutions:
+        if resolution.known:
+            names_to_ids[resolution.section][resolution.name] = resolution.entity_id
+        elif resolution.entity_id is not None:
+            logger.info(f"Resolved the {resolution.section} {resolution.name} to {resolution.entity_id}.")
+            print(context.translate_message['resolver_found'].format(resolution.name, resolution.entity_id))
+            names_to_ids[resolution.section][resolution.name] = resolution.entity_id
+            resolved.setdefault(resolution.section, {})[resolution.name] = resolution.entity_id
+        elif not resolution.searched:
+            logger.warning(f"Couldn't search for the {resolution.section} {resolution.name}, trying again on the next scan.")
+            print(context.translate_message['resolver_search_failed'].format(resolution.name))
+        elif resolution.ambiguous:
+            candidates = ", ".join(f"{x} ({name})" for x, name in resolution.candidates)
+            logger.warning(f"The {resolution.section} {resolution.name} matches more than one id: {candidates}")
+            print(context.translate_message['resolver_ambiguous'].format(resolution.name, candidates))
+        else:
+            logger.warning(f"No {resolution.section} found for {resolution.name}.")
+            print(context.translate_message['resolver_not_found'].format(resolution.name))
 
-def get_zips_to_upload(names_to_ids: "dict", allow_ext = ['.png', '.jpg', '.jpeg', '.webp']) -> "Optional[List[FileProcesser]]":
-    """Get a list of files that end with a zip/cbz extension for uploading."""
-    to_upload_folder_path = Path(config["paths"]["uploads_folder"])
+    if resolved and context.resolve_names_write_map:
+        try:
+            add_to_name_id_map(context.root_path.joinpath("name_id_map.json"), resolved)
+        except (OSError, ValueError) as e:
+            logger.error(f"Couldn't add the resolved names to the name-to-id map: {e}")
+
+
+def get_zips_to_upload(
+    names_to_ids: "dict",
+    allow_ext = image_extensions,
+    quiet: "bool" = False,
+    name_resolver: "Optional[NameResolver]" = None,
+    split_images: "bool" = True,
+) -> "Optional[List[FileProcesser]]":
+    """Get a list of files that end with a zip/cbz extension for uploading.
+    With a name resolver, names missing from the map are searched on the api."""
+    to_upload_folder_path = Path(context.config["paths"]["uploads_folder"])
     zips_to_upload: "List[FileProcesser]" = []
     zips_invalid_file_name = []
     zips_no_manga_id = []
+    seen_paths: "List[Path]" = []
+    # Sources with names to resolve before they are sorted out
+    unresolved_sources: "List[Tuple[Path, bool, dict]]" = []
+    scan_index = ScanIndex(context.scan_index_path)
+    if name_resolver is not None:
+        name_resolver.start_scan()
+
+    def process_source(to_upload: "Path", extended: "bool"):
+        zip_obj, zip_name_process = process_upload_source(
+            to_upload, names_to_ids, scan_index, allow_ext, extended, name_resolver is None, split_images
+        )
+        if name_resolver is not None:
+            if name_resolver.untried(zip_obj.unresolved_names):
+                unresolved_sources.append((to_upload, extended, zip_obj.unresolved_names))
+                return
+            if zip_obj.manga_series is None and zip_obj.zip_name_match is not None:
+                logger.error(f"Couldn't find a manga id for {zip_obj.zip_name}, skipping.")
+                print(f"{context.translate_message['skip_no_manga_id']}".format(zip_obj.zip_name))
+
+        if zip_name_process:
+            zips_to_upload.append(zip_obj)
+
+        if zip_obj.zip_name_match is None:
+            zips_invalid_file_name.append(to_upload)
+
+        if zip_obj.manga_series is None and zip_obj.zip_name_match is not None:
+            zips_no_manga_id.append(to_upload)
+
+    def add_upload_source(to_upload: "Path", extended: "bool" = True):
+        seen_paths.append(to_upload)
+        process_source(to_upload, extended)
 
     for archive in to_upload_folder_path.iterdir():
-        
+        # Hidden files, such as the watch mode markers
+        if archive.name.startswith('.'):
+            continue
+
         # Language [1]
         if archive.name.startswith('[') and archive.name.endswith(']'):
             if archive.is_dir():
@@ -135,38 +313,13 @@ def get_zips_to_upload(names_to_ids: "dict", allow_ext = ['.png', '.jpg', '.jpeg
                                         
                                                     for name_tag in chapter_tag.iterdir():
                                                         if name_tag.is_dir():
-                                                            
-                                                            check_images(name_tag, allow_ext)
-                                                            zip_obj = FileProcesser(name_tag, names_to_ids)
-                                                            zip_name_process = zip_obj.process_zip_name_extanded()
-                                                            
-                                                            if zip_name_process:
-                                                                if not zip_obj in zips_to_upload:
-                                                                    zips_to_upload.append(zip_obj)
-
-                                                            if zip_obj.zip_name_match is None:
-                                                                zips_invalid_file_name.append(name_tag)
-
-                                                            if zip_obj.manga_series is None and zip_obj.zip_name_match is not None:
-                                                                zips_no_manga_id.append(name_tag)
+                                                            add_upload_source(name_tag)
                                                         
                                                 else:
-                                                    check_images(chapter_tag, allow_ext)
-                                                    zip_obj = FileProcesser(chapter_tag, names_to_ids)
-                                                    zip_name_process = zip_obj.process_zip_name_extanded()
-                                                    
-                                                    if zip_name_process:
-                                                        if not zip_obj in zips_to_upload:
-                                                            zips_to_upload.append(zip_obj)
-
-                                                    if zip_obj.zip_name_match is None:
-                                                        zips_invalid_file_name.append(chapter_tag)
-
-                                                    if zip_obj.manga_series is None and zip_obj.zip_name_match is not None:
-                                                        zips_no_manga_id.append(chapter_tag)
+                                                    add_upload_source(chapter_tag)
                                 
-                                # Chapter [4]
-                                for chapter_tag in group_tag.iterdir():
+                                # Chapter [4], without a volume folder the chapters are in the title folder
+                                for chapter_tag in title_tag.iterdir():
                                     if chapter_tag.is_dir():
                                         
                                         if chapter_tag.name.startswith('v'):
@@ -177,54 +330,30 @@ def get_zips_to_upload(names_to_ids: "dict", allow_ext = ['.png', '.jpg', '.jpeg
                                             
                                             for name_tag in chapter_tag.iterdir():
                                                 if name_tag.is_dir():
-                                                    
-                                                    check_images(name_tag, allow_ext)
-                                                    zip_obj = FileProcesser(name_tag, names_to_ids)
-                                                    zip_name_process = zip_obj.process_zip_name_extanded()
-                                                    
-                                                    if zip_name_process:
-                                                        if not zip_obj in zips_to_upload:
-                                                            zips_to_upload.append(zip_obj)
-
-                                                    if zip_obj.zip_name_match is None:
-                                                        zips_invalid_file_name.append(name_tag)
-
-                                                    if zip_obj.manga_series is None and zip_obj.zip_name_match is not None:
-                                                        zips_no_manga_id.append(name_tag)
+                                                    add_upload_source(name_tag)
                                             
                                         else:
-                                            check_images(chapter_tag, allow_ext)
-                                            zip_obj = FileProcesser(chapter_tag, names_to_ids)
-                                            zip_name_process = zip_obj.process_zip_name_extanded()
-                                            
-                                            if zip_name_process:
-                                                if not zip_obj in zips_to_upload:
-                                                    zips_to_upload.append(zip_obj)
-
-                                            if zip_obj.zip_name_match is None:
-                                                zips_invalid_file_name.append(chapter_tag)
-
-                                            if zip_obj.manga_series is None and zip_obj.zip_name_match is not None:
-                                                zips_no_manga_id.append(chapter_tag)
+                                            add_upload_source(chapter_tag)
     
         else:
-            check_images(archive, allow_ext)
-            zip_obj = FileProcesser(archive, names_to_ids)
-            zip_name_process = zip_obj.process_zip_name()
-        
-        if zip_name_process:
-            if not zip_obj in zips_to_upload:
-                zips_to_upload.append(zip_obj)
+            add_upload_source(archive, extended=False)
 
-        if zip_obj.zip_name_match is None:
-            zips_invalid_file_name.append(archive)
+    # Groups of a chapter are only read once its title is resolved, so resolve again for them
+    while unresolved_sources:
+        sources = unresolved_sources[:]
+        unresolved_sources.clear()
+        names: "Dict[str, List[str]]" = {}
+        for _, _, unresolved_names in sources:
+            for section, section_names in unresolved_names.items():
+                names.setdefault(section, []).extend(section_names)
 
-        if zip_obj.manga_series is None and zip_obj.zip_name_match is not None:
-            zips_no_manga_id.append(archive)
+        with span("resolve_names"):
+            apply_name_resolutions(names_to_ids, name_resolver.resolve(names))
+        for to_upload, extended, _ in sources:
+            process_source(to_upload, extended)
 
-    # Sort the array to mirror your system's file explorer
-    zips_to_upload = natsort.os_sorted(zips_to_upload, key=lambda x: x.to_upload)
-    zips_to_upload = natsort.os_sorted(zips_to_upload, key=lambda x: (x.volume_number, x.chapter_number))
+    scan_index.prune(seen_paths)
+    scan_index.close()
 
     if zips_invalid_file_name:
         logger.warning(
@@ -245,80 +374,517 @@ def get_zips_to_upload(names_to_ids: "dict", allow_ext = ['.png', '.jpg', '.jpeg
         )
 
     if not zips_to_upload:
-        print(translate_message['invalid_folder_to_upload'])
-        logger.error(f"Exited due to {len(zips_to_upload)} zips not being valid.")
+        if not quiet:
+            print(context.translate_message['invalid_folder_to_upload'])
+            logger.error(f"Exited due to {len(zips_to_upload)} zips not being valid.")
         return
 
     logger.debug(f"Uploading files: {zips_to_upload}")
     return zips_to_upload
 
 
-def open_manga_series_map(files_path: "Path") -> "dict":
+def open_manga_series_map(files_path: "Path") -> "NameIdMap":
     """Get the manga-name-to-id map."""
+    map_path = context.root_path.joinpath("name_id_map.json")
     try:
-        with open(os.path.join(Path.home(), "MangaDex Uploader (APP)", "name_id_map.json"), "r", encoding="utf-8",) as json_file:
-            names_to_ids = json.load(json_file)
+        names_to_ids = load_name_id_map(map_path, map_path.with_name(f".{map_path.stem}.cache"))
     except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
         logger.exception("Please check your name-to-id file.")
-        print(translate_message['check_file_name_to_id'])
-        return {"manga": {}, "group": {}}
+        print(context.translate_message['check_file_name_to_id'])
+        return NameIdMap({"manga": {}, "group": {}})
     return names_to_ids
 
 
-def main(threaded: "bool" = True):
-    """Run the mupl on each zip."""
-    names_to_ids = open_manga_series_map(root_path)
-    zips_to_upload = get_zips_to_upload(names_to_ids)
-    if zips_to_upload is None:
-        return
-
-    http_client = HTTPClient()
-    failed_uploads: "List[Path]" = []
+def wait_for_api(stop_event: "Optional[threading.Event]" = None) -> "bool":
+    """Pause the uploads while the circuit breaker of an api route is open,
+    return False if stopped meanwhile."""
+    retry_after = circuit_breakers.retry_after()
+    while retry_after > 0:
+        open_routes = ", ".join(circuit_breakers.open_routes())
+        logger.warning(f"Pausing the uploads for {retry_after:.0f} seconds, failing routes: {open_routes}.")
+        print(context.translate_message['api_paused'].format(open_routes, round(retry_after)))
+        if stop_event is not None:
+            if stop_event.wait(retry_after):
+                return False
+        else:
+            time.sleep(retry_after)
+        retry_after = circuit_breakers.retry_after()
+    return True
+
+
+def upload_chapters(
+    http_client: "HTTPClient",
+    zips_to_upload: "List[FileProcesser]",
+    names_to_ids: "dict",
+    failed_uploads: "List[Path]",
+    threaded: "bool",
+    job_queue: "JobQueue",
+    stop_event: "Optional[threading.Event]" = None,
+) -> "bool":
+    """Upload each chapter, return False if the uploads were interrupted."""
+    for file_name_obj in zips_to_upload:
+        emit(
+            EventType.CHAPTER_QUEUED,
+            str(file_name_obj.to_upload),
+            pages=len(file_name_obj.page_manifest or []),
+        )
 
     for index, file_name_obj in enumerate(zips_to_upload, start=1):
+        if stop_event is not None and stop_event.is_set():
+            return False
+        # The first request of the chapter to each paused route probes it
+        if not wait_for_api(stop_event):
+            return False
+
+        # Another host sharing the upload folder is uploading it
+        if not chapter_leases.claim(file_name_obj.to_upload):
+            # Gone when another host already archived it
+            if file_name_obj.to_upload.exists():
+                logger.info(f"{file_name_obj.to_upload} is claimed by another host, skipping.")
+                print(context.translate_message['lease_claimed'].format(file_name_obj.zip_name))
+            continue
+
+        job_queue.add(file_name_obj.to_upload)
         try:
-            print(f"\n\n[{datetime.now().strftime('%c')}] {translate_message['uploading_draft']} {str(file_name_obj.manga_series)} - {str(file_name_obj.chapter_number)}\n{'-'*100}")
+            print(f"\n\n[{datetime.now().strftime('%c')}] {context.translate_message['uploading_draft']} {str(file_name_obj.manga_series)} - {str(file_name_obj.chapter_number)}\n{'-'*100}")
             
-            uploader_process = ChapterUploader(
-                http_client, file_name_obj, names_to_ids, failed_uploads, threaded
+            with profiler.chapter(file_name_obj.zip_name), span(
+                "chapter", chapter=file_name_obj.zip_name
+            ) as chapter_span:
+                with sample_peak_rss() as peak_rss:
+                    uploader_process = ChapterUploader(
+                        http_client, file_name_obj, names_to_ids, failed_uploads, threaded, job_queue
+                    )
+                    try:
+                        uploader_process.upload()
+                    finally:
+                        uploader_process.close()
+
+                buffer_peaks = memory_budget.take_peaks()
+                chapter_span.set(
+                    peak_rss_mb=peak_rss.peak_mb,
+                    **{f"peak_{x}_bytes": y for x, y in buffer_peaks.items()},
+                )
+            logger.info(
+                f"Peak memory of {file_name_obj.zip_name}: {peak_rss.peak_mb} MB, page buffers "
+                + ", ".join(f"{x} {round(y / (1024 * 1024), 1)} MB" for x, y in buffer_peaks.items())
             )
-            uploader_process.upload()
-            if not uploader_process.folder_upload:
-                uploader_process.myzip.close()
 
-            http_client.login()
+            try:
+                http_client.login()
+            except RequestError as e:
+                # The next chapter waits for the api before logging in again
+                logger.error(e)
 
             # Delete to save memory on large amounts of uploads
             del uploader_process
+            http_client.upload_stats.save()
+            http_metrics.save()
+            # Let the progress bar finish before the next messages
+            event_bus.flush()
 
-            print(f"{'-'*100}\n{Fore.GREEN}[{datetime.now().strftime('%c')}] {translate_message['finish_upload']} {str(file_name_obj.manga_series)} - {str(file_name_obj.chapter_number)}{Style.RESET_ALL}\n{'-'*100}")
+            print(f"{'-'*100}\n{Fore.GREEN}[{datetime.now().strftime('%c')}] {context.translate_message['finish_upload']} {str(file_name_obj.manga_series)} - {str(file_name_obj.chapter_number)}{Style.RESET_ALL}\n{'-'*100}")
             logger.debug("Sleeping between zip upload.")
-            time.sleep(RATELIMIT_TIME * 2)
+            if stop_event is not None:
+                stop_event.wait(context.ratelimit_time * 2)
+            else:
+                time.sleep(context.ratelimit_time * 2)
         except KeyboardInterrupt:
             logger.warning(
                 f"Keyboard Interrupt detected during upload of {str(file_name_obj.manga_series)} - {str(file_name_obj.chapter_number)}"
             )
-            print(translate_message['keyboard_interrupt_exit'])
+            print(context.translate_message['keyboard_interrupt_exit'])
             try:
                 asyncio.get_event_loop().stop()
                 asyncio.get_event_loop().close()
-                uploader_process.remove_upload_session()
-                if not uploader_process.folder_upload:
-                    uploader_process.myzip.close()
+                job = job_queue.get(file_name_obj.to_upload)
+                # Sent for commit or committed, the next run checks it instead
+                interrupted_upload = job is not None and job.state in (
+                    JobState.PREPARING, JobState.UPLOADING
+                )
+                if interrupted_upload:
+                    uploader_process.remove_upload_session()
+                uploader_process.close()
                 del uploader_process
             except UnboundLocalError:
                 pass
             else:
-                failed_uploads.append(file_name_obj.to_upload)
-            break
+                if interrupted_upload:
+                    failed_uploads.append(file_name_obj.to_upload)
+                    job_queue.set_state(file_name_obj.to_upload, JobState.FAILED, error="Interrupted.")
+            return False
+        finally:
+            chapter_leases.release(file_name_obj.to_upload)
+    return True
+
+
+def recover_committed_chapters(
+    http_client: "HTTPClient",
+    zips_to_upload: "List[FileProcesser]",
+    names_to_ids: "dict",
+    job_queue: "JobQueue",
+    reset_committing: "bool" = False,
+) -> "List[FileProcesser]":
+    """Finish the chapters committed in a previous run but not moved to the uploaded folder,
+    return the chapters that still need to be uploaded."""
+    remaining_zips = []
+    for file_name_obj in zips_to_upload:
+        job = job_queue.get(file_name_obj.to_upload)
+        if job is None or job.state not in (JobState.COMMITTING, JobState.COMMITTED):
+            remaining_zips.append(file_name_obj)
+            continue
+
+        uploader_process = ChapterUploader(
+            http_client, file_name_obj, names_to_ids, [], False, job_queue
+        )
+        uploader_process.close()
+
+        if job.state == JobState.COMMITTING:
+            committed, chapter_id = uploader_process.check_commit(job.session_id, job.updated)
+            if committed is None and reset_committing:
+                logger.warning(f"{file_name_obj.to_upload} was interrupted while committing, uploading it again.")
+                job_queue.reset(file_name_obj.to_upload)
+                remaining_zips.append(file_name_obj)
+                continue
+            if committed is None:
+                logger.warning(f"{file_name_obj.to_upload} was interrupted while committing, not uploading again.")
+                print(context.translate_message['job_commit_interrupted'].format(file_name_obj.zip_name))
+                continue
+            if not committed:
+                logger.info(f"{file_name_obj.to_upload} wasn't committed before the interruption, uploading it again.")
+                print(context.translate_message['job_commit_not_done'].format(file_name_obj.zip_name))
+                uploader_process.remove_upload_session(job.session_id)
+                job_queue.reset(file_name_obj.to_upload)
+                remaining_zips.append(file_name_obj)
+                continue
+            job_queue.set_state(file_name_obj.to_upload, JobState.COMMITTED, chapter_id=chapter_id)
+            job = job_queue.get(file_name_obj.to_upload)
+
+        logger.info(f"{file_name_obj.to_upload} was committed as {job.chapter_id}, archiving it.")
+        print(context.translate_message['job_already_committed'].format(file_name_obj.zip_name))
+        if uploader_process.move_files():
+            job_queue.set_state(file_name_obj.to_upload, JobState.ARCHIVED)
+    return remaining_zips
+
+
+def reject_unknown_ids(
+    http_client: "HTTPClient",
+    zips_to_upload: "List[FileProcesser]",
+    failed_uploads: "List[Path]",
+    job_queue: "JobQueue",
+) -> "List[FileProcesser]":
+    """Fail the chapters whose manga or group ids don't exist before creating any
+    upload session, return the chapters that can be uploaded."""
+    if not zips_to_upload:
+        return zips_to_upload
+
+    with span("id_check", chapters=len(zips_to_upload)):
+        valid_zips, rejected = IdValidator(http_client).validate(zips_to_upload)
+
+    for file_name_obj, reason in rejected:
+        logger.error(f"Not uploading {file_name_obj.to_upload}: {reason}")
+        print(context.translate_message['unknown_ids'].format(file_name_obj.zip_name, reason))
+        failed_uploads.append(file_name_obj.to_upload)
+        job_queue.add(file_name_obj.to_upload)
+        job_queue.set_state(file_name_obj.to_upload, JobState.FAILED, error=reason)
+        emit(EventType.FAILURE, str(file_name_obj.to_upload), detail=reason)
+    return valid_zips
+
+
+def retry_failed_uploads(
+    http_client: "HTTPClient",
+    zips_to_upload: "List[FileProcesser]",
+    names_to_ids: "dict",
+    failed_uploads: "List[Path]",
+    threaded: "bool",
+    job_queue: "JobQueue",
+    stop_event: "Optional[threading.Event]" = None,
+):
+    """Retry the failed chapters in deferred passes, waiting longer after each attempt."""
+    while failed_uploads:
+        failed_paths = set(failed_uploads)
+        retry_zips = [
+            x for x in zips_to_upload if x.to_upload in failed_paths and x.to_upload.exists()
+        ]
+        next_retry = job_queue.next_retry(x.to_upload for x in retry_zips)
+        if next_retry is None:
+            return
+
+        retry_delay = max(0, next_retry - time.time())
+        logger.info(f"Retrying {len(retry_zips)} failed uploads in {retry_delay} seconds.")
+        print(context.translate_message['retry_failed_uploads'].format(len(retry_zips), round(retry_delay)))
+        if stop_event is not None:
+            if stop_event.wait(retry_delay):
+                return
+        else:
+            time.sleep(retry_delay)
+
+        retry_zips = [x for x in retry_zips if job_queue.should_upload(x.to_upload)]
+        retry_paths = {x.to_upload for x in retry_zips}
+        failed_uploads[:] = [x for x in failed_uploads if x not in retry_paths]
+        if not upload_chapters(
+            http_client, retry_zips, names_to_ids, failed_uploads, threaded, job_queue, stop_event
+        ):
+            return
+
+
+def open_job_queue() -> "JobQueue":
+    return JobQueue(
+        context.job_queue_path,
+        max_attempts=context.upload_retry_passes + 1,
+        retry_delay=context.retry_pass_delay,
+    )
 
+
+def start_archiver():
+    """Finish the archival of the chapters left staged by an earlier run in the background."""
+    archiver.configure(
+        Path(context.config["paths"]["uploads_folder"]),
+        Path(context.config["paths"]["uploaded_files"]),
+        context.archive_pack_folders,
+    )
+
+
+def start_leases():
+    """Claim the chapters before uploading them when several hosts share the upload folder."""
+    chapter_leases.configure(
+        Path(context.config["paths"]["uploads_folder"]),
+        context.shared_upload_folder,
+        context.lease_time,
+    )
+
+
+def print_failed_uploads(failed_uploads: "List[Path]"):
     if failed_uploads:
         logger.info(f"Failed uploads: {failed_uploads}")
-        print(translate_message['failed_uploads'] if len(failed_uploads) == 1 else translate_message['failed_upload'])
+        print(context.translate_message['failed_uploads'] if len(failed_uploads) == 1 else context.translate_message['failed_upload'])
         for fail in failed_uploads:
-            prefix = translate_message['metod_folder'] if fail.is_dir() else translate_message['metod_archive']
+            prefix = context.translate_message['metod_folder'] if fail.is_dir() else context.translate_message['metod_archive']
             print("{}: {}".format(prefix, fail.name))
 
+
+def print_trace_summary():
+    """Print the time spent in each stage of the traced run."""
+    summary = tracer.summary()
+    if not summary:
+        return
+
+    print(f"\n{context.translate_message['trace_summary']}")
+    print(
+        f"{context.translate_message['trace_stage']:<16} {context.translate_message['trace_count']:>10} "
+        f"{context.translate_message['trace_total']:>10} {context.translate_message['trace_mean']:>10} "
+        f"{context.translate_message['trace_max']:>10} {context.translate_message['trace_cpu']:>6}"
+    )
+    for stage in summary:
+        print(
+            f"{stage['name']:<16} {stage['count']:>10} {stage['total']:>9.2f}s "
+            f"{stage['mean'] * 1000:>8.1f}ms {stage['max'] * 1000:>8.1f}ms {stage['cpu']:>6.0%}"
+        )
+
+
+def print_http_metrics(show: "bool"):
+    """Log the api requests of the run per route, printing them if asked."""
+    summary = http_metrics.summary()
+    if not summary:
+        return
+
+    for route in summary:
+        logger.info(
+            "%s: %s requests, p50 %s, p95 %s, p99 %s, sent %s bytes, received %s bytes, "
+            "status codes %s, retries %s, errors %s, rate limit sleep %.1fs, pool wait %.3fs",
+            route["route"],
+            route["requests"],
+            route["p50"],
+            route["p95"],
+            route["p99"],
+            route["request_bytes"],
+            route["response_bytes"],
+            route["status_codes"],
+            route["retries"],
+            route["errors"],
+            route["ratelimit_sleep"],
+            route["pool_wait"],
+        )
+    if not show:
+        return
+
+    def format_ms(seconds: "Optional[float]") -> "str":
+        return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+    print(f"\n{context.translate_message['metrics_summary']}")
+    print(
+        f"{context.translate_message['metrics_route']:<28} {context.translate_message['metrics_requests']:>11} "
+        f"{'p50':>8} {'p95':>8} {'p99':>8} {context.translate_message['metrics_sent']:>10} "
+        f"{context.translate_message['metrics_received']:>10} {'429':>5} {context.translate_message['metrics_retries']:>10} "
+        f"{context.translate_message['metrics_sleep']:>17} {context.translate_message['metrics_pool_wait']:>18}"
+    )
+    for route in summary:
+        print(
+            f"{route['route']:<28} {route['requests']:>11} {format_ms(route['p50']):>8} "
+            f"{format_ms(route['p95']):>8} {format_ms(route['p99']):>8} "
+            f"{route['request_bytes'] / 1048576:>8.2f}MB {route['response_bytes'] / 1048576:>8.2f}MB "
+            f"{route['rate_limited']:>5} {route['retries']:>10} {route['ratelimit_sleep']:>16.1f}s "
+            f"{route['pool_wait']:>17.3f}s"
+        )
+
+
+def reload_bandwidth_limit(signum, frame):
+    """Apply the upload bandwidth limit and schedule of the config file while uploading."""
+    logger.info(f"Received signal {signum}, reloading the upload bandwidth limit.")
+    context.reload()
+    try:
+        upload_bandwidth.configure(
+            context.upload_bandwidth_limit, context.upload_bandwidth_schedule
+        )
+    except Exception as e:
+        logger.error(f"Couldn't reload the upload bandwidth limit: {e}")
+
+
+def watch_upload_folder(threaded: "bool", reset_committing: "bool" = False):
+    """Keep running and upload the chapters as they are added to the upload folder.
+    SIGTERM (or a keyboard interrupt) stops the watcher after the current chapter."""
+    stop_event = threading.Event()
+
+    def stop_watching(signum, frame):
+        logger.info(f"Received signal {signum}, stopping after the current chapter.")
+        print(context.translate_message['watch_stopping'])
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop_watching)
+
+    watcher = UploadFolderWatcher(
+        Path(context.config["paths"]["uploads_folder"]),
+        settle_time=context.watch_settle_time,
+        poll_interval=context.watch_poll_interval,
+        marker_name=context.watch_marker_file,
+    )
+    http_client = HTTPClient()
+    job_queue = open_job_queue()
+    start_archiver()
+    start_leases()
+    failed_uploads: "List[Path]" = []
+    name_resolver = NameResolver(http_client) if context.resolve_names else None
+    # Chapters already tried are only tried again once they change or their retry is due
+    attempted: "Dict[Path, Tuple[int, int]]" = {}
+
+    logger.info(f"Watching {watcher.folder} for new chapters.")
+    print(context.translate_message['watch_started'].format(watcher.folder))
+
+    try:
+        while not stop_event.is_set():
+            names_to_ids = open_manga_series_map(context.root_path)
+            with span("scan"):
+                # Chapters still being copied are split once they settle
+                zips_to_upload = get_zips_to_upload(
+                    names_to_ids, quiet=True, name_resolver=name_resolver, split_images=False
+                ) or []
+
+            new_zips = []
+            for file_name_obj in zips_to_upload:
+                try:
+                    signature = ScanIndex.signature(file_name_obj.to_upload)
+                except OSError:
+                    continue
+                if attempted.get(file_name_obj.to_upload) is None:
+                    job_queue.reset_attempts([file_name_obj.to_upload])
+                if (
+                    attempted.get(file_name_obj.to_upload) != signature
+                    or job_queue.should_upload(file_name_obj.to_upload)
+                ):
+                    new_zips.append(file_name_obj)
+
+            ready_zips = watcher.settled(new_zips)
+            for file_name_obj in ready_zips:
+                split_tall_images(file_name_obj)
+                attempted[file_name_obj.to_upload] = ScanIndex.signature(file_name_obj.to_upload)
+
+            if ready_zips:
+                upload_plan = UploadPlan(
+                    ready_zips, http_client.upload_stats, get_series_priorities(names_to_ids)
+                )
+                ready_zips = recover_committed_chapters(
+                    http_client, upload_plan.zips_to_upload, names_to_ids, job_queue, reset_committing
+                )
+                ready_zips = reject_unknown_ids(http_client, ready_zips, failed_uploads, job_queue)
+                if not upload_chapters(
+                    http_client, ready_zips, names_to_ids, failed_uploads, threaded, job_queue, stop_event
+                ):
+                    break
+                print(context.translate_message['watch_started'].format(watcher.folder))
+
+            watcher.wait(stop_event)
+    except KeyboardInterrupt:
+        print(context.translate_message['keyboard_interrupt_exit'])
+    finally:
+        watcher.close()
+        chapter_leases.release_all()
+        archiver.wait()
+        job_queue.close()
+
+    print_failed_uploads(failed_uploads)
+
+
+def main(
+    threaded: "bool" = True,
+    watch: "bool" = False,
+    plan: "bool" = False,
+    reset_committing: "bool" = False,
+):
+    """Run the mupl on each zip."""
+    if watch:
+        watch_upload_folder(threaded, reset_committing)
+        sys.exit(0)
+
+    names_to_ids = open_manga_series_map(context.root_path)
+    http_client = HTTPClient()
+    name_resolver = NameResolver(http_client) if context.resolve_names else None
+    start_leases()
+    with profiler.chapter("scan"), span("scan"):
+        zips_to_upload = get_zips_to_upload(names_to_ids, name_resolver=name_resolver)
+    if zips_to_upload is None:
+        return
+
+    if plan:
+        UploadPlan(
+            zips_to_upload,
+            UploadStats(context.upload_stats_path),
+            get_series_priorities(names_to_ids),
+        ).print_report()
+        sys.exit(0)
+
+    # SIGTERM, e.g. a cancel in the web ui, stops after the current chapter
+    stop_event = threading.Event()
+
+    def stop_uploading(signum, frame):
+        logger.info(f"Received signal {signum}, stopping after the current chapter.")
+        print(context.translate_message['watch_stopping'])
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, stop_uploading)
+
+    job_queue = open_job_queue()
+    start_archiver()
+    failed_uploads: "List[Path]" = []
+    upload_plan = UploadPlan(
+        zips_to_upload, http_client.upload_stats, get_series_priorities(names_to_ids)
+    )
+
+    zips_to_upload = upload_plan.zips_to_upload
+    job_queue.reset_attempts(x.to_upload for x in zips_to_upload)
+    zips_to_upload = recover_committed_chapters(
+        http_client, zips_to_upload, names_to_ids, job_queue, reset_committing
+    )
+    zips_to_upload = reject_unknown_ids(http_client, zips_to_upload, failed_uploads, job_queue)
+
+    if upload_chapters(http_client, zips_to_upload, names_to_ids, failed_uploads, threaded, job_queue, stop_event):
+        retry_failed_uploads(
+            http_client, zips_to_upload, names_to_ids, failed_uploads, threaded, job_queue, stop_event
+        )
+    chapter_leases.release_all()
+    archiver.wait()
+    job_queue.close()
+    print_failed_uploads(failed_uploads)
+
     sys.exit(0)
 
 
@@ -340,13 +906,103 @@ if __name__ == "__main__":
         nargs="?",
         help="Upload the images concurrently.",
     )
+    parser.add_argument(
+        "--watch",
+        "-w",
+        action="store_true",
+        help="Keep running and upload new chapters as they are added to the upload folder.",
+    )
+    parser.add_argument(
+        "--plan",
+        "-p",
+        action="store_true",
+        help="Print the pages, size, requests and estimated time of the upload without uploading.",
+    )
+    parser.add_argument(
+        "--reset-committing",
+        action="store_true",
+        help="Upload again the chapters interrupted while committing when MangaDex can't tell if they were uploaded.",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        default=None,
+        help="Time each upload stage, save the spans as a Chrome trace to this file and print a summary.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        default=None,
+        help="Profile the scan and each chapter, saving pstats and collapsed stack files to this folder.",
+    )
+    parser.add_argument(
+        "--profile-mode",
+        choices=PROFILE_MODES,
+        default=None,
+        help="cprofile profiles every call, sample samples the stacks with less overhead. "
+        "Defaults to sample in watch mode and cprofile otherwise.",
+    )
+    parser.add_argument(
+        "--profile-threshold",
+        type=float,
+        default=0,
+        help="Only save the profiles of the chapters that took at least this many seconds.",
+    )
+    parser.add_argument(
+        "--events",
+        type=Path,
+        default=None,
+        help="Append the upload progress events to this file as json lines.",
+    )
+    parser.add_argument(
+        "--bandwidth-control",
+        type=Path,
+        default=None,
+        help="Read the upload bandwidth limit from this json file whenever it changes while uploading, "
+        'e.g. {"limit": 2048} in KB/s, or {"limit": null} for the limits of the config.',
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        default=None,
+        help="Save the latency, bytes, status codes, retries and waits of the api requests per route "
+        "to this file in the Prometheus text format and print them at the end.",
+    )
 
     vargs = vars(parser.parse_args())
+    start_logging()
 
     if vargs["verbose"] == 0:
         logger.setLevel(logging.INFO)
     else:
-        VERBOSE = True
+        context.verbose = True
         logger.setLevel(logging.DEBUG)
 
-    main(vargs["threaded"])
+    if vargs["trace"] is not None:
+        tracer.start(vargs["trace"])
+    if vargs["profile"] is not None:
+        profile_mode = vargs["profile_mode"] or ("sample" if vargs["watch"] else "cprofile")
+        profiler.start(vargs["profile"], profile_mode, vargs["profile_threshold"])
+    http_metrics.prometheus_path = vargs["metrics"]
+    # Not available on Windows, where the limit is changed through --bandwidth-control
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_bandwidth_limit)
+    upload_bandwidth.control_path = vargs["bandwidth_control"]
+
+    event_bus.add_sink(TerminalSink())
+    if vargs["events"] is not None:
+        event_bus.add_sink(JsonLinesSink(vargs["events"]))
+    event_bus.start()
+
+    try:
+        main(vargs["threaded"], vargs["watch"], vargs["plan"], vargs["reset_committing"])
+    finally:
+        event_bus.stop()
+        if tracer.enabled:
+            tracer.stop()
+            print_trace_summary()
+        if profiler.enabled:
+            profiler.stop()
+            print(context.translate_message['profile_saved'].format(profiler.saved, profiler.folder))
+        http_metrics.save()
+        print_http_metrics(vargs["metrics"] is not None or context.verbose)
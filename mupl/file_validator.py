@@ -2,9 +2,9 @@ import logging
 import re
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional, List
+from typing import Dict, Optional, List
 
-from mupl.utils.config import config, translate_message
+from mupl.utils.config import context
 
 logger = logging.getLogger("mupl")
 
@@ -30,7 +30,7 @@ UUID_REGEX = re.compile(
 
 
 class FileProcesser:
-    def __init__(self, to_upload: "Path", names_to_ids: "dict") -> None:
+    def __init__(self, to_upload: "Path", names_to_ids: "dict", report_missing: "bool" = True) -> None:
         self.to_upload = to_upload
         self.zip_name = self.to_upload.name
         self.zip_extension = self.to_upload.suffix
@@ -47,6 +47,12 @@ class FileProcesser:
         self.groups = None
         self.chapter_title = None
         self.publish_date = None
+        # List of (image name, size) from the scan index
+        self.page_manifest = None
+        # Names not in the name-to-id map, for the name resolver
+        self.unresolved_names: "Dict[str, List[str]]" = {"manga": [], "group": []}
+        # Print the chapters skipped for a missing manga id, off while the names are resolved
+        self._report_missing = report_missing
 
     def _match_file_name(self) -> "Optional[re.Match[str]]":
         """Check for a full regex match of the file."""
@@ -54,7 +60,7 @@ class FileProcesser:
         if not zip_name_match:
             logger.error(f"{self.zip_name} isn't in the correct naming format.")
             print(
-                f"{translate_message['naming_format_incorret']}".format(self.zip_name)
+                f"{context.translate_message['naming_format_incorret']}".format(self.zip_name)
             )
             return
         return zip_name_match
@@ -66,10 +72,13 @@ class FileProcesser:
         if manga_series is not None:
             manga_series = manga_series.strip()
             if not self._uuid_regex.match(manga_series):
+                title = manga_series
                 try:
                     manga_series = self._names_to_ids["manga"].get(manga_series, None)
                 except KeyError:
                     manga_series = None
+                if manga_series is None:
+                    self.unresolved_names["manga"].append(title)
 
         if manga_series is None:
             logger.warning(f"No manga id found for {manga_series}.")
@@ -213,14 +222,16 @@ class FileProcesser:
                         group_id = None
                     if group_id is not None:
                         groups.append(group_id)
+                    else:
+                        self.unresolved_names["group"].append(group)
                 else:
                     groups.append(group)
 
         if not groups:
             groups = (
                 []
-                if not config["options"]["group_fallback_id"]
-                else [config["options"]["group_fallback_id"]]
+                if not context.config["options"]["group_fallback_id"]
+                else [context.config["options"]["group_fallback_id"]]
             )
         return groups
 
@@ -234,8 +245,9 @@ class FileProcesser:
         self.manga_series = self._get_manga_series()
 
         if self.manga_series is None:
-            logger.error(f"Couldn't find a manga id for {self.zip_name}, skipping.")
-            print(f"{translate_message['skip_no_manga_id']}".format(self.zip_name))
+            if self._report_missing:
+                logger.error(f"Couldn't find a manga id for {self.zip_name}, skipping.")
+                print(f"{context.translate_message['skip_no_manga_id']}".format(self.zip_name))
             return False
 
         self.language = self._get_language()
@@ -337,10 +349,13 @@ class FileProcesser:
             if manga_series is not None:
                 manga_series = manga_series.strip()
                 if not self._uuid_regex.match(manga_series):
+                    title = manga_series
                     try:
                         manga_series = self._names_to_ids["manga"].get(manga_series, None)
                     except KeyError:
                         manga_series = None
+                    if manga_series is None:
+                        self.unresolved_names["manga"].append(title)
 
             if manga_series is None:
                 logger.warning(f"No manga id found for {manga_series}.")
@@ -349,8 +364,9 @@ class FileProcesser:
         self.manga_series = get_manga(self._zip_name_match[1])
 
         if self.manga_series is None:
-            logger.error(f"Couldn't find a manga id for {self.zip_name}, skipping.")
-            print(f"{translate_message['skip_no_manga_id']}".format(self.zip_name))
+            if self._report_missing:
+                logger.error(f"Couldn't find a manga id for {self.zip_name}, skipping.")
+                print(f"{context.translate_message['skip_no_manga_id']}".format(self.zip_name))
             return False
         
         def group_get(group):
@@ -374,14 +390,16 @@ class FileProcesser:
                             group_id = None
                         if group_id is not None:
                             groups.append(group_id)
+                        else:
+                            self.unresolved_names["group"].append(group)
                     else:
                         groups.append(group)
 
             if not groups:
                 groups = (
                     []
-                    if not config["options"]["group_fallback_id"]
-                    else [config["options"]["group_fallback_id"]]
+                    if not context.config["options"]["group_fallback_id"]
+                    else [context.config["options"]["group_fallback_id"]]
                 )
             return groups
 
@@ -447,6 +465,19 @@ class FileProcesser:
         self.publish_date = publish_get(self._zip_name_match[6])
         return True
 
+    def get_metadata(self) -> "dict":
+        """Get the processed chapter data in a json serialisable format."""
+        return {
+            "manga_series": self.manga_series,
+            "language": self.language,
+            "chapter_number": self.chapter_number,
+            "volume_number": self.volume_number,
+            "chapter_title": self.chapter_title,
+            "groups": self.groups,
+            "publish_date": None if self.publish_date is None else self.publish_date.isoformat(),
+            "oneshot": self.oneshot,
+        }
+
     @property
     def zip_name_match(self):
         return self._zip_name_match
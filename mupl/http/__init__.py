@@ -1,3 +1,6 @@
+import re
+from urllib.parse import urlsplit
+
 http_error_codes = {
     "400": "Bad Request.",
     "401": "Unauthorised.",
@@ -10,6 +13,16 @@ http_error_codes = {
     "504": "Gateway Timeout.",
 }
 
+ROUTE_ID_REGEX = re.compile(
+    r"[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}"
+)
+
+
+def get_route_class(method: "str", route: "str") -> "str":
+    """Group requests by method and path, with the ids replaced, e.g. `POST /upload/{id}`."""
+    path = ROUTE_ID_REGEX.sub("{id}", urlsplit(route).path)
+    return f"{method.upper()} {path}"
+
 
 class RequestError(Exception):
     def __init__(self, message: str) -> None:
@@ -0,0 +1,223 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional
+
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+# Seconds of upload allowed at once above the rate, e.g. after an idle moment
+BURST_SECONDS = 0.25
+# Seconds between checks of the schedule for another limit
+SCHEDULE_CHECK_INTERVAL = 30
+# Seconds between checks of the control file for a new limit
+CONTROL_CHECK_INTERVAL = 2
+
+
+class TokenBucket:
+    """Byte rate limit shared by every upload.
+
+    Each read reserves the next free slot of the rate in the order it asked,
+    so concurrent uploads reading the same chunk size take turns and get an
+    equal share of the bandwidth."""
+
+    def __init__(self, rate: "Optional[float]" = None, burst: "float" = BURST_SECONDS) -> None:
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        # Time when the bytes reserved so far are sent at the rate
+        self._reserved_until = time.monotonic()
+
+    def set_rate(self, rate: "Optional[float]"):
+        """Bytes per second, None for no limit. Applies from the next read."""
+        with self._lock:
+            self.rate = rate or None
+            self._reserved_until = time.monotonic()
+
+    def consume(self, size: "int"):
+        """Wait until `size` bytes can be sent."""
+        with self._lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._reserved_until = max(self._reserved_until, now) + size / self.rate
+            delay = self._reserved_until - now - self.burst
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledBody:
+    """Request body read through a token bucket. The length is known up front,
+    so the body is still sent with a Content-Length instead of chunked."""
+
+    def __init__(self, data: "bytes", bucket: "TokenBucket") -> None:
+        self.data = data
+        self.bucket = bucket
+        self.position = 0
+
+    def __len__(self) -> "int":
+        return len(self.data)
+
+    def read(self, size: "int" = -1) -> "bytes":
+        if size is None or size < 0:
+            size = len(self.data) - self.position
+        chunk = self.data[self.position : self.position + size]
+        self.position += len(chunk)
+        if chunk:
+            self.bucket.consume(len(chunk))
+        return chunk
+
+    def tell(self) -> "int":
+        return self.position
+
+    def seek(self, offset: "int", whence: "int" = 0) -> "int":
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.data)
+        self.position = max(0, min(offset, len(self.data)))
+        return self.position
+
+
+class ScheduleEntry(NamedTuple):
+    # Minutes since midnight, the entry wraps past midnight when start > end
+    start: "int"
+    end: "int"
+    rate: "Optional[float]"
+
+    def matches(self, minute: "int") -> "bool":
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+def _parse_minute(value: "str") -> "int":
+    hours, _, minutes = str(value).partition(":")
+    return (int(hours) * 60 + int(minutes or 0)) % (24 * 60)
+
+
+def kb_to_rate(limit: "Optional[float]") -> "Optional[float]":
+    """Config limits are in KB/s, 0 is no limit."""
+    if not limit or limit <= 0:
+        return None
+    return limit * 1024
+
+
+def parse_schedule(entries: "Iterable[dict]") -> "List[ScheduleEntry]":
+    """Read the schedule entries of the config, e.g. {"start": "09:00", "end": "18:00", "limit": 5120}."""
+    schedule = []
+    for entry in entries or []:
+        try:
+            schedule.append(
+                ScheduleEntry(
+                    _parse_minute(entry["start"]),
+                    _parse_minute(entry["end"]),
+                    kb_to_rate(float(entry.get("limit") or 0)),
+                )
+            )
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.warning(f"Ignoring the bandwidth schedule entry {entry}: {e}")
+    return schedule
+
+
+class BandwidthShaper:
+    """Upload bandwidth limit, following a time of day schedule.
+
+    Outside the schedule entries the default limit applies. set_rate
+    overrides both until the limits are configured again.
+
+    The limit can also be changed through a control file, read again
+    whenever it changes, e.g. {"limit": 2048} in KB/s, 0 for no limit, or
+    {"limit": null} to go back to the configured limits. It works where
+    there is no SIGHUP, and is how the web ui changes the limit."""
+
+    def __init__(self) -> None:
+        self.bucket = TokenBucket()
+        self.default_rate: "Optional[float]" = None
+        self.schedule: "List[ScheduleEntry]" = []
+        self.override: "Optional[float]" = None
+        self._overridden = False
+        self._next_check = 0.0
+        self.control_path: "Optional[Path]" = None
+        self._control_mtime: "Optional[float]" = None
+        self._next_control_check = 0.0
+
+    def configure(self, limit: "Optional[float]", schedule: "Iterable[dict]" = ()):
+        """Set the default limit in KB/s and the schedule, 0 is no limit."""
+        self.default_rate = kb_to_rate(limit)
+        self.schedule = parse_schedule(schedule)
+        self._overridden = False
+        self._next_check = 0.0
+        # A limit set through the control file still applies
+        self._control_mtime = None
+        self._next_control_check = 0.0
+        self._update_rate()
+
+    def set_rate(self, rate: "Optional[float]"):
+        """Change the limit in bytes per second while uploading, None for no limit."""
+        self.override = rate or None
+        self._overridden = True
+        self.bucket.set_rate(self.override)
+        logger.info("Upload bandwidth limit set to %s bytes/s.", self.override)
+
+    def rate_at(self, when: "datetime") -> "Optional[float]":
+        minute = when.hour * 60 + when.minute
+        for entry in self.schedule:
+            if entry.matches(minute):
+                return entry.rate
+        return self.default_rate
+
+    def _read_control(self):
+        try:
+            mtime = self.control_path.stat().st_mtime
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+
+        try:
+            limit = json_codec.load_file(self.control_path).get("limit")
+            rate = None if limit is None else kb_to_rate(float(limit))
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"Ignoring the bandwidth control file {self.control_path}: {e}")
+            return
+
+        if limit is not None:
+            self.set_rate(rate)
+        elif self._overridden:
+            logger.info("Upload bandwidth limit set back to the config.")
+            self._overridden = False
+            self._next_check = 0.0
+
+    def _update_rate(self):
+        now = time.monotonic()
+        if self.control_path is not None and now >= self._next_control_check:
+            self._next_control_check = now + CONTROL_CHECK_INTERVAL
+            self._read_control()
+        if self._overridden or now < self._next_check:
+            return
+        self._next_check = now + SCHEDULE_CHECK_INTERVAL
+
+        rate = self.rate_at(datetime.now())
+        if rate != self.bucket.rate:
+            logger.info("Upload bandwidth limit changed to %s bytes/s.", rate)
+            self.bucket.set_rate(rate)
+
+    @property
+    def limited(self) -> "bool":
+        self._update_rate()
+        return self.bucket.rate is not None
+
+    def throttle(self, body):
+        """Wrap a request body to send it within the limit."""
+        if not isinstance(body, bytes) or not self.limited:
+            return body
+        return ThrottledBody(body, self.bucket)
+
+
+upload_bandwidth = BandwidthShaper()
@@ -0,0 +1,196 @@
+import collections
+import enum
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from mupl.http import RequestError
+
+logger = logging.getLogger("mupl")
+
+# Least requests in the window before the error rate can open a breaker
+MIN_REQUESTS = 5
+# Seconds of requests used for the error rate and the retry budget
+WINDOW_SECONDS = 60
+# The open time doubles after each failed probe, up to this many times the first
+MAX_OPEN_BACKOFF = 16
+# Retries always allowed per window, on top of the share of the requests
+MIN_RETRIES = 10
+
+
+class CircuitOpenError(RequestError):
+    """The request wasn't sent because the api route is failing."""
+
+
+class BreakerState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+def is_failure(status_code: "Optional[int]") -> "bool":
+    """Answers that mean the api can't take requests, None is a request without an answer."""
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+class CircuitBreaker:
+    """Stops sending requests to a route once too many of them fail.
+
+    While open, requests fail straight away. Once the open time is over, a
+    single request is let through as a probe: if it works the breaker closes,
+    otherwise it opens again for twice as long."""
+
+    def __init__(
+        self,
+        route_class: "str",
+        error_rate: "float",
+        open_time: "float",
+        min_requests: "int" = MIN_REQUESTS,
+        window: "float" = WINDOW_SECONDS,
+    ) -> None:
+        self.route_class = route_class
+        self.error_rate = error_rate
+        self.open_time = open_time
+        self.min_requests = min_requests
+        self.window = window
+        self.state = BreakerState.CLOSED
+        self.opened_until = 0.0
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque()
+        self._backoff = 1
+        self._probing = False
+
+    def allow(self) -> "bool":
+        """Whether a request may be sent now, the first one after the open time is the probe."""
+        with self._lock:
+            if self.state == BreakerState.CLOSED:
+                return True
+            if self.state == BreakerState.OPEN:
+                if time.monotonic() < self.opened_until:
+                    return False
+                self.state = BreakerState.HALF_OPEN
+            if self._probing:
+                return False
+            self._probing = True
+            logger.info("Probing %s.", self.route_class)
+            return True
+
+    def record(self, status_code: "Optional[int]"):
+        failed = is_failure(status_code)
+        now = time.monotonic()
+        with self._lock:
+            if self.state == BreakerState.HALF_OPEN and self._probing:
+                self._probing = False
+                if failed:
+                    self._backoff = min(self._backoff * 2, MAX_OPEN_BACKOFF)
+                    self._open(now)
+                else:
+                    logger.info("%s works again, closing its circuit breaker.", self.route_class)
+                    self.state = BreakerState.CLOSED
+                    self._backoff = 1
+                    self._outcomes.clear()
+                return
+
+            if self.state != BreakerState.CLOSED:
+                return
+
+            self._outcomes.append((now, failed))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+
+            if failed and len(self._outcomes) >= self.min_requests:
+                failures = sum(1 for _, x in self._outcomes if x)
+                if failures / len(self._outcomes) >= self.error_rate:
+                    self._open(now)
+
+    def _open(self, now: "float"):
+        open_time = self.open_time * self._backoff
+        self.state = BreakerState.OPEN
+        self.opened_until = now + open_time
+        logger.warning(
+            "Too many failed requests to %s, pausing it for %s seconds.",
+            self.route_class,
+            open_time,
+        )
+
+    def retry_after(self) -> "float":
+        """Seconds until a probe can be sent, 0 if requests can be sent."""
+        with self._lock:
+            if self.state != BreakerState.OPEN:
+                return 0.0
+            return max(self.opened_until - time.monotonic(), 0.0)
+
+
+class RetryBudget:
+    """Retries allowed across every route: a share of the requests sent in the
+    window plus a few, so an outage can't turn into a storm of retries."""
+
+    def __init__(self, ratio: "float", min_retries: "int" = MIN_RETRIES, window: "float" = WINDOW_SECONDS) -> None:
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._lock = threading.Lock()
+        self._requests = collections.deque()
+        self._retries = collections.deque()
+
+    def _expire(self, now: "float"):
+        for sent in (self._requests, self._retries):
+            while sent and sent[0] < now - self.window:
+                sent.popleft()
+
+    def record_request(self):
+        with self._lock:
+            self._requests.append(time.monotonic())
+
+    def try_retry(self) -> "bool":
+        """Take a retry from the budget, False if it is spent."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+                return False
+            self._retries.append(now)
+            return True
+
+
+class CircuitBreakers:
+    """Circuit breaker of each route class and the retry budget."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.breakers: "Dict[str, CircuitBreaker]" = {}
+        self.error_rate = 0.5
+        self.open_time = 60.0
+        self.retry_budget = RetryBudget(0.2)
+
+    def configure(self, error_rate: "int", open_time: "int", retry_budget: "int"):
+        """Error rate and retry budget in percent, open time in seconds."""
+        with self._lock:
+            self.error_rate = error_rate / 100
+            self.open_time = open_time
+            self.retry_budget = RetryBudget(retry_budget / 100)
+            self.breakers = {}
+
+    def get(self, route_class: "str") -> "CircuitBreaker":
+        with self._lock:
+            breaker = self.breakers.get(route_class)
+            if breaker is None:
+                breaker = self.breakers[route_class] = CircuitBreaker(
+                    route_class, self.error_rate, self.open_time
+                )
+            return breaker
+
+    def open_routes(self) -> "List[str]":
+        with self._lock:
+            breakers = list(self.breakers.values())
+        return [x.route_class for x in breakers if x.retry_after() > 0]
+
+    def retry_after(self) -> "float":
+        """Seconds until every open route can be probed."""
+        with self._lock:
+            breakers = list(self.breakers.values())
+        return max((x.retry_after() for x in breakers), default=0.0)
+
+
+circuit_breakers = CircuitBreakers()
@@ -0,0 +1,299 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+logger = logging.getLogger("mupl")
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Pool wait and new connections of the request running on this thread
+_connection_local = threading.local()
+
+
+class LatencyHistogram:
+    """Request latencies counted in fixed buckets, cheap enough to keep for every request."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: "tuple" = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # The last count is for the latencies over the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: "float"):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q: "float") -> "Optional[float]":
+        """Estimate of the quantile, interpolated within its bucket."""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    # No upper bound, the last bucket bound is the best estimate
+                    return self.buckets[-1]
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class RouteMetrics:
+    __slots__ = (
+        "latency",
+        "status_codes",
+        "request_bytes",
+        "response_bytes",
+        "rate_limited",
+        "retries",
+        "errors",
+        "ratelimit_sleep",
+        "pool_wait",
+        "connections_opened",
+    )
+
+    def __init__(self) -> None:
+        self.latency = LatencyHistogram()
+        self.status_codes: "Dict[int, int]" = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.errors = 0
+        self.ratelimit_sleep = 0.0
+        self.pool_wait = 0.0
+        self.connections_opened = 0
+
+    @property
+    def requests(self) -> "int":
+        return self.latency.count
+
+
+class HTTPMetrics:
+    """Per route class metrics of the api requests.
+
+    Shows whether the api (latency, 429s), the link (bytes and latency of the
+    uploads) or the uploader's own throttling (rate limit sleeps, waiting for a
+    pooled connection) limits the upload."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.routes: "Dict[str, RouteMetrics]" = {}
+        self.prometheus_path: "Optional[Path]" = None
+
+    def _route(self, route_class: "str") -> "RouteMetrics":
+        route = self.routes.get(route_class)
+        if route is None:
+            route = self.routes[route_class] = RouteMetrics()
+        return route
+
+    def record_request(
+        self,
+        route_class: "str",
+        status_code: "int",
+        seconds: "float",
+        request_bytes: "int",
+        response_bytes: "int",
+    ):
+        pool_wait, connections_opened = take_connection_stats()
+        with self._lock:
+            route = self._route(route_class)
+            route.latency.observe(seconds)
+            route.status_codes[status_code] = route.status_codes.get(status_code, 0) + 1
+            route.request_bytes += request_bytes
+            route.response_bytes += response_bytes
+            route.pool_wait += pool_wait
+            route.connections_opened += connections_opened
+            if status_code == 429:
+                route.rate_limited += 1
+
+    def record_error(self, route_class: "str"):
+        """A request that failed without a response."""
+        take_connection_stats()
+        with self._lock:
+            self._route(route_class).errors += 1
+
+    def record_retry(self, route_class: "str"):
+        with self._lock:
+            self._route(route_class).retries += 1
+
+    def record_sleep(self, route_class: "str", seconds: "float"):
+        with self._lock:
+            self._route(route_class).ratelimit_sleep += seconds
+
+    def summary(self) -> "List[dict]":
+        """Routes sorted by their number of requests."""
+        with self._lock:
+            routes = list(self.routes.items())
+
+        return [
+            {
+                "route": route_class,
+                "requests": route.requests,
+                "p50": route.latency.quantile(0.5),
+                "p95": route.latency.quantile(0.95),
+                "p99": route.latency.quantile(0.99),
+                "request_bytes": route.request_bytes,
+                "response_bytes": route.response_bytes,
+                "status_codes": dict(route.status_codes),
+                "rate_limited": route.rate_limited,
+                "retries": route.retries,
+                "errors": route.errors,
+                "ratelimit_sleep": route.ratelimit_sleep,
+                "pool_wait": route.pool_wait,
+                "connections_opened": route.connections_opened,
+            }
+            for route_class, route in sorted(
+                routes, key=lambda x: x[1].requests, reverse=True
+            )
+        ]
+
+    def to_prometheus(self) -> "str":
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            routes = [
+                (_escape_label(route_class), route)
+                for route_class, route in sorted(self.routes.items())
+            ]
+
+        lines = []
+
+        def add_metric(name: "str", metric_type: "str", help_text: "str", samples: "list"):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        latency_samples = []
+        for route_class, route in routes:
+            cumulative = 0
+            for bucket, bucket_count in zip(route.latency.buckets, route.latency.counts):
+                cumulative += bucket_count
+                latency_samples.append(
+                    (f'route="{route_class}",le="{bucket}"', cumulative)
+                )
+            latency_samples.append(
+                (f'route="{route_class}",le="+Inf"', route.latency.count)
+            )
+        lines.append("# HELP mupl_http_request_duration_seconds Latency of the api requests.")
+        lines.append("# TYPE mupl_http_request_duration_seconds histogram")
+        for labels, value in latency_samples:
+            lines.append(f"mupl_http_request_duration_seconds_bucket{{{labels}}} {value}")
+        for route_class, route in routes:
+            lines.append(
+                f'mupl_http_request_duration_seconds_sum{{route="{route_class}"}} {route.latency.sum}'
+            )
+            lines.append(
+                f'mupl_http_request_duration_seconds_count{{route="{route_class}"}} {route.latency.count}'
+            )
+
+        add_metric(
+            "mupl_http_requests_total",
+            "counter",
+            "Api requests by status code.",
+            [
+                (f'route="{route_class}",code="{status_code}"', count)
+                for route_class, route in routes
+                for status_code, count in sorted(route.status_codes.items())
+            ],
+        )
+        counters = (
+            ("mupl_http_request_bytes_total", "request_bytes", "Bytes of the request bodies sent."),
+            ("mupl_http_response_bytes_total", "response_bytes", "Bytes of the response bodies received."),
+            ("mupl_http_rate_limited_total", "rate_limited", "Requests answered with 429."),
+            ("mupl_http_retries_total", "retries", "Requests sent again."),
+            ("mupl_http_errors_total", "errors", "Requests that failed without a response."),
+            ("mupl_http_ratelimit_sleep_seconds_total", "ratelimit_sleep", "Time slept on the rate limits."),
+            ("mupl_http_pool_wait_seconds_total", "pool_wait", "Time waited for a pooled connection."),
+            ("mupl_http_connections_opened_total", "connections_opened", "New connections opened."),
+        )
+        for name, field, help_text in counters:
+            add_metric(
+                name,
+                "counter",
+                help_text,
+                [(f'route="{route_class}"', getattr(route, field)) for route_class, route in routes],
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        """Write the Prometheus text file, e.g. for the node exporter textfile collector."""
+        if self.prometheus_path is None:
+            return
+
+        temp_path = self.prometheus_path.with_name(f"{self.prometheus_path.name}.tmp")
+        try:
+            temp_path.write_text(self.to_prometheus(), encoding="utf-8")
+            # Collectors must never read a half written file
+            os.replace(temp_path, self.prometheus_path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the http metrics: {e}")
+
+
+def _escape_label(value: "str") -> "str":
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def take_connection_stats() -> "tuple":
+    """Pool wait and new connections of the last request on this thread."""
+    pool_wait = getattr(_connection_local, "pool_wait", 0.0)
+    connections_opened = getattr(_connection_local, "connections_opened", 0)
+    _connection_local.pool_wait = 0.0
+    _connection_local.connections_opened = 0
+    return pool_wait, connections_opened
+
+
+class _MeasuredPoolMixin:
+    def _get_conn(self, timeout=None):
+        start = time.perf_counter()
+        try:
+            return super()._get_conn(timeout)
+        finally:
+            _connection_local.pool_wait = getattr(
+                _connection_local, "pool_wait", 0.0
+            ) + (time.perf_counter() - start)
+
+    def _new_conn(self):
+        _connection_local.connections_opened = (
+            getattr(_connection_local, "connections_opened", 0) + 1
+        )
+        return super()._new_conn()
+
+
+class MeasuredHTTPConnectionPool(_MeasuredPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class MeasuredHTTPSConnectionPool(_MeasuredPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class MeasuredHTTPAdapter(HTTPAdapter):
+    """Adapter that measures the time requests wait for a pooled connection."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": MeasuredHTTPConnectionPool,
+            "https": MeasuredHTTPSConnectionPool,
+        }
+
+
+http_metrics = HTTPMetrics()
@@ -2,14 +2,20 @@ import json
 import logging
 import time
 from datetime import datetime
+from typing import Optional
 
 import requests
 
 from mupl import __version__
-from mupl.http import RequestError, http_error_codes
+from mupl.http import RequestError, get_route_class, http_error_codes
+from mupl.http.bandwidth import upload_bandwidth
+from mupl.http.breaker import CircuitOpenError, circuit_breakers
+from mupl.http.metrics import MeasuredHTTPAdapter, http_metrics
 from mupl.http.response import HTTPResponse
 from mupl.http.oauth import OAuth2
-from mupl.utils.config import UPLOAD_RETRY, config, mangadex_api_url, root_path, translate_message
+from mupl.http.stats import UploadStats
+from mupl.utils.config import context
+from mupl.utils.logs import SAMPLED
 
 
 logger = logging.getLogger("mupl")
@@ -19,17 +25,28 @@ class HTTPModel:
     def __init__(self) -> None:
         self.session = requests.Session()
         self.session.headers.update({"User-Agent": f"mupl/{__version__}"})
+        self.session.mount("https://", MeasuredHTTPAdapter())
+        self.session.mount("http://", MeasuredHTTPAdapter())
 
-        self.upload_retry_total = UPLOAD_RETRY
+        self.upload_retry_total = context.upload_retry
         self.max_requests = 5
         self.number_of_requests = 0
         self.total_requests = 0
         self.total_not_login_row = 0
+        self.upload_stats = UploadStats(context.upload_stats_path)
+        upload_bandwidth.configure(
+            context.upload_bandwidth_limit, context.upload_bandwidth_schedule
+        )
+        circuit_breakers.configure(
+            context.circuit_breaker_error_rate,
+            context.circuit_breaker_open_time,
+            context.retry_budget_percent,
+        )
 
-        self._config = config
-        self._token_file = root_path.joinpath(config["paths"]["mdauth_path"])
+        self._config = context.config
+        self._token_file = context.root_path.joinpath(context.config["paths"]["mdauth_path"])
         self._file_token = self._open_auth_file()
-        self._md_auth_api_url = f"{mangadex_api_url}/auth"
+        self._md_auth_api_url = f"{context.mangadex_api_url}/auth"
 
         self.oauth = OAuth2(
             self._config["credentials"],
@@ -50,7 +67,11 @@ class HTTPModel:
         return self.oauth.refresh_token
 
     def _calculate_sleep_time(
-        self, status_code: "int", wait: "bool", headers: "dict"
+        self,
+        status_code: "int",
+        wait: "bool",
+        headers: "dict",
+        route_class: "Optional[str]" = None,
     ) -> "bool":
         self.number_of_requests += 1
         self.total_requests += 1
@@ -64,10 +85,14 @@ class HTTPModel:
         )
         retry_after = headers.get("x-ratelimit-retry-after", None)
 
-        logger.debug(f"limit: {limit}")
-        logger.debug(f"remaining: {remaining}")
-        logger.debug(f"retry_after: {retry_after}")
-        logger.debug(f"number_of_requests: {self.number_of_requests}")
+        logger.debug(
+            "limit: %s, remaining: %s, retry_after: %s, number_of_requests: %s",
+            limit,
+            remaining,
+            retry_after,
+            self.number_of_requests,
+            extra=SAMPLED,
+        )
 
         delta = self.max_requests
         sleep = delta / limit
@@ -92,31 +117,28 @@ class HTTPModel:
             else:
                 sleep = delta / remaining
 
-        logger.debug("delta is: %s", delta)
+        logger.debug("delta is: %s", delta, extra=SAMPLED)
 
         if remaining <= 0 or retry_after is not None or status_code == 429:
             if not wait and status_code != 429 and remaining > 0:
                 return loop
 
             self.number_of_requests = 0
-            logger.debug(f"Sleeping {sleep} seconds")
+            logger.debug("Sleeping %s seconds", sleep)
+            if route_class is not None:
+                http_metrics.record_sleep(route_class, sleep)
             time.sleep(sleep)
 
             if remaining == 0 and status_code != 429:
                 loop = False
         return loop
 
-    def _format_request_log(
-        self,
-        method: "str",
-        route: "str",
-        params: "dict" = None,
-        json: "dict" = None,
-        data=None,
-        files=None,
-        successful_codes: "list" = None,
-    ) -> "str":
-        return f'"{method}": {route} {successful_codes=} {params=} {json=} {data=}'
+    def _send_throttled(self, method: "str", route: "str", **kwargs) -> "requests.Response":
+        """Send the request with its body read within the upload bandwidth limit."""
+        prepared = self.session.prepare_request(requests.Request(method, route, **kwargs))
+        prepared.body = upload_bandwidth.throttle(prepared.body)
+        settings = self.session.merge_environment_settings(prepared.url, {}, None, None, None)
+        return self.session.send(prepared, **settings)
 
     def _request(
         self,
@@ -137,33 +159,70 @@ class HTTPModel:
         run_number = 0
         tries = kwargs.get("tries", self.upload_retry_total)
         sleep = kwargs.get("sleep", True)
-
-        formatted_request_string = self._format_request_log(
-            method=method,
-            route=route,
-            params=params,
-            json=json,
-            data=data,
-            files=files,
-            successful_codes=successful_codes,
+        throttled = kwargs.get("throttled", False)
+        route_class = get_route_class(method, route)
+        breaker = circuit_breakers.get(route_class)
+
+        # Formatted on the logging thread, only for the sampled requests
+        logger.debug(
+            '"%s": %s successful_codes=%s params=%s json=%s data=%s',
+            method,
+            route,
+            successful_codes,
+            params,
+            json,
+            data,
+            extra=SAMPLED,
         )
 
-        logger.info(formatted_request_string)
-
         while retry > 0:
+            if run_number > 0 and not circuit_breakers.retry_budget.try_retry():
+                logger.warning("Retry budget spent, not sending %s again.", route_class)
+                break
+            if not breaker.allow():
+                raise CircuitOpenError(
+                    f"Not sending {route_class}, too many of its requests failed."
+                )
+
             try:
                 run_number += 1
-
-                response = self.session.request(
-                    method, route, json=json, params=params, data=data, files=files
+                if run_number > 1:
+                    http_metrics.record_retry(route_class)
+                circuit_breakers.retry_budget.record_request()
+
+                request_start = time.perf_counter()
+                if throttled and upload_bandwidth.limited:
+                    response = self._send_throttled(
+                        method, route, json=json, params=params, data=data, files=files
+                    )
+                else:
+                    response = self.session.request(
+                        method, route, json=json, params=params, data=data, files=files
+                    )
+                request_seconds = time.perf_counter() - request_start
+                breaker.record(response.status_code)
+                self.upload_stats.record_request(
+                    route_class,
+                    request_seconds,
+                    response.headers.get("x-ratelimit-limit"),
+                )
+                http_metrics.record_request(
+                    route_class,
+                    response.status_code,
+                    request_seconds,
+                    len(response.request.body or b""),
+                    len(response.content),
                 )
                 logger.debug(
-                    f"Initial Request: Code {response.status_code}, URL: {response.url}"
+                    "Initial Request: Code %s, URL: %s",
+                    response.status_code,
+                    response.url,
+                    extra=SAMPLED,
                 )
                 response_obj = HTTPResponse(response, successful_codes)
 
                 if response.status_code == 401:
-                    print(translate_message['error_conenction'])
+                    print(context.translate_message['error_conenction'])
                     self.total_not_login_row += 1
                     if self.total_not_login_row >= self.upload_retry_total:
                         return response_obj
@@ -174,6 +233,7 @@ class HTTPModel:
                     status_code=response.status_code,
                     headers=response.headers,
                     wait=sleep,
+                    route_class=route_class,
                 )
 
                 retry -= 1
@@ -181,7 +241,11 @@ class HTTPModel:
                 if loop:
                     continue
             except requests.RequestException as e:
+                breaker.record(None)
+                http_metrics.record_error(route_class)
                 logger.error(e)
+                retry -= 1
+                total_retry -= 1
                 continue
 
             if (successful_codes and response.status_code not in successful_codes) or (
@@ -213,6 +277,7 @@ class HTTPModel:
             elif response.status_code == 429:
                 response_obj.print_error()
                 print(f"429: {http_error_codes.get('429')}")
+                http_metrics.record_sleep(route_class, 90)
                 time.sleep(90)
 
                 if total_retry <= 0:
@@ -229,7 +294,7 @@ class HTTPModel:
                 )
                 continue
 
-        raise RequestError(formatted_request_string)
+        raise RequestError(f'"{method}": {route} failed after {run_number} tries.')
 
     def _login(self) -> "bool":
         if self._first_login:
@@ -249,7 +314,7 @@ class HTTPModel:
 
             if self._first_login:
                 logger.info(f"Logged into mangadex.")
-                print(translate_message['error_success'])
+                print(context.translate_message['error_success'])
                 self._first_login = False
             return True
         else:
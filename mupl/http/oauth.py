@@ -5,7 +5,9 @@ import time
 from configparser import SectionProxy
 from typing import Optional, TYPE_CHECKING
 
-from mupl.utils.config import mangadex_auth_url
+from mupl.http import RequestError
+from mupl.http.breaker import is_failure
+from mupl.utils.config import context
 
 logger = logging.getLogger("mupl")
 
@@ -22,7 +24,7 @@ class OAuth2:
         refresh_token: "Optional[str]" = None,
     ):
         self.__client: "HTTPClient" = client
-        self.token_url = f"{mangadex_auth_url}/token"
+        self.token_url = f"{context.mangadex_auth_url}/token"
 
         self.__username: "str" = credential_config.get("mangadex_username")
         self.__password: "str" = credential_config.get("mangadex_password")
@@ -69,6 +71,11 @@ class OAuth2:
         if token_response.status_code == 200 and token_response.data is not None:
             self.__update_token(token_response.data)
             return True
+        elif is_failure(token_response.status_code):
+            # The api is down, the login details may still be right
+            raise RequestError(
+                f"Couldn't reach the login api: {token_response.status_code}."
+            )
 
         logger.error(f"Couldn't login to mangadex using the details provided.")
         return False
@@ -90,6 +97,10 @@ class OAuth2:
         if token_response.status_code == 200 and token_response.data is not None:
             self.__update_token(token_response.data)
             return True
+        elif is_failure(token_response.status_code):
+            raise RequestError(
+                f"Couldn't reach the login api: {token_response.status_code}."
+            )
         elif token_response.status_code in (401, 403):
             logger.warning(
                 f"Couldn't login using refresh token, logging in using your account."
@@ -1,4 +1,3 @@
-import json
 import logging
 from copy import copy
 from typing import Optional
@@ -6,9 +5,14 @@ from typing import Optional
 import requests
 
 from mupl.http import http_error_codes
+from mupl.utils import json_codec
+from mupl.utils.logs import SAMPLED
 
 logger = logging.getLogger("mupl")
 
+# Marks a body that wasn't decoded yet, None is a valid result
+_NOT_DECODED = object()
+
 
 class HTTPResponse:
     def __init__(
@@ -22,7 +26,18 @@ class HTTPResponse:
         successful_codes.extend(range(200, 300))
         self.successful_codes = successful_codes
         self.response = response
-        self.data = self.json()
+        self._data = _NOT_DECODED
+
+        logger.debug(
+            "Request id: %s", self.response.headers.get("x-request-id"), extra=SAMPLED
+        )
+
+    @property
+    def data(self) -> "Optional[dict]":
+        """The decoded body, decoded the first time it is used."""
+        if self._data is _NOT_DECODED:
+            self._data = self.json()
+        return self._data
 
     @property
     def status_code(self) -> "int":
@@ -42,37 +57,21 @@ class HTTPResponse:
 
     def json(self) -> "Optional[dict]":
         """Convert the api response into a parsable json."""
-        critical_decode_error_message = (
-            "{}: Couldn't convert mangadex API response into a JSON.".format(
-                self.status_code
-            )
-        )
-
-        logger.info(f"Request id: {self.response.headers.get('x-request-id', None)}")
-
         if self.response.status_code == 204:
             return
 
         try:
-            converted_response = self.response.json()
-            return converted_response
-        except json.JSONDecodeError:
+            return json_codec.loads(self.response.content)
+        except json_codec.JSONDecodeError:
+            critical_decode_error_message = (
+                "{}: Couldn't convert mangadex API response into a JSON.".format(
+                    self.status_code
+                )
+            )
             logger.critical(critical_decode_error_message)
             logger.error(self.response.content)
             print(critical_decode_error_message)
             return
-        except AttributeError:
-            logger.critical(
-                f"Api response doesn't have load as json method, trying to load as json manually."
-            )
-            try:
-                converted_response = json.loads(self.response.content)
-                return converted_response
-            except json.JSONDecodeError:
-                logger.critical(critical_decode_error_message)
-                logger.error(self.response.content)
-                print(critical_decode_error_message)
-                return
 
     def print_error(
         self,
@@ -84,7 +83,7 @@ class HTTPResponse:
             return None
 
         error_message = f"Error: {self.status_code}"
-        error_json = self.json()
+        error_json = self.data
 
         if error_json is not None:
             # Api response doesn't follow the normal api error format
@@ -0,0 +1,87 @@
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+# Used until the values are learned from the api
+DEFAULT_REQUEST_SECONDS = 1.0
+DEFAULT_BYTES_PER_SECOND = 1024 * 1024
+# Window of the x-ratelimit-limit header in seconds
+RATELIMIT_WINDOW = 60
+
+
+class UploadStats:
+    """Request latency, rate limits and upload throughput learned from previous runs.
+    Values are kept as exponential moving averages and saved between runs."""
+
+    smoothing = 0.2
+
+    def __init__(self, stats_path: "Path") -> None:
+        self.stats_path = stats_path
+        self._lock = threading.Lock()
+        self.routes: "dict" = {}
+        self.bytes_per_second: "Optional[float]" = None
+
+        try:
+            stats = json_codec.load_file(self.stats_path)
+            self.routes = stats.get("routes", {})
+            self.bytes_per_second = stats.get("bytes_per_second")
+        except (FileNotFoundError, json_codec.JSONDecodeError, AttributeError):
+            pass
+
+    def _average(self, previous: "Optional[float]", value: "float") -> "float":
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    def record_request(
+        self, route_class: "str", seconds: "float", limit: "Optional[str]" = None
+    ):
+        with self._lock:
+            route = self.routes.setdefault(route_class, {})
+            route["latency"] = self._average(route.get("latency"), seconds)
+            if limit is not None:
+                try:
+                    route["limit"] = int(limit)
+                except ValueError:
+                    pass
+
+    def record_upload(self, size: "int", seconds: "float"):
+        if seconds <= 0 or size <= 0:
+            return
+        with self._lock:
+            self.bytes_per_second = self._average(self.bytes_per_second, size / seconds)
+
+    def latency(self, route_class: "str") -> "float":
+        return self.routes.get(route_class, {}).get("latency", DEFAULT_REQUEST_SECONDS)
+
+    def min_interval(self, route_class: "str") -> "float":
+        """Least time between requests to the route allowed by its rate limit."""
+        limit = self.routes.get(route_class, {}).get("limit")
+        if not limit:
+            return 0
+        return RATELIMIT_WINDOW / limit
+
+    def request_seconds(self, route_class: "str", requests: "int" = 1) -> "float":
+        return requests * max(self.latency(route_class), self.min_interval(route_class))
+
+    def upload_seconds(self, size: "int") -> "float":
+        return size / (self.bytes_per_second or DEFAULT_BYTES_PER_SECOND)
+
+    @property
+    def learned(self) -> "bool":
+        return self.bytes_per_second is not None
+
+    def save(self):
+        with self._lock:
+            stats = {"routes": self.routes, "bytes_per_second": self.bytes_per_second}
+        try:
+            with open(self.stats_path, "w", encoding="utf-8") as stats_file:
+                json.dump(stats, stats_file, indent=4)
+        except OSError as e:
+            logger.warning(f"Couldn't save the upload stats: {e}")
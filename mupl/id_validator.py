@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from mupl.file_validator import FileProcesser
+from mupl.http import RequestError
+from mupl.http.client import HTTPClient
+from mupl.utils import json_codec
+from mupl.utils.config import context
+
+logger = logging.getLogger("mupl")
+
+# Most ids the list routes of the api return in one request
+IDS_PER_REQUEST = 100
+# The manga list leaves out some content ratings unless asked for them
+CONTENT_RATINGS = ("safe", "suggestive", "erotica", "pornographic")
+# Api list route of each kind of id
+ID_ROUTES = {"manga": "manga", "group": "group"}
+
+
+class IdCache:
+    """Ids found on the api and when they were checked, saved between runs.
+
+    Only ids that exist are kept, so a title or group created after a run
+    is found on the next one."""
+
+    def __init__(self, cache_path: "Path", ttl: "float") -> None:
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.ids: "Dict[str, Dict[str, float]]" = {kind: {} for kind in ID_ROUTES}
+
+        try:
+            cache = json_codec.load_file(self.cache_path)
+            for kind in ID_ROUTES:
+                self.ids[kind] = dict(cache.get(kind, {}))
+        except (FileNotFoundError, json_codec.JSONDecodeError, AttributeError, TypeError):
+            pass
+
+    def known(self, kind: "str", entity_id: "str") -> "bool":
+        """Whether the id was found on the api within the ttl."""
+        checked = self.ids[kind].get(entity_id)
+        return checked is not None and time.time() - checked < self.ttl
+
+    def add(self, kind: "str", entity_ids: "Iterable[str]"):
+        now = time.time()
+        with self._lock:
+            for entity_id in entity_ids:
+                self.ids[kind][entity_id] = now
+
+    def save(self):
+        now = time.time()
+        with self._lock:
+            cache = {
+                kind: {x: checked for x, checked in ids.items() if now - checked < self.ttl}
+                for kind, ids in self.ids.items()
+            }
+        temp_path = self.cache_path.with_name(f"{self.cache_path.name}.tmp")
+        try:
+            temp_path.write_text(json_codec.dumps(cache), encoding="utf-8")
+            # An interrupted save leaves the previous cache instead of a truncated one
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the id cache: {e}")
+
+
+class IdValidator:
+    """Checks that the manga and group ids of the chapters exist before any
+    upload session is created, asking the api for up to 100 ids at once."""
+
+    def __init__(self, http_client: "HTTPClient", cache: "Optional[IdCache]" = None) -> None:
+        self.http_client = http_client
+        self.cache = cache or IdCache(context.id_cache_path, context.id_cache_ttl)
+
+    def _fetch_existing(self, kind: "str", entity_ids: "List[str]") -> "Optional[Set[str]]":
+        """Ids of the list found on the api, None if they couldn't be checked."""
+        params = {"ids[]": entity_ids, "limit": IDS_PER_REQUEST}
+        if kind == "manga":
+            params["contentRating[]"] = list(CONTENT_RATINGS)
+
+        try:
+            response = self.http_client.get(
+                f"{context.mangadex_api_url}/{ID_ROUTES[kind]}", params=params
+            )
+        except RequestError as e:
+            logger.error(e)
+            return None
+
+        if not response.ok or response.data is None:
+            return None
+
+        try:
+            return {entity["id"].lower() for entity in response.data["data"]}
+        except (KeyError, TypeError, AttributeError):
+            logger.warning(f"Unexpected {kind} list response: {response.data}")
+            return None
+
+    def missing_ids(self, kind: "str", entity_ids: "Iterable[str]") -> "Set[str]":
+        """Ids of the kind not found on the api. Ids that couldn't be checked are
+        assumed to exist, the upload session reports them if they don't."""
+        to_check = sorted({x for x in entity_ids if not self.cache.known(kind, x)})
+        missing = set()
+        for index in range(0, len(to_check), IDS_PER_REQUEST):
+            batch = to_check[index : index + IDS_PER_REQUEST]
+            existing = self._fetch_existing(kind, batch)
+            if existing is None:
+                logger.warning(f"Couldn't check {len(batch)} {kind} ids, uploading without checking them.")
+                continue
+
+            self.cache.add(kind, existing)
+            missing.update(x for x in batch if x not in existing)
+        return missing
+
+    def validate(
+        self, zips_to_upload: "List[FileProcesser]"
+    ) -> "Tuple[List[FileProcesser], List[Tuple[FileProcesser, str]]]":
+        """Split the chapters into the valid ones and the rejected ones with the reason."""
+        manga_ids = {x.manga_series.lower() for x in zips_to_upload if x.manga_series}
+        group_ids = {g.lower() for x in zips_to_upload for g in (x.groups or [])}
+
+        missing_manga = self.missing_ids("manga", manga_ids)
+        missing_groups = self.missing_ids("group", group_ids)
+        self.cache.save()
+
+        valid, rejected = [], []
+        for file_name_obj in zips_to_upload:
+            reasons = []
+            if file_name_obj.manga_series and file_name_obj.manga_series.lower() in missing_manga:
+                reasons.append(f"Unknown manga id {file_name_obj.manga_series}.")
+            unknown_groups = [g for g in (file_name_obj.groups or []) if g.lower() in missing_groups]
+            if unknown_groups:
+                reasons.append(f"Unknown group ids {', '.join(unknown_groups)}.")
+
+            if reasons:
+                rejected.append((file_name_obj, " ".join(reasons)))
+            else:
+                valid.append(file_name_obj)
+
+        if rejected:
+            logger.warning(f"Rejected {len(rejected)} chapters with unknown ids.")
+        return valid, rejected
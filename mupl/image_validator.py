@@ -4,16 +4,20 @@ import logging
 import string
 import zipfile
 from pathlib import Path
-from typing import List, Dict, Union, Literal, Optional
+from typing import List, Dict, Union, Literal, Optional, Tuple
 
-import natsort
-from PIL import Image, ImageSequence
 
 from mupl.file_validator import FileProcesser
-from mupl.utils.config import NUMBER_OF_IMAGES_UPLOAD
+from mupl.utils.config import context
+from mupl.utils.events import EventType, emit
+from mupl.utils.memory import Reservation, memory_budget
+from mupl.utils.tracing import span
 
 logger = logging.getLogger("mupl")
 
+# Bytes needed to detect the format of an image
+IMAGE_HEADER_SIZE = 16
+
 
 class Format(enum.Enum):
     PNG = 0
@@ -57,6 +61,8 @@ class ImageProcessorBase:
 
     @staticmethod
     def get_new_format_for_webp(image_bytes: "bytes") -> "str":
+        from PIL import Image, ImageSequence
+
         with Image.open(io.BytesIO(image_bytes)) as image:
             # If it has more then 1 frame it's animated so convert to GIF
             try:
@@ -72,6 +78,41 @@ class ImageProcessorBase:
             # Otherwise, convert to JPEG
             return "JPEG"
 
+    @staticmethod
+    def get_page_manifest(
+        to_upload: "Path", myzip: "Optional[zipfile.ZipFile]" = None
+    ) -> "List[Tuple[str, int]]":
+        """Get the name and size of each valid image of a chapter file or folder, natural sorted.
+        Only the first bytes of each file are read to check the image format."""
+        pages = []
+        if to_upload.is_dir():
+            for image in to_upload.iterdir():
+                if not image.is_file():
+                    continue
+                with open(image, "rb") as image_file:
+                    image_header = image_file.read(IMAGE_HEADER_SIZE)
+                if ImageProcessorBase.get_image_format(image_header) is not None:
+                    pages.append((image.name, image.stat().st_size))
+        else:
+            close_zip = myzip is None
+            if close_zip:
+                myzip = zipfile.ZipFile(to_upload)
+            try:
+                for image in myzip.infolist():
+                    if image.is_dir():
+                        continue
+                    with myzip.open(image) as image_file:
+                        image_header = image_file.read(IMAGE_HEADER_SIZE)
+                    if ImageProcessorBase.get_image_format(image_header) is not None:
+                        pages.append((image.filename, image.file_size))
+            finally:
+                if close_zip:
+                    myzip.close()
+
+        import natsort
+
+        return natsort.natsorted(pages, key=lambda x: ImageProcessorBase.key(x[0]))
+
 
 class ImageProcessor:
     def __init__(self, file_name_obj: "FileProcesser", folder_upload: "bool") -> None:
@@ -88,76 +129,103 @@ class ImageProcessor:
         # Renamed file to original file name
         self.images_to_upload_names: "Dict[str, str]" = {}
         self.converted_images: "Dict[str, str]" = {}
+        # Original file name to file size
+        self.page_sizes: "Dict[str, int]" = {}
 
-        self.images_upload_session = NUMBER_OF_IMAGES_UPLOAD
+        self.images_upload_session = context.number_of_images_upload
 
         self.info_list = self._get_valid_images()
 
-    def _is_image_valid(self, image: "str") -> "bool":
-        return (
-            ImageProcessorBase.get_image_format(self._read_image_data(image))
-            is not None
-        )
-
     def _read_image_data(self, image: "str") -> "bytes":
         """Read the image data from the zip or from the folder."""
-        if self.folder_upload:
-            image_path = self.to_upload.joinpath(image)
-            return image_path.read_bytes()
-        else:
-            with self.myzip.open(image) as myfile:
-                return myfile.read()
+        with span("page_read", chapter=self.to_upload.name, page=image):
+            if self.folder_upload:
+                image_path = self.to_upload.joinpath(image)
+                return image_path.read_bytes()
+            else:
+                with self.myzip.open(image) as myfile:
+                    return myfile.read()
 
     def _read_zip(self) -> "zipfile.ZipFile":
         """Open zip file in read only mode."""
-        return zipfile.ZipFile(self.to_upload)
+        with span("zip_open", chapter=self.to_upload.name):
+            return zipfile.ZipFile(self.to_upload)
 
     def _get_bytes_for_upload(self, image: "str") -> "bytes":
-        image_bytes = self._read_image_data(image)
-        current_format = ImageProcessorBase.get_image_format(image_bytes)
-        new_format = None
-        if current_format == Format.WEBP:
-            new_format = ImageProcessorBase.get_new_format_for_webp(image_bytes)
-
-        if not new_format:
-            return image_bytes
-
-        self.converted_images.update({image: new_format})
-        logger.info(f"Converted {image} into {new_format}")
-        with Image.open(io.BytesIO(image_bytes)) as image:
-            output = io.BytesIO()
-            image.save(output, new_format)
-            return output.getvalue()
+        # Counted on top of the batch, which only waits for room before it is read
+        with memory_budget.reserve("read", self.page_sizes.get(image, 0), wait=False):
+            image_bytes = self._read_image_data(image)
+            with span("sniff", chapter=self.to_upload.name, page=image):
+                current_format = ImageProcessorBase.get_image_format(image_bytes)
+                new_format = None
+                if current_format == Format.WEBP:
+                    new_format = ImageProcessorBase.get_new_format_for_webp(image_bytes)
+
+            if not new_format:
+                return image_bytes
+
+            self.converted_images.update({image: new_format})
+            emit(EventType.PAGE_CONVERTED, str(self.to_upload), page=image, detail=new_format)
+            logger.info("Converted %s into %s", image, new_format)
+            from PIL import Image
+
+            with span("convert", chapter=self.to_upload.name, page=image, format=new_format):
+                with Image.open(io.BytesIO(image_bytes)) as image:
+                    output = io.BytesIO()
+                    image.save(output, new_format)
+                    with memory_budget.reserve("convert", output.tell(), wait=False):
+                        return output.getvalue()
 
     def _get_valid_images(self):
         """Validate the files in the archive.
         Check if all the files are images.
-        Sorts the images using natural sort."""
-        if self.folder_upload:
-            to_iter = [x.name for x in self.to_upload.iterdir()]
-        else:
-            to_iter = [x.filename for x in self.myzip.infolist()]
+        Sorts the images using natural sort.
+        Uses the page manifest from the scan index if the chapter didn't change."""
+        page_manifest = self.file_name_obj.page_manifest
+        if page_manifest is None:
+            page_manifest = ImageProcessorBase.get_page_manifest(
+                self.to_upload, self.myzip
+            )
 
-        info_list = [image for image in to_iter if self._is_image_valid(image)]
-        info_list_images_only = natsort.natsorted(info_list, key=ImageProcessorBase.key)
+        self.page_sizes = dict(page_manifest)
+        info_list_images_only = [image for image, _ in page_manifest]
 
         self.valid_images_to_upload = [
             info_list_images_only[l : l + self.images_upload_session]
             for l in range(0, len(info_list_images_only), self.images_upload_session)
         ]
-        logger.debug(f"Images to upload: {self.valid_images_to_upload}")
+        logger.debug("Images to upload: %s", self.valid_images_to_upload)
         return info_list_images_only
 
-    def get_images_to_upload(self, images_to_read: "List[str]") -> "Dict[str, bytes]":
-        """Read the image data from the zip as list."""
-        logger.debug(f"Reading data for images: {images_to_read}")
+    def get_batch_size(self, images_to_read: "List[str]") -> "int":
+        """Bytes of the images in the chapter, before any conversion."""
+        return sum(self.page_sizes.get(image, 0) for image in images_to_read)
+
+    def close(self):
+        """Close the zip file, reading the chapter afterwards opens it again."""
+        if self.myzip is not None:
+            self.myzip.close()
+
+    def get_images_to_upload(
+        self, images_to_read: "List[str]", reservation: "Optional[Reservation]" = None
+    ) -> "Dict[str, bytes]":
+        """Read the image data from the zip as list.
+        The reservation of the batch is resized to the bytes read, converted pages
+        can be larger than their files."""
+        logger.debug("Reading data for images: %s", images_to_read)
         # Dictionary to store the image index to the image bytes
         files: "Dict[str, bytes]" = {}
+        # Bytes of the pages read so far and the files of the ones left
+        held_size = self.get_batch_size(images_to_read)
         for array_index, image in enumerate(images_to_read, start=1):
             image_filename = str(Path(image).name)
             # Get index of the image in the images array
             renamed_file = str(self.info_list.index(image))
             # Keeps track of which image index belongs to which image name
             self.images_to_upload_names.update({renamed_file: image_filename})
-            files.update({renamed_file: self._get_bytes_for_upload(image)})
+            image_bytes = self._get_bytes_for_upload(image)
+            files.update({renamed_file: image_bytes})
+            if reservation is not None:
+                held_size += len(image_bytes) - self.page_sizes.get(image, 0)
+                reservation.resize(held_size)
         return files
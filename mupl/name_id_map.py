@@ -0,0 +1,137 @@
+import json
+import logging
+import marshal
+import os
+import unicodedata
+from pathlib import Path
+from typing import Optional
+
+from mupl.file_validator import UUID_REGEX
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+# Sections of the map that hold name to id pairs
+MAP_SECTIONS = ("manga", "group")
+# Bump when the compiled format changes
+COMPILED_MAP_VERSION = 1
+
+
+def normalize_name(name: "str") -> "str":
+    """Unicode normalise, case fold and collapse the whitespace of a name."""
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+
+class NameIdLookup(dict):
+    """Name to id dictionary that ignores casing, whitespace and unicode form differences."""
+
+    def __init__(self, mapping: "Optional[dict]" = None) -> None:
+        super().__init__()
+        if mapping:
+            for name, value in mapping.items():
+                self[name] = value
+
+    @classmethod
+    def from_normalized(cls, mapping: "dict") -> "NameIdLookup":
+        """Create the lookup from an already normalised dictionary."""
+        lookup = cls()
+        dict.update(lookup, mapping)
+        return lookup
+
+    def __getitem__(self, name: "str"):
+        return super().__getitem__(normalize_name(name))
+
+    def __setitem__(self, name: "str", value) -> None:
+        super().__setitem__(normalize_name(name), value)
+
+    def __contains__(self, name) -> "bool":
+        return isinstance(name, str) and super().__contains__(normalize_name(name))
+
+    def get(self, name: "str", default=None):
+        if not isinstance(name, str):
+            return default
+        return super().get(normalize_name(name), default)
+
+
+class NameIdMap(dict):
+    """The name-to-id map, with normalised lookups for the manga and group sections.
+
+    Aliases are read from the optional `alias` section, which has the same `manga`
+    and `group` sections mapping an alias to a name of the map or to an id."""
+
+    def __init__(self, names_to_ids: "Optional[dict]" = None) -> None:
+        super().__init__(names_to_ids or {})
+        aliases = self.get("alias") or {}
+
+        for section in MAP_SECTIONS:
+            lookup = NameIdLookup(self.get(section) or {})
+            for alias, target in (aliases.get(section) or {}).items():
+                target_id = target if UUID_REGEX.match(target) else lookup.get(target)
+                if target_id is None:
+                    logger.warning(f"Alias {alias} points to {target}, which isn't in the {section} map.")
+                    continue
+                # Aliases never override a name
+                if alias not in lookup:
+                    lookup[alias] = target_id
+            self[section] = lookup
+
+    def to_compiled(self) -> "dict":
+        """Get the map as plain types for marshal."""
+        return {
+            section: dict(value) if isinstance(value, NameIdLookup) else value
+            for section, value in self.items()
+        }
+
+    @classmethod
+    def from_compiled(cls, compiled: "dict") -> "NameIdMap":
+        names_to_ids = cls()
+        dict.update(names_to_ids, compiled)
+        for section in MAP_SECTIONS:
+            names_to_ids[section] = NameIdLookup.from_normalized(compiled.get(section) or {})
+        return names_to_ids
+
+
+def load_name_id_map(map_path: "Path", compiled_path: "Path") -> "NameIdMap":
+    """Load the name-to-id map, using the compiled copy if the json didn't change since it was compiled."""
+    map_stat = map_path.stat()
+    source_key = (map_stat.st_mtime_ns, map_stat.st_size, COMPILED_MAP_VERSION)
+
+    try:
+        with open(compiled_path, "rb") as compiled_file:
+            compiled = marshal.load(compiled_file)
+        if compiled.get("source") == source_key:
+            return NameIdMap.from_compiled(compiled["map"])
+    except (OSError, EOFError, ValueError, TypeError, AttributeError):
+        pass
+
+    logger.debug(f"Compiling {map_path}.")
+    names_to_ids = NameIdMap(json_codec.load_file(map_path))
+
+    temp_path = compiled_path.with_name(f"{compiled_path.name}.tmp")
+    try:
+        with open(temp_path, "wb") as compiled_file:
+            marshal.dump({"source": source_key, "map": names_to_ids.to_compiled()}, compiled_file)
+        os.replace(temp_path, compiled_path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Couldn't save the compiled name-to-id map: {e}")
+    return names_to_ids
+
+
+def add_to_name_id_map(map_path: "Path", names_to_ids: "dict"):
+    """Add names to the sections of the map file, names already in the map are kept."""
+    try:
+        name_id_map = json_codec.load_file(map_path)
+    except FileNotFoundError:
+        name_id_map = {}
+
+    for section, names in names_to_ids.items():
+        lookup = NameIdLookup(name_id_map.get(section) or {})
+        section_map = name_id_map.setdefault(section, {})
+        for name, entity_id in names.items():
+            if name not in lookup:
+                section_map[name] = entity_id
+
+    temp_path = map_path.with_name(f"{map_path.name}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as map_file:
+        json.dump(name_id_map, map_file, indent=4, ensure_ascii=False)
+    os.replace(temp_path, map_path)
@@ -0,0 +1,203 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from mupl.http import RequestError
+from mupl.http.bandwidth import TokenBucket
+from mupl.http.client import HTTPClient
+from mupl.id_validator import CONTENT_RATINGS
+from mupl.name_id_map import MAP_SECTIONS, normalize_name
+from mupl.utils import json_codec
+from mupl.utils.config import context
+
+logger = logging.getLogger("mupl")
+
+# Search results checked for an exact match of the name
+SEARCH_LIMIT = 10
+# Searches per second across the threads, under the global rate limit of the api
+SEARCHES_PER_SECOND = 4
+# Search route and parameter of each section of the map
+SEARCH_ROUTES = {"manga": ("manga", "title"), "group": ("group", "name")}
+
+
+class Resolution(NamedTuple):
+    section: "str"
+    name: "str"
+    entity_id: "Optional[str]"
+    # Id and name of each search result matching the name exactly
+    candidates: "List[Tuple[str, str]]"
+    # Resolved earlier in this run, only added again to a reloaded map
+    known: "bool" = False
+    # False when the api couldn't be searched, the name is searched again on the next scan
+    searched: "bool" = True
+
+    @property
+    def ambiguous(self) -> "bool":
+        return self.entity_id is None and len(self.candidates) > 1
+
+
+def _entity_names(section: "str", attributes: "dict") -> "List[str]":
+    """Every name of a search result, in any language."""
+    if section == "manga":
+        names = list((attributes.get("title") or {}).values())
+        for alt_title in attributes.get("altTitles") or []:
+            names.extend(alt_title.values())
+        return names
+
+    names = [attributes.get("name") or ""]
+    for alt_name in attributes.get("altNames") or []:
+        names.extend(alt_name.values())
+    return names
+
+
+class ResolverCache:
+    """Names resolved in previous runs, saved between runs. Ids of titles and
+    groups don't change, so the entries don't expire."""
+
+    def __init__(self, cache_path: "Path") -> None:
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self.names: "Dict[str, Dict[str, str]]" = {section: {} for section in MAP_SECTIONS}
+
+        try:
+            cache = json_codec.load_file(self.cache_path)
+            for section in MAP_SECTIONS:
+                self.names[section] = dict(cache.get(section, {}))
+        except (FileNotFoundError, json_codec.JSONDecodeError, AttributeError, TypeError):
+            pass
+
+    def get(self, section: "str", name: "str") -> "Optional[str]":
+        return self.names[section].get(normalize_name(name))
+
+    def add(self, section: "str", name: "str", entity_id: "str"):
+        with self._lock:
+            self.names[section][normalize_name(name)] = entity_id
+
+    def save(self):
+        with self._lock:
+            cache = {section: dict(names) for section, names in self.names.items()}
+        temp_path = self.cache_path.with_name(f"{self.cache_path.name}.tmp")
+        try:
+            temp_path.write_text(json_codec.dumps(cache), encoding="utf-8")
+            # An interrupted save leaves the previous cache instead of a truncated one
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the name resolver cache: {e}")
+
+
+class NameResolver:
+    """Finds the ids of the titles and groups missing from the name-to-id map
+    with the search routes of the api.
+
+    A name is only resolved when exactly one result matches it exactly, in any
+    of its titles or alternative names. Each name is searched at most once per
+    run, and the resolved ones are cached for the next runs and given again
+    from the cache when the map is reloaded, e.g. by each scan of watch mode.
+    Names whose search failed, e.g. on an api error, are searched again on
+    the next scan."""
+
+    def __init__(
+        self,
+        http_client: "Optional[HTTPClient]" = None,
+        cache: "Optional[ResolverCache]" = None,
+    ) -> None:
+        self.http_client = http_client or HTTPClient()
+        self.cache = cache or ResolverCache(context.resolver_cache_path)
+        self.bucket = TokenBucket(SEARCHES_PER_SECOND, burst=0)
+        # Normalised names of each section resolved or not found in this run
+        self._resolved: "Dict[str, set]" = {section: set() for section in MAP_SECTIONS}
+        self._failed: "Dict[str, set]" = {section: set() for section in MAP_SECTIONS}
+        # Normalised names of each section whose search failed in this scan
+        self._unavailable: "Dict[str, set]" = {section: set() for section in MAP_SECTIONS}
+
+    def start_scan(self):
+        """Search again the names whose search failed in the previous scan."""
+        for names in self._unavailable.values():
+            names.clear()
+
+    def _search(self, section: "str", name: "str") -> "Resolution":
+        route, parameter = SEARCH_ROUTES[section]
+        params = {parameter: name, "limit": SEARCH_LIMIT}
+        if section == "manga":
+            params["contentRating[]"] = list(CONTENT_RATINGS)
+
+        self.bucket.consume(1)
+        try:
+            response = self.http_client.get(
+                f"{context.mangadex_api_url}/{route}", params=params
+            )
+        except RequestError as e:
+            logger.error(e)
+            return Resolution(section, name, None, [], searched=False)
+
+        if not response.ok or response.data is None:
+            return Resolution(section, name, None, [], searched=False)
+
+        normalized = normalize_name(name)
+        candidates = []
+        for entity in response.data.get("data") or []:
+            attributes = entity.get("attributes") or {}
+            entity_names = _entity_names(section, attributes)
+            if any(normalize_name(x) == normalized for x in entity_names if x):
+                candidates.append((entity["id"], entity_names[0] if entity_names else ""))
+
+        entity_id = candidates[0][0] if len(candidates) == 1 else None
+        return Resolution(section, name, entity_id, candidates)
+
+    def untried(self, names: "Dict[str, Iterable[str]]") -> "bool":
+        """Whether any of the names may still be resolved, the ones not found in this run
+        can't, nor the ones whose search failed until the next scan."""
+        return any(
+            normalize_name(name)
+            and normalize_name(name) not in self._failed[section]
+            and normalize_name(name) not in self._unavailable[section]
+            for section, section_names in names.items()
+            for name in section_names
+        )
+
+    def resolve(self, names: "Dict[str, Iterable[str]]") -> "List[Resolution]":
+        """Look up the names of each section, from the cache or with a search
+        for the ones not tried yet in this run."""
+        resolutions: "List[Resolution]" = []
+        to_search: "List[Tuple[str, str]]" = []
+        # The map lookups ignore casing and whitespace, so each name is searched once in any form
+        searching: "set" = set()
+        for section, section_names in names.items():
+            for name in section_names:
+                normalized = normalize_name(name)
+                if (
+                    not normalized
+                    or normalized in self._failed[section]
+                    or normalized in self._unavailable[section]
+                ):
+                    continue
+
+                entity_id = self.cache.get(section, name)
+                if entity_id is not None:
+                    known = normalized in self._resolved[section]
+                    self._resolved[section].add(normalized)
+                    resolutions.append(Resolution(section, name, entity_id, [(entity_id, name)], known))
+                elif (section, normalized) not in searching:
+                    searching.add((section, normalized))
+                    to_search.append((section, name))
+
+        if to_search:
+            logger.info(f"Searching the api for {len(to_search)} names missing from the name-to-id map.")
+            with ThreadPoolExecutor(max_workers=context.number_threads) as executor:
+                searched = list(executor.map(lambda x: self._search(*x), to_search))
+
+            for resolution in searched:
+                normalized = normalize_name(resolution.name)
+                if resolution.entity_id is not None:
+                    self.cache.add(resolution.section, resolution.name, resolution.entity_id)
+                    self._resolved[resolution.section].add(normalized)
+                elif resolution.searched:
+                    self._failed[resolution.section].add(normalized)
+                else:
+                    self._unavailable[resolution.section].add(normalized)
+            self.cache.save()
+            resolutions.extend(searched)
+        return resolutions
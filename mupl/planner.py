@@ -0,0 +1,191 @@
+import logging
+import math
+import zipfile
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from mupl.file_validator import FileProcesser
+from mupl.http import get_route_class
+from mupl.http.stats import UploadStats
+from mupl.image_validator import ImageProcessorBase
+from mupl.scheduler import UploadScheduler
+from mupl.utils.config import context
+
+logger = logging.getLogger("mupl")
+
+
+def get_chapter_requests(pages: "int") -> "Dict[str, int]":
+    """Expected requests per route class to upload a chapter."""
+    upload_url = f"{context.mangadex_api_url}/upload"
+    return {
+        # Login check before the upload and after the chapter
+        get_route_class("GET", f"{context.mangadex_api_url}/auth/check"): 2,
+        get_route_class("GET", upload_url): 1,
+        get_route_class("POST", f"{upload_url}/begin"): 1,
+        get_route_class("POST", f"{upload_url}/{{id}}"): math.ceil(
+            pages / context.number_of_images_upload
+        ),
+        get_route_class("POST", f"{upload_url}/{{id}}/commit"): 1,
+    }
+
+
+class ChapterRecord(NamedTuple):
+    file_name_obj: "FileProcesser"
+    pages: "int"
+    size: "int"
+    requests: "Dict[str, int]"
+    eta: "float"
+
+    @property
+    def to_upload(self) -> "Path":
+        return self.file_name_obj.to_upload
+
+    @property
+    def manga_series(self) -> "Optional[str]":
+        return self.file_name_obj.manga_series
+
+
+class UploadPlan:
+    """Chapters to upload, deduplicated, sorted once, ordered by the upload order
+    and grouped by series, with the expected pages, bytes, requests and time of each."""
+
+    def __init__(
+        self,
+        zips_to_upload: "Iterable[FileProcesser]",
+        upload_stats: "UploadStats",
+        priorities: "Optional[Dict[str, int]]" = None,
+    ) -> None:
+        self.upload_stats = upload_stats
+
+        seen_paths = set()
+        unique_zips: "List[FileProcesser]" = []
+        for file_name_obj in zips_to_upload:
+            if file_name_obj.to_upload in seen_paths:
+                continue
+            seen_paths.add(file_name_obj.to_upload)
+            unique_zips.append(file_name_obj)
+
+        import natsort
+
+        # Mirror the system's file explorer within the same volume and chapter
+        unique_zips = natsort.os_sorted(
+            unique_zips,
+            key=lambda x: (x.volume_number, x.chapter_number, str(x.to_upload)),
+        )
+        self.records: "List[ChapterRecord]" = UploadScheduler(
+            context.upload_order, priorities or {}
+        ).schedule([self._get_record(x) for x in unique_zips])
+
+        self.series: "Dict[str, List[ChapterRecord]]" = {}
+        for record in self.records:
+            self.series.setdefault(record.manga_series, []).append(record)
+
+    def _get_record(self, file_name_obj: "FileProcesser") -> "ChapterRecord":
+        page_manifest = file_name_obj.page_manifest
+        if page_manifest is None:
+            try:
+                page_manifest = ImageProcessorBase.get_page_manifest(
+                    file_name_obj.to_upload
+                )
+            except (OSError, zipfile.BadZipFile) as e:
+                logger.error(f"Couldn't read the pages of {file_name_obj.to_upload}: {e}")
+                page_manifest = []
+            file_name_obj.page_manifest = page_manifest
+
+        pages = len(page_manifest)
+        size = sum(page_size for _, page_size in page_manifest)
+        requests = get_chapter_requests(pages)
+        return ChapterRecord(
+            file_name_obj=file_name_obj,
+            pages=pages,
+            size=size,
+            requests=requests,
+            eta=self._get_eta(requests, size),
+        )
+
+    def _get_eta(self, requests: "Dict[str, int]", size: "int") -> "float":
+        upload_route = get_route_class("POST", f"{context.mangadex_api_url}/upload/{{id}}")
+        eta = context.ratelimit_time * 2
+        for route_class, number_of_requests in requests.items():
+            if route_class == upload_route:
+                # Image uploads are bound by the bandwidth or the rate limit
+                eta += max(
+                    self.upload_stats.upload_seconds(size),
+                    number_of_requests * self.upload_stats.min_interval(route_class),
+                )
+            else:
+                eta += self.upload_stats.request_seconds(route_class, number_of_requests)
+        return eta
+
+    @property
+    def zips_to_upload(self) -> "List[FileProcesser]":
+        return [record.file_name_obj for record in self.records]
+
+    @property
+    def pages(self) -> "int":
+        return sum(record.pages for record in self.records)
+
+    @property
+    def size(self) -> "int":
+        return sum(record.size for record in self.records)
+
+    @property
+    def eta(self) -> "float":
+        return sum(record.eta for record in self.records)
+
+    @property
+    def requests(self) -> "Dict[str, int]":
+        requests: "Dict[str, int]" = {}
+        for record in self.records:
+            for route_class, number_of_requests in record.requests.items():
+                requests[route_class] = requests.get(route_class, 0) + number_of_requests
+        return requests
+
+    def __len__(self) -> "int":
+        return len(self.records)
+
+    @staticmethod
+    def _format_size(size: "int") -> "str":
+        return f"{round(size / (1024 * 1024), 2)} MB"
+
+    @staticmethod
+    def _format_eta(seconds: "float") -> "str":
+        return str(timedelta(seconds=round(seconds)))
+
+    def print_report(self):
+        """Print the plan for the whole batch and each chapter."""
+        print(context.translate_message["plan_title"])
+        for manga_series, records in self.series.items():
+            print(f"\n{manga_series}")
+            for record in records:
+                print(
+                    "  {}: {} {}, {}, {} {}, {} {}".format(
+                        record.file_name_obj.zip_name,
+                        record.pages,
+                        context.translate_message["plan_pages"],
+                        self._format_size(record.size),
+                        sum(record.requests.values()),
+                        context.translate_message["plan_requests"],
+                        context.translate_message["plan_eta"],
+                        self._format_eta(record.eta),
+                    )
+                )
+
+        print(
+            "\n{}: {} {}, {} {}, {}".format(
+                context.translate_message["plan_total"],
+                len(self),
+                context.translate_message["plan_chapters"],
+                self.pages,
+                context.translate_message["plan_pages"],
+                self._format_size(self.size),
+            )
+        )
+        for route_class, number_of_requests in self.requests.items():
+            print(f"  {route_class}: {number_of_requests} {context.translate_message['plan_requests']}")
+
+        eta_message = f"{context.translate_message['plan_eta']} {self._format_eta(self.eta)}"
+        if not self.upload_stats.learned:
+            eta_message += f" ({context.translate_message['plan_eta_default']})"
+        print(eta_message)
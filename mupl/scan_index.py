@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+
+class ScanEntry(NamedTuple):
+    path: str
+    mtime_ns: int
+    size: int
+    metadata: "dict"
+    pages: "Optional[List[Tuple[str, int]]]"
+
+
+class ScanIndex:
+    """Persistent index of the chapter sources found in the upload folder.
+
+    Each source is keyed by its path and stored with the mtime and size it had
+    when it was last scanned, so unchanged sources can reuse the parsed
+    metadata and the page manifest without opening their contents again."""
+
+    schema_version = 1
+
+    def __init__(self, index_path: "Path") -> None:
+        self.index_path = index_path
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.index_path), check_same_thread=False)
+        self._setup()
+
+    def _setup(self):
+        user_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version != self.schema_version:
+            logger.debug(f"Rebuilding scan index {self.index_path}.")
+            self._connection.execute("DROP TABLE IF EXISTS scan_index")
+            self._connection.execute(f"PRAGMA user_version = {self.schema_version}")
+
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS scan_index ("
+            "path TEXT PRIMARY KEY, "
+            "mtime_ns INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "metadata TEXT, "
+            "pages TEXT, "
+            "last_seen REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def signature(to_upload: "Path") -> "Tuple[int, int]":
+        """Get the (mtime, size) signature of a chapter file or folder.
+        Folders use the newest mtime and the total size of their direct entries."""
+        stat = to_upload.stat()
+        if not to_upload.is_dir():
+            return stat.st_mtime_ns, stat.st_size
+
+        mtime_ns = stat.st_mtime_ns
+        size = 0
+        with os.scandir(to_upload) as entries:
+            for entry in entries:
+                entry_stat = entry.stat()
+                mtime_ns = max(mtime_ns, entry_stat.st_mtime_ns)
+                size += entry_stat.st_size
+        return mtime_ns, size
+
+    def get(self, to_upload: "Path", signature: "Tuple[int, int]") -> "Optional[ScanEntry]":
+        """Get the indexed entry if the source hasn't changed since it was indexed."""
+        row = self._connection.execute(
+            "SELECT path, mtime_ns, size, metadata, pages FROM scan_index WHERE path = ?",
+            (str(to_upload),),
+        ).fetchone()
+        if row is None or (row[1], row[2]) != tuple(signature):
+            return
+
+        self._connection.execute(
+            "UPDATE scan_index SET last_seen = ? WHERE path = ?",
+            (time.time(), row[0]),
+        )
+        return ScanEntry(
+            path=row[0],
+            mtime_ns=row[1],
+            size=row[2],
+            metadata=json_codec.loads(row[3]) if row[3] else {},
+            pages=[tuple(page) for page in json_codec.loads(row[4])] if row[4] else None,
+        )
+
+    def update(
+        self,
+        to_upload: "Path",
+        signature: "Tuple[int, int]",
+        metadata: "Optional[dict]" = None,
+        pages: "Optional[List[Tuple[str, int]]]" = None,
+    ):
+        """Store the current state of a source."""
+        self._connection.execute(
+            "INSERT OR REPLACE INTO scan_index (path, mtime_ns, size, metadata, pages, last_seen) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                str(to_upload),
+                signature[0],
+                signature[1],
+                json.dumps(metadata or {}, default=str),
+                json.dumps(pages) if pages is not None else None,
+                time.time(),
+            ),
+        )
+
+    def prune(self, seen_paths: "Iterable[Path]"):
+        """Remove the entries of sources that weren't found in the last scan."""
+        seen = {str(path) for path in seen_paths}
+        stale = [
+            (path,)
+            for (path,) in self._connection.execute("SELECT path FROM scan_index")
+            if path not in seen
+        ]
+        if stale:
+            logger.debug(f"Removing {len(stale)} stale entries from the scan index.")
+            self._connection.executemany("DELETE FROM scan_index WHERE path = ?", stale)
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
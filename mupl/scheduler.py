@@ -0,0 +1,95 @@
+import logging
+from typing import TYPE_CHECKING, Callable, Dict, List, Sequence, Tuple
+
+from mupl.file_validator import UUID_REGEX
+
+if TYPE_CHECKING:
+    from mupl.planner import ChapterRecord
+
+logger = logging.getLogger("mupl")
+
+# Criteria of the upload order option
+SCHEDULE_CRITERIA = ("priority", "publish_date", "smallest", "fair_share")
+
+
+def get_series_priorities(names_to_ids: "dict") -> "Dict[str, int]":
+    """Manga id to priority, from the `priority` section of the name-to-id map.
+    The section maps a manga name of the map or a manga id to a number, higher first."""
+    priorities: "Dict[str, int]" = {}
+    manga_map = names_to_ids.get("manga") or {}
+    for name, priority in (names_to_ids.get("priority") or {}).items():
+        manga_id = name if UUID_REGEX.match(name) else manga_map.get(name)
+        if manga_id is None:
+            logger.warning(f"Priority set for {name}, which isn't in the manga map.")
+            continue
+        try:
+            priorities[manga_id.lower()] = int(priority)
+        except (TypeError, ValueError):
+            logger.warning(f"Priority of {name} isn't a number: {priority}")
+    return priorities
+
+
+class UploadScheduler:
+    """Orders the chapters by the criteria of the upload order, in turn:
+
+    - `priority`: series with a higher priority in the name-to-id map first.
+    - `publish_date`: chapters with the nearest publish date first.
+    - `smallest`: chapters with the shortest expected upload first.
+    - `fair_share`: chapters of the groups with the least upload time scheduled so far first.
+
+    Only the next chapter of each series is a candidate, so chapters of the same
+    series keep their volume and chapter order. Ties keep the sorted order."""
+
+    def __init__(self, criteria: "Sequence[str]", priorities: "Dict[str, int]") -> None:
+        self.criteria = []
+        for criterion in criteria:
+            if criterion in SCHEDULE_CRITERIA:
+                self.criteria.append(criterion)
+            else:
+                logger.warning(f"Unknown upload order {criterion}, ignoring it.")
+        self.priorities = priorities
+        # Upload time scheduled for each group
+        self._group_time: "Dict[str, float]" = {}
+
+    def _groups(self, record: "ChapterRecord") -> "List[str]":
+        return [x.lower() for x in record.file_name_obj.groups or []] or [""]
+
+    def _key(self, record: "ChapterRecord", index: "int") -> "Tuple":
+        keys: "Dict[str, Callable[[], object]]" = {
+            "priority": lambda: -self.priorities.get((record.manga_series or "").lower(), 0),
+            "publish_date": lambda: (
+                record.file_name_obj.publish_date is None,
+                record.file_name_obj.publish_date.timestamp()
+                if record.file_name_obj.publish_date is not None
+                else 0,
+            ),
+            "smallest": lambda: record.eta,
+            # A joint release waits for the busiest of its groups
+            "fair_share": lambda: max(self._group_time.get(x, 0.0) for x in self._groups(record)),
+        }
+        return tuple(keys[criterion]() for criterion in self.criteria) + (index,)
+
+    def schedule(self, records: "List[ChapterRecord]") -> "List[ChapterRecord]":
+        """Order the records, already sorted by volume and chapter."""
+        if not self.criteria:
+            return list(records)
+
+        # Each series' chapters in order, with their position in the sorted list
+        series: "Dict[str, List[Tuple[int, ChapterRecord]]]" = {}
+        for index, record in enumerate(records):
+            series.setdefault(record.manga_series, []).append((index, record))
+        for chapters in series.values():
+            chapters.reverse()
+
+        scheduled: "List[ChapterRecord]" = []
+        while series:
+            manga_series = min(series, key=lambda x: self._key(series[x][-1][1], series[x][-1][0]))
+            chapters = series[manga_series]
+            _, record = chapters.pop()
+            if not chapters:
+                del series[manga_series]
+
+            scheduled.append(record)
+            for group in self._groups(record):
+                self._group_time[group] = self._group_time.get(group, 0.0) + record.eta
+        return scheduled
@@ -0,0 +1,445 @@
+"""Local stand-in for the MangaDex api routes used by mupl.
+
+Run with `python -m mupl.testing.mock_api` and point `mangadex_api_url` and
+`mangadex_auth_url` in the config file at the printed url."""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from mupl.http import get_route_class
+
+
+@dataclass
+class MockApiConfig:
+    # Seconds added to every response
+    latency: float = 0.0
+    # Upload speed cap in bytes per second, 0 for unlimited
+    bandwidth: int = 0
+    # Chance of answering with a 429 or 5xx error
+    error_rate_429: float = 0.0
+    error_rate_5xx: float = 0.0
+    # Chance of each image in a batch failing
+    partial_failure_rate: float = 0.0
+    # Requests allowed per route in each window
+    ratelimit_limit: int = 40
+    ratelimit_window: int = 60
+    ratelimit_limits: "Dict[str, int]" = field(
+        default_factory=lambda: {"POST /upload/{id}": 250}
+    )
+    # Manga and group ids the list routes don't find, any other id exists
+    missing_ids: "List[str]" = field(default_factory=list)
+    # Name to id of the titles and groups the search routes find
+    manga_titles: "Dict[str, str]" = field(default_factory=dict)
+    group_names: "Dict[str, str]" = field(default_factory=dict)
+    seed: "Optional[int]" = None
+
+
+class MockApiState:
+    """Sessions, chapters and counters of the stand-in api."""
+
+    def __init__(self, config: "MockApiConfig") -> None:
+        self.config = config
+        self.lock = threading.Lock()
+        self.random = random.Random(config.seed)
+        self.started = time.time()
+
+        self.upload_session: "Optional[dict]" = None
+        self.ratelimits: "Dict[str, Tuple[float, int]]" = {}
+
+        self.requests: "Dict[str, int]" = {}
+        self.status_codes: "Dict[str, int]" = {}
+        self.bytes_received = 0
+        self.images_received = 0
+        self.injected_errors = 0
+        self.failed_images = 0
+        self.commits: "List[dict]" = []
+
+    def check_ratelimit(self, route_class: "str") -> "Tuple[int, int, float]":
+        """Count the request, return the route limit, remaining requests and window reset time."""
+        limit = self.config.ratelimit_limits.get(route_class, self.config.ratelimit_limit)
+        now = time.time()
+        window_start, used = self.ratelimits.get(route_class, (now, 0))
+        if now - window_start >= self.config.ratelimit_window:
+            window_start, used = now, 0
+        used += 1
+        self.ratelimits[route_class] = (window_start, used)
+        return limit, limit - used, window_start + self.config.ratelimit_window
+
+    def to_dict(self) -> "dict":
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "requests": dict(self.requests),
+                "status_codes": dict(self.status_codes),
+                "bytes_received": self.bytes_received,
+                "images_received": self.images_received,
+                "injected_errors": self.injected_errors,
+                "failed_images": self.failed_images,
+                "commits": list(self.commits),
+            }
+
+
+def make_token(lifetime: "int") -> "str":
+    """Create an unsigned jwt, mupl only reads its expiry."""
+
+    def encode(data: "dict") -> "str":
+        return base64.b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    payload = {"exp": int(time.time()) + lifetime, "sub": "mupl-mock", "jti": str(uuid.uuid4())}
+    return f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(payload)}.mock"
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    server: "MockApiServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self) -> "MockApiState":
+        return self.server.state
+
+    def _read_body(self) -> "bytes":
+        length = int(self.headers.get("Content-Length", 0))
+        bandwidth = self.state.config.bandwidth
+        if not bandwidth:
+            return self.rfile.read(length)
+
+        chunks = []
+        chunk_size = 64 * 1024
+        while length > 0:
+            chunk = self.rfile.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            chunks.append(chunk)
+            time.sleep(len(chunk) / bandwidth)
+        return b"".join(chunks)
+
+    def _send_json(self, status: "int", data: "Optional[dict]", headers: "Dict[str, str]"):
+        body = b"" if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-request-id", str(uuid.uuid4()))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def _error(status: "int", title: "str", detail: "str") -> "dict":
+        return {
+            "result": "error",
+            "errors": [{"id": str(uuid.uuid4()), "status": status, "title": title, "detail": detail}],
+        }
+
+    def _handle(self, method: "str"):
+        path = urlsplit(self.path).path.rstrip("/")
+        route_class = get_route_class(method, path)
+        body = self._read_body()
+
+        with self.state.lock:
+            self.state.requests[route_class] = self.state.requests.get(route_class, 0) + 1
+            limit, remaining, reset = self.state.check_ratelimit(route_class)
+            injected = self.state.random.random()
+
+        if self.state.config.latency:
+            time.sleep(self.state.config.latency)
+
+        headers = {
+            "x-ratelimit-limit": str(limit),
+            "x-ratelimit-remaining": str(max(remaining, 0)),
+        }
+        if remaining <= 0:
+            headers["x-ratelimit-retry-after"] = str(int(reset))
+
+        if remaining < 0 or injected < self.state.config.error_rate_429:
+            headers["x-ratelimit-retry-after"] = str(int(reset))
+            status, data = 429, self._error(429, "ratelimit_exceeded_http_exception", "Rate limit exceeded.")
+            if remaining >= 0:
+                with self.state.lock:
+                    self.state.injected_errors += 1
+        elif injected < self.state.config.error_rate_429 + self.state.config.error_rate_5xx:
+            status, data = 503, self._error(503, "service_unavailable", "Injected server error.")
+            with self.state.lock:
+                self.state.injected_errors += 1
+        else:
+            status, data = self._route(method, path, body)
+
+        with self.state.lock:
+            self.state.status_codes[str(status)] = self.state.status_codes.get(str(status), 0) + 1
+        self._send_json(status, data, headers)
+
+    def _route(self, method: "str", path: "str", body: "bytes") -> "Tuple[int, Optional[dict]]":
+        parts = path.strip("/").split("/")
+
+        if method == "POST" and parts[-1] == "token":
+            return 200, {
+                "access_token": make_token(900),
+                "refresh_token": make_token(86400),
+                "token_type": "Bearer",
+                "expires_in": 900,
+            }
+
+        if method == "GET" and parts[-2:] == ["auth", "check"]:
+            authenticated = self.headers.get("Authorization", "").startswith("Bearer ")
+            return 200, {"result": "ok", "isAuthenticated": authenticated, "roles": []}
+
+        if method == "GET" and parts[-1] in ("manga", "group"):
+            query = parse_qs(urlsplit(self.path).query)
+            search = (query.get("title") or query.get("name") or [None])[0]
+            if search is not None:
+                found = self._search(parts[-1], search)
+            else:
+                entity_type = "manga" if parts[-1] == "manga" else "scanlation_group"
+                found = [
+                    {"id": x, "type": entity_type, "attributes": {}}
+                    for x in query.get("ids[]", [])
+                    if x not in self.state.config.missing_ids
+                ]
+            return 200, {
+                "result": "ok",
+                "response": "collection",
+                "data": found,
+                "limit": 100,
+                "offset": 0,
+                "total": len(found),
+            }
+
+        if method == "GET" and parts[-1] == "chapter":
+            query = parse_qs(urlsplit(self.path).query)
+            with self.state.lock:
+                commits = list(self.state.commits)
+            found = [
+                {
+                    "id": x["id"],
+                    "type": "chapter",
+                    "attributes": {
+                        "volume": x["volume"],
+                        "chapter": x["chapter"],
+                        "translatedLanguage": x["language"],
+                    },
+                }
+                for x in commits
+                if x["manga"] in query.get("manga", [x["manga"]])
+                and x["language"] in query.get("translatedLanguage[]", [x["language"]])
+                and x["chapter"] in query.get("chapter", [x["chapter"]])
+                and set(query.get("groups[]", [])) <= set(x["groups"])
+            ]
+            return 200, {
+                "result": "ok",
+                "response": "collection",
+                "data": found,
+                "limit": 100,
+                "offset": 0,
+                "total": len(found),
+            }
+
+        if "upload" not in parts:
+            return 404, self._error(404, "not_found_http_exception", f"No route for {path}.")
+        route = parts[parts.index("upload") + 1 :]
+
+        if method == "GET" and not route:
+            with self.state.lock:
+                session = self.state.upload_session
+            if session is None:
+                return 404, self._error(404, "not_found_http_exception", "No upload session.")
+            return 200, {"result": "ok", "response": "entity", "data": session}
+
+        if method == "POST" and route == ["begin"]:
+            payload = json.loads(body or b"{}")
+            with self.state.lock:
+                if self.state.upload_session is not None:
+                    return 400, self._error(400, "upload_session_exists", "An upload session already exists.")
+                self.state.upload_session = {
+                    "id": str(uuid.uuid4()),
+                    "type": "upload_session",
+                    "attributes": {"isCommitted": False, "isProcessed": False, "isDeleted": False},
+                    "relationships": [{"id": payload.get("manga"), "type": "manga"}]
+                    + [{"id": group, "type": "scanlation_group"} for group in payload.get("groups", [])],
+                }
+                return 200, {"result": "ok", "response": "entity", "data": self.state.upload_session}
+
+        with self.state.lock:
+            session = self.state.upload_session
+        if session is None or not route or route[0] != session["id"]:
+            return 404, self._error(404, "not_found_http_exception", "Upload session not found.")
+
+        if method == "DELETE" and len(route) == 1:
+            with self.state.lock:
+                self.state.upload_session = None
+            return 200, {"result": "ok"}
+
+        if method == "POST" and len(route) == 1:
+            return self._upload_files(body)
+
+        if method == "POST" and route[1:] == ["commit"]:
+            payload = json.loads(body or b"{}")
+            chapter_id = str(uuid.uuid4())
+            chapter_draft = payload.get("chapterDraft", {})
+            relationships = session["relationships"]
+            with self.state.lock:
+                self.state.upload_session = None
+                self.state.commits.append(
+                    {
+                        "id": chapter_id,
+                        "time": time.time(),
+                        "pages": len(payload.get("pageOrder", [])),
+                        "manga": next(x["id"] for x in relationships if x["type"] == "manga"),
+                        "groups": [x["id"] for x in relationships if x["type"] == "scanlation_group"],
+                        "volume": chapter_draft.get("volume"),
+                        "chapter": chapter_draft.get("chapter"),
+                        "language": chapter_draft.get("translatedLanguage"),
+                    }
+                )
+            return 200, {
+                "result": "ok",
+                "response": "entity",
+                "data": {"id": chapter_id, "type": "chapter", "attributes": payload.get("chapterDraft", {})},
+            }
+
+        return 404, self._error(404, "not_found_http_exception", f"No route for {path}.")
+
+    def _search(self, route: "str", search: "str") -> "List[dict]":
+        """Titles or groups whose name contains the search, ignoring the case."""
+        if route == "manga":
+            return [
+                {"id": x, "type": "manga", "attributes": {"title": {"en": title}, "altTitles": []}}
+                for title, x in self.state.config.manga_titles.items()
+                if search.casefold() in title.casefold()
+            ]
+        return [
+            {"id": x, "type": "scanlation_group", "attributes": {"name": name, "altNames": []}}
+            for name, x in self.state.config.group_names.items()
+            if search.casefold() in name.casefold()
+        ]
+
+    def _upload_files(self, body: "bytes") -> "Tuple[int, dict]":
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode() + body
+        )
+        uploaded, errors = [], []
+        with self.state.lock:
+            self.state.bytes_received += len(body)
+            for part in message.iter_parts():
+                file_name = part.get_filename() or part.get_param("name", header="content-disposition")
+                file_data = part.get_payload(decode=True) or b""
+                self.state.images_received += 1
+                if self.state.random.random() < self.state.config.partial_failure_rate:
+                    self.state.failed_images += 1
+                    errors.append({"status": 400, "title": "file_upload_error", "detail": f"Injected failure for {file_name}."})
+                    continue
+                uploaded.append(
+                    {
+                        "id": str(uuid.uuid4()),
+                        "type": "upload_session_file",
+                        "attributes": {
+                            "originalFileName": file_name,
+                            "fileHash": str(uuid.uuid4()),
+                            "fileSize": len(file_data),
+                            "mimeType": part.get_content_type(),
+                            "source": "local",
+                            "version": 1,
+                        },
+                    }
+                )
+        return 200, {"result": "ok", "errors": errors, "data": uploaded}
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/_mock/stats":
+            self._send_json(200, self.state.to_dict(), {})
+            return
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: "str" = "127.0.0.1", port: "int" = 0, config: "Optional[MockApiConfig]" = None) -> None:
+        super().__init__((host, port), MockApiHandler)
+        self.state = MockApiState(config or MockApiConfig())
+        self._thread: "Optional[threading.Thread]" = None
+
+    @property
+    def url(self) -> "str":
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self) -> "str":
+        return self.url
+
+    @property
+    def auth_url(self) -> "str":
+        return f"{self.url}/auth/realms/mangadex/protocol/openid-connect"
+
+    def start(self) -> "MockApiServer":
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the MangaDex upload api.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each response.")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="Upload cap in MB/s, 0 for unlimited.")
+    parser.add_argument("--error-rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate-5xx", type=float, default=0.0)
+    parser.add_argument("--partial-failure-rate", type=float, default=0.0, help="Chance of each image in a batch failing.")
+    parser.add_argument("--ratelimit", type=int, default=40, help="Requests per route in each window.")
+    parser.add_argument("--ratelimit-window", type=int, default=60)
+    parser.add_argument("--missing-id", action="append", default=[], help="Manga or group id the api doesn't find.")
+    parser.add_argument("--seed", type=int, default=None)
+    vargs = parser.parse_args()
+
+    config = MockApiConfig(
+        latency=vargs.latency,
+        bandwidth=int(vargs.bandwidth * 1024 * 1024),
+        error_rate_429=vargs.error_rate_429,
+        error_rate_5xx=vargs.error_rate_5xx,
+        partial_failure_rate=vargs.partial_failure_rate,
+        ratelimit_limit=vargs.ratelimit,
+        ratelimit_window=vargs.ratelimit_window,
+        missing_ids=vargs.missing_id,
+        seed=vargs.seed,
+    )
+    server = MockApiServer(vargs.host, vargs.port, config)
+    print(f"mangadex_api_url: {server.api_url}")
+    print(f"mangadex_auth_url: {server.auth_url}")
+    print(f"Stats: {server.url}/_mock/stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import errno
+import logging
+import os
+import queue
+import shutil
+import threading
+import uuid
+import zipfile
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+# Folder in the upload folder holding the chapters still being archived, hidden from the scan
+STAGING_FOLDER = ".mupl-archive"
+# Tries at a free name when the uploaded folder changes under the archiver
+NAME_TRIES = 5
+
+
+class Archiver:
+    """Moves the uploaded chapters to the uploaded folder without delaying the next upload.
+
+    A chapter leaves the upload folder straight away: it is renamed into the
+    uploaded folder, or into a staging folder next to it when the uploaded folder
+    is on another device or folders are packed. Copies and packing then run on a
+    background thread. Each staged chapter has a record of its destination, so a
+    crash leaves it to be finished by the next run instead of losing it."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Path]" = queue.Queue()
+        self._thread: "Optional[threading.Thread]" = None
+        self.uploads_folder: "Optional[Path]" = None
+        self.uploaded_folder: "Optional[Path]" = None
+        self.pack_folders = False
+        # Names taken in the uploaded folder, listed once instead of for every chapter
+        self._names: "Optional[Set[str]]" = None
+
+    @property
+    def staging_folder(self) -> "Path":
+        return self.uploads_folder.joinpath(STAGING_FOLDER)
+
+    def configure(self, uploads_folder: "Path", uploaded_folder: "Path", pack_folders: "bool" = False):
+        """Set the folders, finishing the chapters left staged by an earlier run."""
+        with self._lock:
+            if (uploads_folder, uploaded_folder, pack_folders) == (
+                self.uploads_folder,
+                self.uploaded_folder,
+                self.pack_folders,
+            ):
+                return
+            self.uploads_folder = uploads_folder
+            self.uploaded_folder = uploaded_folder
+            self.pack_folders = pack_folders
+            self._names = None
+
+        try:
+            records = sorted(self.staging_folder.glob("*.json"))
+        except OSError:
+            records = []
+        for record_path in records:
+            logger.info(f"Finishing the archival of {record_path.stem} from an earlier run.")
+            self._submit(record_path)
+
+    def _reserve_name(self, name: "str", extension: "str") -> "Path":
+        """Destination of the chapter, with a version added if the name is taken."""
+        with self._lock:
+            if self._names is None:
+                self.uploaded_folder.mkdir(parents=True, exist_ok=True)
+                self._names = set(os.listdir(self.uploaded_folder))
+
+            file_name = f"{name}{extension}"
+            version = 1
+            while file_name in self._names:
+                version += 1
+                file_name = f"{name}{{v{version}}}{extension}"
+            self._names.add(file_name)
+        return self.uploaded_folder.joinpath(file_name)
+
+    def _forget_names(self):
+        """List the uploaded folder again, another program added to it."""
+        with self._lock:
+            self._names = None
+
+    @staticmethod
+    def _rename_new(source: "Path", destination: "Path"):
+        """Rename without replacing anything at the destination, FileExistsError if it is taken.
+        A rename replaces files, so files are linked first, and folders are only checked
+        as a rename can't replace a folder that isn't empty."""
+        if not source.is_dir():
+            try:
+                os.link(source, destination)
+            except FileExistsError:
+                raise
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    raise
+                # Links aren't supported by the file system
+            else:
+                source.unlink()
+                return
+
+        if destination.exists():
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(destination))
+        try:
+            source.rename(destination)
+        except OSError as e:
+            if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                raise FileExistsError(e.errno, e.strerror, str(destination))
+            raise
+
+    def _move_to_free_name(self, source: "Path", name: "str", extension: "str", destination: "Path") -> "Path":
+        """Rename to the destination, or to the next free name if it was taken since it was reserved."""
+        for _ in range(NAME_TRIES - 1):
+            try:
+                self._rename_new(source, destination)
+                return destination
+            except FileExistsError:
+                logger.warning(f"{destination} was taken meanwhile, looking for another name.")
+                self._forget_names()
+                destination = self._reserve_name(name, extension)
+        self._rename_new(source, destination)
+        return destination
+
+    def archive(self, to_upload: "Path", name: "str", extension: "str" = "") -> "Optional[Path]":
+        """Take the chapter out of the upload folder, return its destination or None if it couldn't be moved."""
+        pack = self.pack_folders and to_upload.is_dir()
+        if pack:
+            extension = ".cbz"
+        destination = self._reserve_name(name, extension)
+
+        if not pack:
+            try:
+                destination = self._move_to_free_name(to_upload, name, extension, destination)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    logger.error(f"Couldn't move {to_upload} to {destination}: {e}")
+                    return None
+            else:
+                logger.debug(f"Moved {to_upload} to {destination}.")
+                self._prune(to_upload.parent)
+                return destination
+
+        # Another device or packing, stage it on this device and finish in the background
+        token = uuid.uuid4().hex
+        staged_path = self.staging_folder.joinpath(token)
+        record_path = staged_path.with_suffix(".json")
+        record = {
+            "source": str(to_upload),
+            "destination": str(destination),
+            "name": name,
+            "extension": extension,
+            "pack": pack,
+        }
+        # Locked so the worker can't remove the empty staging folder meanwhile
+        with self._lock:
+            try:
+                self.staging_folder.mkdir(parents=True, exist_ok=True)
+                record_path.write_text(json_codec.dumps(record), encoding="utf-8")
+                to_upload.rename(staged_path)
+            except OSError as e:
+                logger.error(f"Couldn't stage {to_upload} for archival: {e}")
+                record_path.unlink(missing_ok=True)
+                return None
+
+        self._prune(to_upload.parent)
+        self._submit(record_path)
+        return destination
+
+    def _prune(self, folder: "Path"):
+        """Remove the chapter's parent folders that are now empty, up to the upload folder."""
+        while folder != self.uploads_folder and self.uploads_folder in folder.parents:
+            try:
+                folder.rmdir()
+            except OSError:
+                return
+            folder = folder.parent
+
+    def _submit(self, record_path: "Path"):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="archiver", daemon=True)
+                self._thread.start()
+        self._queue.put(record_path)
+
+    def _run(self):
+        while True:
+            record_path = self._queue.get()
+            try:
+                self._finish(record_path)
+            except Exception as e:
+                logger.exception(f"Couldn't archive {record_path.stem}, it is retried on the next run: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _finish(self, record_path: "Path"):
+        """Copy or pack a staged chapter to its destination, then remove it from the staging folder."""
+        record: "Dict[str, object]" = json_codec.load_file(record_path)
+        staged_path = record_path.with_suffix("")
+        destination = Path(record["destination"])
+        if not staged_path.exists():
+            # Finished before a crash, only the record was left
+            record_path.unlink(missing_ok=True)
+            return
+
+        if destination.exists():
+            # Taken since the chapter was staged
+            self._forget_names()
+            destination = self._reserve_name(record["name"], record["extension"])
+
+        # Written under a hidden name, the destination only ever holds a whole chapter
+        partial_path = destination.with_name(f".{destination.name}.partial")
+        if partial_path.is_dir():
+            shutil.rmtree(partial_path)
+        if record.get("pack"):
+            self._pack(staged_path, partial_path)
+        elif staged_path.is_dir():
+            shutil.copytree(staged_path, partial_path)
+        else:
+            shutil.copy2(staged_path, partial_path)
+        destination = self._move_to_free_name(partial_path, record["name"], record["extension"], destination)
+
+        if staged_path.is_dir():
+            shutil.rmtree(staged_path)
+        else:
+            staged_path.unlink()
+        record_path.unlink()
+        with self._lock:
+            try:
+                record_path.parent.rmdir()
+            except OSError:
+                pass
+        logger.debug(f"Archived {record['source']} to {destination}.")
+
+    @staticmethod
+    def _pack(folder: "Path", cbz_path: "Path"):
+        # The images are already compressed
+        with zipfile.ZipFile(cbz_path, "w", zipfile.ZIP_STORED) as cbz_file:
+            for image_path in sorted(folder.rglob("*")):
+                if image_path.is_file():
+                    cbz_file.write(image_path, image_path.relative_to(folder).as_posix())
+
+    def wait(self):
+        """Block until the queued chapters are archived, e.g. before exiting."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+
+archiver = Archiver()
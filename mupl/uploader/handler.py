@@ -1,16 +1,17 @@
 import logging
-from typing import List, Optional, Dict
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Dict, Tuple
 
 from mupl.file_validator import FileProcesser
 from mupl.http import RequestError
 from mupl.http.client import HTTPClient
 from mupl.image_validator import ImageProcessor
-from mupl.utils.config import (
-    VERBOSE,
-    mangadex_api_url,
-    UPLOAD_RETRY,
-    translate_message,
-)
+from mupl.uploader.jobs import JobQueue, JobState
+from mupl.uploader.leases import chapter_leases
+from mupl.utils.config import context
+from mupl.utils.events import EventType, emit, emit_message
+from mupl.utils.tracing import span
 
 logger = logging.getLogger("mupl")
 
@@ -21,11 +22,13 @@ class ChapterUploaderHandler:
         http_client: "HTTPClient",
         file_name_obj: "FileProcesser",
         failed_uploads: "list",
+        job_queue: "Optional[JobQueue]" = None,
     ):
         self.http_client = http_client
         self.file_name_obj = file_name_obj
         self.to_upload = self.file_name_obj.to_upload
         self.failed_uploads = failed_uploads
+        self.job_queue = job_queue
         self.zip_name = self.to_upload.name
         self.zip_extension = self.to_upload.suffix
         self.folder_upload = False
@@ -34,8 +37,8 @@ class ChapterUploaderHandler:
             self.folder_upload = True
             self.zip_extension = None
 
-        self.number_upload_retry = UPLOAD_RETRY
-        self.md_upload_api_url = f"{mangadex_api_url}/upload"
+        self.number_upload_retry = context.upload_retry
+        self.md_upload_api_url = f"{context.mangadex_api_url}/upload"
 
         # Images to include with chapter commit
         self.images_to_upload_ids: "List[str]" = []
@@ -46,17 +49,45 @@ class ChapterUploaderHandler:
             self.file_name_obj, self.folder_upload
         )
 
+    def close(self):
+        """Close the chapter's zip file."""
+        self.image_uploader_process.close()
+
+    def _set_job_state(self, state: "JobState", **kwargs):
+        if self.job_queue is not None:
+            self.job_queue.set_state(self.to_upload, state, **kwargs)
+
+    def _upload_failed(self, error: "str"):
+        """Mark the chapter as failed."""
+        self.failed_uploads.append(self.to_upload)
+        self._set_job_state(JobState.FAILED, error=error)
+        emit(EventType.FAILURE, str(self.to_upload), detail=error)
+
     def _images_upload(self, image_batch: "Dict[str, bytes]"):
         """Upload the images"""
+        batch_size = sum(len(image_bytes) for image_bytes in image_batch.values())
+        upload_start = time.perf_counter()
         try:
-            image_upload_response = self.http_client.post(
-                f"{self.md_upload_api_url}/{self.upload_session_id}",
-                files=image_batch,
-            )
+            with span(
+                "batch_upload",
+                chapter=self.zip_name,
+                pages=len(image_batch),
+                size=batch_size,
+            ):
+                image_upload_response = self.http_client.post(
+                    f"{self.md_upload_api_url}/{self.upload_session_id}",
+                    files=image_batch,
+                    throttled=True,
+                )
         except (RequestError,) as e:
             logger.error(e)
             return
 
+        self.http_client.upload_stats.record_upload(
+            batch_size, time.perf_counter() - upload_start
+        )
+        emit(EventType.BYTES_SENT, str(self.to_upload), pages=len(image_batch), size=batch_size)
+
         # Some images returned errors
         try:
             uploaded_image_data = image_upload_response.data
@@ -95,16 +126,20 @@ class ChapterUploaderHandler:
         image_batch_list = list(image_batch.keys())
         batch_start = int(image_batch_list[0]) + 1
         batch_end = int(image_batch_list[-1]) + 1
-        if VERBOSE:
-            print(f"{translate_message['uploading_images']}".format(batch_start, batch_end))
-        logger.debug(f"Uploading images {batch_start} to {batch_end}.")
+        if context.verbose:
+            emit_message(
+                str(self.to_upload),
+                f"{context.translate_message['uploading_images']}".format(batch_start, batch_end),
+            )
+        logger.debug("Uploading images %s to %s.", batch_start, batch_end)
 
         for retry in range(self.number_upload_retry):
             successful_upload_data = self._images_upload(image_batch)
 
             if successful_upload_data is None:
-                print(
-                    f"{translate_message['uploading_images_error']}".format(
+                emit_message(
+                    str(self.to_upload),
+                    f"{context.translate_message['uploading_images_error']}".format(
                         batch_start,
                         batch_end,
                         retry + 1,
@@ -118,7 +153,7 @@ class ChapterUploaderHandler:
             # Add successful image uploads to the image ids array
             for uploaded_image in successful_upload_data:
                 if successful_upload_data.index(uploaded_image) == 0:
-                    logger.debug(f"Success: Uploaded images {successful_upload_data}")
+                    logger.debug("Success: Uploaded images %s", successful_upload_data)
 
                 uploaded_image_attributes = uploaded_image["attributes"]
                 uploaded_filename = uploaded_image_attributes["originalFileName"]
@@ -137,8 +172,9 @@ class ChapterUploaderHandler:
                 if converted_format is not None:
                     formatted_name_message += f" (converted to {converted_format})"
 
-                if VERBOSE:
-                    print(
+                if context.verbose:
+                    emit_message(
+                        str(self.to_upload),
                         successful_upload_message.format(
                             formatted_name_message,
                             round(file_size * 0.00000095367432, 2),
@@ -147,10 +183,13 @@ class ChapterUploaderHandler:
 
             # Length of images array returned from the api is the same as the array sent to the api
             if len(successful_upload_data) == len(image_batch):
-                logger.info(
-                    f"Uploaded images {int(image_batch_list[0]) + 1} to {int(image_batch_list[-1]) + 1}."
+                logger.info("Uploaded images %s to %s.", batch_start, batch_end)
+                emit(
+                    EventType.BATCH_SENT,
+                    str(self.to_upload),
+                    pages=len(image_batch_list),
+                    size=sum(len(image_bytes) for image_bytes in image_batch.values()),
                 )
-                self.tqdm.update(len(image_batch_list))
                 return False
             else:
                 # Update the images to upload dictionary with the images that failed
@@ -163,8 +202,10 @@ class ChapterUploaderHandler:
                         for i in successful_upload_data
                     ]
                 }
+                # Only the names, the batch holds the image bytes
                 logger.warning(
-                    f"Some images didn't upload, retrying. Failed images: {image_batch}"
+                    "Some images didn't upload, retrying. Failed images: %s",
+                    list(image_batch),
                 )
                 self.failed_image_upload = True
                 continue
@@ -193,7 +234,7 @@ class ChapterUploaderHandler:
         """Remove any exising upload sessions to not error out as mangadex only allows one upload session at a time."""
         try:
             existing_session = self.http_client.get(
-                f"{mangadex_api_url}/upload", successful_codes=[404]
+                f"{context.mangadex_api_url}/upload", successful_codes=[404]
             )
         except (RequestError,) as e:
             logger.error(e)
@@ -210,6 +251,64 @@ class ChapterUploaderHandler:
         logger.error("Exising upload session not deleted.")
         raise Exception(f"Couldn't delete existing upload session.")
 
+    def _find_committed_chapter(self, since: "float") -> "Optional[str]":
+        """Id of the chapter created since the time with the volume, chapter, language
+        and groups of this one."""
+        language = self.file_name_obj.language.replace('[', '').replace(']', '')
+        params = {
+            "manga": self.file_name_obj.manga_series,
+            "translatedLanguage[]": [language],
+            "groups[]": self.file_name_obj.groups,
+            "createdAtSince": datetime.fromtimestamp(since, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"),
+            "includeFutureUpdates": "1",
+            "limit": 100,
+        }
+        if self.file_name_obj.chapter_number is not None:
+            params["chapter"] = self.file_name_obj.chapter_number
+
+        try:
+            chapters_response = self.http_client.get(
+                f"{context.mangadex_api_url}/chapter", params=params
+            )
+        except (RequestError,) as e:
+            logger.error(e)
+            return
+
+        for chapter in (chapters_response.data or {}).get("data", []):
+            attributes = chapter.get("attributes", {})
+            if (
+                attributes.get("chapter") == self.file_name_obj.chapter_number
+                and attributes.get("volume") == self.file_name_obj.volume_number
+            ):
+                return chapter["id"]
+
+    def check_commit(
+        self, session_id: "Optional[str]", since: "float"
+    ) -> "Tuple[Optional[bool], Optional[str]]":
+        """Check if an interrupted commit went through, from the upload session and the
+        chapters created since it was sent. Returns whether it was committed, None if it
+        can't be told, and the chapter id when found."""
+        session_committed = False
+        if session_id is not None:
+            try:
+                existing_session = self.http_client.get(
+                    f"{context.mangadex_api_url}/upload", successful_codes=[404]
+                )
+            except (RequestError,) as e:
+                logger.error(e)
+                return None, None
+
+            if existing_session.response.ok and existing_session.data["data"]["id"] == session_id:
+                if not existing_session.data["data"]["attributes"].get("isCommitted"):
+                    return False, None
+                session_committed = True
+
+        # A minute earlier for the clock of the api
+        chapter_id = self._find_committed_chapter(since - 60)
+        if chapter_id is not None:
+            return True, chapter_id
+        return (True if session_committed else None), None
+
     def _create_upload_session(self) -> "Optional[dict]":
         """Try create an upload session 3 times."""
         payload = {
@@ -224,7 +323,8 @@ class ChapterUploaderHandler:
         else:
             # Start the upload session
             try:
-                upload_session_response = self._begin_upload_session(payload)
+                with span("session_begin", chapter=self.zip_name):
+                    upload_session_response = self._begin_upload_session(payload)
             except (RequestError,) as e:
                 logger.error(e)
             else:
@@ -237,10 +337,10 @@ class ChapterUploaderHandler:
         )
         logger.error(upload_session_response_json_message)
         upload_session_response_json_message = (
-            f"{translate_message['error_create_draft_session']}".format(self.zip_name)
+            f"{context.translate_message['error_create_draft_session']}".format(self.zip_name)
         )
-        print(upload_session_response_json_message)
-        self.failed_uploads.append(self.to_upload)
+        emit_message(str(self.to_upload), upload_session_response_json_message)
+        self._upload_failed("Couldn't create an upload session.")
         return
 
     def _commit_chapter(self) -> "bool":
@@ -260,26 +360,53 @@ class ChapterUploaderHandler:
                 "publishAt"
             ] = f"{self.file_name_obj.publish_date.strftime('%Y-%m-%dT%H:%M:%S')}"
 
+        # Taken over by another host after a stall, only one of them may commit
+        if not chapter_leases.held(self.to_upload):
+            logger.error(f"Lost the lease of {self.zip_name} to another host, removing upload draft.")
+            emit_message(
+                str(self.to_upload),
+                f"{context.translate_message['lease_lost']}".format(self.zip_name),
+            )
+            self.remove_upload_session()
+            self._upload_failed("Lost the lease to another host.")
+            return False
+
+        self._set_job_state(JobState.COMMITTING)
         try:
-            chapter_commit_response = self._commit_upload_session(payload)
+            with span("commit", chapter=self.zip_name, pages=len(self.images_to_upload_ids)):
+                chapter_commit_response = self._commit_upload_session(payload)
         except (RequestError,) as e:
             logger.error(e)
         else:
             if chapter_commit_response.ok:
                 successful_upload_id = chapter_commit_response.data["data"]["id"]
-                print(
-                    f"{translate_message['uploading_successfully']}".format(
+                emit_message(
+                    str(self.to_upload),
+                    f"{context.translate_message['uploading_successfully']}".format(
                         successful_upload_id, self.zip_name
                     )
                 )
                 logger.info(
                     f"Successful commit: {successful_upload_id}, {self.zip_name}."
                 )
-                self.move_files()
+                self._set_job_state(JobState.COMMITTED, chapter_id=successful_upload_id)
+                emit(EventType.COMMIT_DONE, str(self.to_upload), detail=successful_upload_id)
+                chapter_leases.mark_committed(self.to_upload)
+                with span("file_move", chapter=self.zip_name):
+                    moved = self.move_files()
+                # Left committed otherwise, the next run moves it again
+                if moved:
+                    self._set_job_state(JobState.ARCHIVED)
                 return True
 
+            # Refused by the api, so it can be uploaded again
+            self._set_job_state(JobState.UPLOADING)
+
         logger.error(f"Failed to commit {self.zip_name}, removing upload draft.")
-        print(f"{translate_message['uploading_failed']}".format(self.zip_name))
+        emit_message(
+            str(self.to_upload),
+            f"{context.translate_message['uploading_failed']}".format(self.zip_name),
+        )
         self.remove_upload_session()
-        self.failed_uploads.append(self.to_upload)
+        self._upload_failed("Couldn't commit the chapter.")
         return False
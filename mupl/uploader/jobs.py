@@ -0,0 +1,191 @@
+import enum
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional
+
+logger = logging.getLogger("mupl")
+
+
+class JobState(enum.Enum):
+    PENDING = "pending"
+    PREPARING = "preparing"
+    UPLOADING = "uploading"
+    COMMITTING = "committing"
+    COMMITTED = "committed"
+    ARCHIVED = "archived"
+    FAILED = "failed"
+
+
+class Job(NamedTuple):
+    path: "Path"
+    state: "JobState"
+    attempts: "int"
+    last_error: "Optional[str]"
+    chapter_id: "Optional[str]"
+    session_id: "Optional[str]"
+    next_attempt: "float"
+    updated: "float"
+
+
+class JobQueue:
+    """Durable record of every chapter upload.
+
+    A chapter is marked committed as soon as the api accepts the commit and
+    archived once it is moved to the uploaded folder, so a crash between the
+    two only needs the move to be redone instead of the upload.
+    Failed chapters are retried after a delay that doubles with each attempt."""
+
+    def __init__(self, queue_path: "Path", max_attempts: "int", retry_delay: "float") -> None:
+        self.queue_path = queue_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+
+        self.queue_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.queue_path), check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "path TEXT PRIMARY KEY, "
+            "state TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "last_error TEXT, "
+            "chapter_id TEXT, "
+            "session_id TEXT, "
+            "next_attempt REAL NOT NULL DEFAULT 0, "
+            "updated REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _to_job(row) -> "Job":
+        return Job(
+            path=Path(row[0]),
+            state=JobState(row[1]),
+            attempts=row[2],
+            last_error=row[3],
+            chapter_id=row[4],
+            session_id=row[5],
+            next_attempt=row[6],
+            updated=row[7],
+        )
+
+    def get(self, to_upload: "Path") -> "Optional[Job]":
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT path, state, attempts, last_error, chapter_id, session_id, next_attempt, updated "
+                "FROM jobs WHERE path = ?",
+                (str(to_upload),),
+            ).fetchone()
+        return None if row is None else self._to_job(row)
+
+    def get_by_state(self, state: "JobState") -> "List[Job]":
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path, state, attempts, last_error, chapter_id, session_id, next_attempt, updated "
+                "FROM jobs WHERE state = ?",
+                (state.value,),
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def add(self, to_upload: "Path") -> "Job":
+        """Add the chapter as pending, a chapter archived before is a new upload."""
+        job = self.get(to_upload)
+        if job is not None and job.state != JobState.ARCHIVED:
+            return job
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO jobs (path, state, attempts, updated) VALUES (?, ?, 0, ?)",
+                (str(to_upload), JobState.PENDING.value, time.time()),
+            )
+            self._connection.commit()
+        return self.get(to_upload)
+
+    def set_state(
+        self,
+        to_upload: "Path",
+        state: "JobState",
+        error: "Optional[str]" = None,
+        chapter_id: "Optional[str]" = None,
+        session_id: "Optional[str]" = None,
+    ):
+        now = time.time()
+        with self._lock:
+            if state == JobState.PREPARING:
+                self._connection.execute(
+                    "UPDATE jobs SET state = ?, attempts = attempts + 1, updated = ? WHERE path = ?",
+                    (state.value, now, str(to_upload)),
+                )
+            elif state == JobState.FAILED:
+                # A chapter sent for commit may be on MangaDex already, it must not be uploaded again
+                cursor = self._connection.execute(
+                    "UPDATE jobs SET state = ?, last_error = ?, updated = ?, "
+                    "next_attempt = ? * (1 << MAX(attempts - 1, 0)) + ? "
+                    "WHERE path = ? AND state NOT IN (?, ?)",
+                    (state.value, error, now, self.retry_delay, now, str(to_upload))
+                    + (JobState.COMMITTING.value, JobState.COMMITTED.value),
+                )
+                if not cursor.rowcount:
+                    self._connection.commit()
+                    logger.debug("Job %s wasn't marked as failed: %s", to_upload, error)
+                    return
+            else:
+                self._connection.execute(
+                    "UPDATE jobs SET state = ?, "
+                    "chapter_id = COALESCE(?, chapter_id), "
+                    "session_id = COALESCE(?, session_id), "
+                    "updated = ? WHERE path = ?",
+                    (state.value, chapter_id, session_id, now, str(to_upload)),
+                )
+            self._connection.commit()
+        logger.debug("Job %s is now %s.", to_upload, state.value)
+
+    def should_upload(self, to_upload: "Path") -> "bool":
+        """Check if the chapter needs to be uploaded now."""
+        job = self.get(to_upload)
+        if job is None or job.state == JobState.ARCHIVED:
+            return True
+        if job.state in (JobState.COMMITTING, JobState.COMMITTED):
+            return False
+        if job.state == JobState.FAILED:
+            return self.retry_due(job)
+        return True
+
+    def retry_due(self, job: "Job") -> "bool":
+        return job.attempts < self.max_attempts and job.next_attempt <= time.time()
+
+    def next_retry(self, paths: "Iterable[Path]") -> "Optional[float]":
+        """Get when the next of the failed chapters can be retried."""
+        retries = []
+        for path in paths:
+            job = self.get(path)
+            if job is not None and job.state == JobState.FAILED and job.attempts < self.max_attempts:
+                retries.append(job.next_attempt)
+        return min(retries) if retries else None
+
+    def reset(self, to_upload: "Path"):
+        """Upload the chapter again from the start, whatever its state."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET state = ?, attempts = 0, next_attempt = 0, session_id = NULL, "
+                "updated = ? WHERE path = ?",
+                (JobState.PENDING.value, time.time(), str(to_upload)),
+            )
+            self._connection.commit()
+        logger.debug("Job %s was reset.", to_upload)
+
+    def reset_attempts(self, paths: "Iterable[Path]"):
+        """Start a new run, failed chapters get all their attempts again."""
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE jobs SET attempts = 0, next_attempt = 0 WHERE path = ? AND state = ?",
+                [(str(path), JobState.FAILED.value) for path in paths],
+            )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,266 @@
+import errno
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+# Folder in the upload folder holding the leases, hidden from the scan
+LEASES_FOLDER = ".mupl-leases"
+
+
+class Lease(NamedTuple):
+    owner: "str"
+    token: "str"
+    path: "str"
+    expires: "float"
+    # Committed chapters keep their lease until they leave the upload folder
+    committed: "bool" = False
+
+    def to_dict(self) -> "dict":
+        return self._asdict()
+
+
+class LeaseManager:
+    """Claims chapters of an upload folder shared by several hosts, so each
+    chapter is uploaded by one host only.
+
+    A lease is a file created atomically in the leases folder of the upload
+    folder. The holder renews it while uploading; if the host crashes, the
+    lease expires and another host takes the chapter over. Hosts need their
+    clocks in sync, within a small part of the lease time."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.uploads_folder: "Optional[Path]" = None
+        self.lease_time = 300.0
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._held: "Dict[str, Lease]" = {}
+        self._stop_event = threading.Event()
+        self._heartbeat: "Optional[threading.Thread]" = None
+
+    @property
+    def leases_folder(self) -> "Path":
+        return self.uploads_folder.joinpath(LEASES_FOLDER)
+
+    def configure(self, uploads_folder: "Path", enabled: "bool", lease_time: "float"):
+        self.uploads_folder = uploads_folder
+        self.enabled = enabled
+        self.lease_time = lease_time
+
+    def _key(self, to_upload: "Path") -> "str":
+        """Same for every host, wherever they mount the upload folder."""
+        try:
+            relative_path = to_upload.relative_to(self.uploads_folder).as_posix()
+        except ValueError:
+            relative_path = to_upload.as_posix()
+        return relative_path
+
+    def _lease_path(self, key: "str") -> "Path":
+        return self.leases_folder.joinpath(hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _read(self, lease_path: "Path") -> "Optional[Lease]":
+        try:
+            return Lease(**json_codec.load_file(lease_path))
+        except FileNotFoundError:
+            return None
+        except (json_codec.JSONDecodeError, TypeError):
+            pass
+        # Still being written by another host, or left half written by one that crashed,
+        # it is held until the lease time passed since it was last written
+        try:
+            modified = lease_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        return Lease("", "", "", modified + self.lease_time)
+
+    def _write(self, lease_path: "Path", lease: "Lease"):
+        temp_path = lease_path.with_name(f"{lease_path.name}.{self.owner}.tmp")
+        temp_path.write_text(json_codec.dumps(lease.to_dict()), encoding="utf-8")
+        os.replace(temp_path, lease_path)
+
+    def _create(self, lease_path: "Path", lease: "Lease") -> "bool":
+        """Create the lease file, False if another host has one.
+
+        The lease is written to a temporary file and linked to its name, so it
+        only appears once complete and the link fails if a lease exists."""
+        temp_path = lease_path.with_name(f"{lease_path.name}.{self.owner}.new")
+        try:
+            temp_path.write_text(json_codec.dumps(lease.to_dict()), encoding="utf-8")
+            try:
+                os.link(temp_path, lease_path)
+                return True
+            except FileExistsError:
+                return False
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    return False
+                # Links aren't supported by the file system, a lease read while
+                # it is written is held until the lease time passed
+                logger.debug(f"Couldn't link the lease of {lease.path}, creating it instead: {e}")
+
+            try:
+                lease_file = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+            with os.fdopen(lease_file, "w", encoding="utf-8") as lease_file:
+                lease_file.write(json_codec.dumps(lease.to_dict()))
+            return True
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    def _take_over(self, lease_path: "Path", stale: "Lease") -> "bool":
+        """Remove an expired lease, False if another host got to it first."""
+        stale_path = lease_path.with_name(f"{lease_path.name}.{self.owner}.stale")
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+        taken = self._read(stale_path)
+        if taken is not None and taken.token != stale.token:
+            # Another host took it over meanwhile, give its lease back
+            try:
+                os.link(stale_path, lease_path)
+            except OSError:
+                pass
+            stale_path.unlink(missing_ok=True)
+            return False
+        stale_path.unlink(missing_ok=True)
+        return True
+
+    def claim(self, to_upload: "Path") -> "bool":
+        """Claim the chapter for this host, False if another host has it."""
+        if not self.enabled:
+            return True
+
+        key = self._key(to_upload)
+        lease_path = self._lease_path(key)
+        lease = Lease(self.owner, uuid.uuid4().hex, key, time.time() + self.lease_time)
+        self.leases_folder.mkdir(parents=True, exist_ok=True)
+
+        for _ in range(3):
+            if self._create(lease_path, lease):
+                break
+
+            current = self._read(lease_path)
+            if current is None:
+                continue
+            if current.committed:
+                if to_upload.exists():
+                    return False
+                # Archived since, the lease is left over
+                self._take_over(lease_path, current)
+                return False
+            if current.expires > time.time():
+                return False
+
+            logger.info(f"The lease of {key} by {current.owner} expired, taking it over.")
+            if not self._take_over(lease_path, current):
+                return False
+        else:
+            return False
+
+        # Archived by another host before the lease was taken
+        if not to_upload.exists():
+            lease_path.unlink(missing_ok=True)
+            return False
+
+        with self._lock:
+            self._held[key] = lease
+        self._start_heartbeat()
+        logger.debug(f"Claimed {key}.")
+        return True
+
+    def held(self, to_upload: "Path") -> "bool":
+        """Whether the lease of the chapter is still this host's."""
+        if not self.enabled:
+            return True
+        key = self._key(to_upload)
+        with self._lock:
+            lease = self._held.get(key)
+        if lease is None:
+            return False
+        current = self._read(self._lease_path(key))
+        return current is not None and current.token == lease.token
+
+    def mark_committed(self, to_upload: "Path"):
+        """Keep the lease after the commit, until the chapter leaves the upload folder."""
+        if not self.enabled:
+            return
+        key = self._key(to_upload)
+        with self._lock:
+            lease = self._held.get(key)
+            if lease is None:
+                return
+            lease = self._held[key] = lease._replace(committed=True)
+        try:
+            self._write(self._lease_path(key), lease)
+        except OSError as e:
+            logger.warning(f"Couldn't mark the lease of {key} as committed: {e}")
+
+    def release(self, to_upload: "Path"):
+        """Give the chapter back, committed chapters still in the upload folder stay claimed."""
+        if not self.enabled:
+            return
+        key = self._key(to_upload)
+        with self._lock:
+            lease = self._held.pop(key, None)
+        if lease is None:
+            return
+
+        lease_path = self._lease_path(key)
+        current = self._read(lease_path)
+        if current is None or current.token != lease.token:
+            return
+        if lease.committed and to_upload.exists():
+            return
+        lease_path.unlink(missing_ok=True)
+        logger.debug(f"Released {key}.")
+
+    def release_all(self):
+        with self._lock:
+            keys = list(self._held)
+        for key in keys:
+            self.release(self.uploads_folder.joinpath(key))
+        self._stop_event.set()
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None and self._heartbeat.is_alive():
+                return
+            self._stop_event.clear()
+            self._heartbeat = threading.Thread(target=self._renew_leases, name="leases", daemon=True)
+            self._heartbeat.start()
+
+    def _renew_leases(self):
+        """Renew the held leases three times per lease time."""
+        while not self._stop_event.wait(self.lease_time / 3):
+            with self._lock:
+                held = list(self._held.items())
+            for key, lease in held:
+                lease_path = self._lease_path(key)
+                current = self._read(lease_path)
+                if current is None or current.token != lease.token:
+                    logger.warning(f"Lost the lease of {key}, another host took it over.")
+                    continue
+                renewed = lease._replace(expires=time.time() + self.lease_time)
+                try:
+                    self._write(lease_path, renewed)
+                except OSError as e:
+                    logger.warning(f"Couldn't renew the lease of {key}: {e}")
+                    continue
+                with self._lock:
+                    if key in self._held:
+                        self._held[key] = renewed._replace(committed=self._held[key].committed)
+
+
+chapter_leases = LeaseManager()
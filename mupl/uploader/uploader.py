@@ -1,22 +1,19 @@
 import asyncio
 import logging
-import os
 import time
 from datetime import datetime
 from pathlib import Path
-
-from tqdm import tqdm
+from typing import Optional
 
 from mupl.file_validator import FileProcesser
+from mupl.http import RequestError
 from mupl.http.client import HTTPClient
+from mupl.uploader.archiver import archiver
 from mupl.uploader.handler import ChapterUploaderHandler
-from mupl.utils.config import (
-    NUMBER_THREADS,
-    VERBOSE,
-    config,
-    RATELIMIT_TIME,
-    translate_message
-)
+from mupl.uploader.jobs import JobQueue, JobState
+from mupl.utils.events import EventType, emit, emit_message
+from mupl.utils.config import context
+from mupl.utils.memory import memory_budget
 
 logger = logging.getLogger("mupl")
 
@@ -29,16 +26,18 @@ class ChapterUploader(ChapterUploaderHandler):
         names_to_ids: "dict",
         failed_uploads: "list",
         threaded: "bool",
+        job_queue: "Optional[JobQueue]" = None,
     ):
-        super().__init__(http_client, file_name_obj, failed_uploads)
+        super().__init__(http_client, file_name_obj, failed_uploads, job_queue)
         self.names_to_ids = names_to_ids
         self.threaded = threaded
-        if NUMBER_THREADS <= 1:
+        if context.number_threads <= 1:
             self.threaded = False
 
-        self.uploaded_files_path = Path(config["paths"]["uploaded_files"])
-        self.ratelimit_time = RATELIMIT_TIME
+        self.uploaded_files_path = Path(context.config["paths"]["uploaded_files"])
+        self.ratelimit_time = context.ratelimit_time
         self.myzip = self.image_uploader_process.myzip
+        memory_budget.configure(context.memory_budget)
 
     @staticmethod
     def create_new_event_loop():
@@ -53,35 +52,22 @@ class ChapterUploader(ChapterUploaderHandler):
             else:
                 raise
 
-    def move_files(self):
-        """Move the uploaded chapters to a different folder."""
-        to_upload_folder_path = Path(config["paths"]["uploads_folder"])
-        self.uploaded_files_path.mkdir(parents=True, exist_ok=True)
+    def move_files(self) -> "bool":
+        """Move the uploaded chapter to a different folder, return False if it couldn't be moved.
+        Moves to another device and packing finish in the background."""
+        to_upload_folder_path = Path(context.config["paths"]["uploads_folder"])
+        archiver.configure(
+            to_upload_folder_path, self.uploaded_files_path, context.archive_pack_folders
+        )
         # Folders don't have an extension
         if self.folder_upload:
             zip_name = self.zip_name
         else:
             zip_name = self.zip_name.rsplit(".", 1)[0]
+            # The file can't be moved on every system while it is open
+            self.close()
         zip_extension = self.zip_extension or ""
-        zip_path_str = f"{zip_name}{zip_extension}"
-        version = 1
-
-        # If a file/folder with that name exists already in the uploaded files path
-        # Add a version number to the end before moving
-        while True:
-            version += 1
-            if zip_path_str in os.listdir(self.uploaded_files_path):
-                if self.folder_upload:
-                    zip_name_unformat = self.zip_name
-                else:
-                    zip_name_unformat = self.zip_name.rsplit(".", 1)[0]
 
-                zip_name = f"{zip_name_unformat}{{v{version}}}"
-                zip_path_str = f"{zip_name}{zip_extension}"
-                continue
-            else:
-                break
-        
         def check_to_upload_metod(parts):
             # Define the variables
             language = None
@@ -143,9 +129,11 @@ class ChapterUploader(ChapterUploaderHandler):
                 
             return language, manga_series, groups, volume_number, chapter_number, chapter_title
 
-        # Retrieve the parts from "to_upload" and remove everything before "to_upload"
-        index_to_upload = self.to_upload.parts.index('to_upload')
-        parts = self.to_upload.parts[index_to_upload:]
+        # Parts from the upload folder on, e.g. (to_upload, [en], group, title, v01, 0001)
+        try:
+            parts = (to_upload_folder_path.name,) + self.to_upload.relative_to(to_upload_folder_path).parts
+        except ValueError:
+            parts = (self.to_upload.name,)
 
         # Check the number of parts to determine the method used. If it's 2,
         # use the normal method; if it's more than 3, use the tree method
@@ -157,44 +145,44 @@ class ChapterUploader(ChapterUploaderHandler):
             chapter_title = f" ({chapter_title})" if chapter_title else ""
             groups = f" [{groups}]" if groups else "[0]"
             
-            text = f"{manga_series} {language} - {chapter_number}{volume_number}{chapter_title}{groups}"
-            
-            try:
-                new_uploaded_zip_path = self.to_upload.rename(
-                    os.path.join(self.uploaded_files_path, f"{text}")
-                )
-                logger.debug(f"Moved {self.to_upload} to {new_uploaded_zip_path}.")
-            except:
-                print("File already exists: " + text)
-        
-            def delete_empty_folders(folder_path):
-                # Recursively traverse the directory tree
-                for root, dirs, files in os.walk(folder_path, topdown=False):
-                    for dir_name in dirs:
-                        dir_path = os.path.join(root, dir_name)
-                        
-                        # Check if the folder is empty
-                        if not os.listdir(dir_path):
-                            # Delete the empty folder
-                            os.rmdir(dir_path)
-
-            delete_empty_folders(to_upload_folder_path)
-            
-        else:
-            new_uploaded_zip_path = self.to_upload.rename(
-                os.path.join(self.uploaded_files_path, f"{zip_name}{zip_extension}")
+            zip_name = f"{manga_series} {language} - {chapter_number}{volume_number}{chapter_title}{groups}"
+            zip_extension = ""
+
+        return archiver.archive(self.to_upload, zip_name, zip_extension) is not None
+
+    def _upload_batch(self, images_array):
+        """Read and upload a batch of images once it fits in the memory budget."""
+        batch_size = self.image_uploader_process.get_batch_size(images_array)
+        with memory_budget.reserve("batch", batch_size) as reservation:
+            images_to_upload = self.image_uploader_process.get_images_to_upload(
+                images_array, reservation
             )
-            logger.debug(f"Moved {self.to_upload} to {new_uploaded_zip_path}.")
+            failed = self._upload_images(images_to_upload)
+            # Drop the page bytes before the room is given back
+            images_to_upload.clear()
+        if failed:
+            self.failed_image_upload = True
+
+    def _batch_groups(self):
+        """Batches sent together, up to the number of threads and fewer when
+        the memory budget is close."""
+        group, group_size = [], 0
+        for images_array in self.image_uploader_process.valid_images_to_upload:
+            batch_size = self.image_uploader_process.get_batch_size(images_array)
+            if group and (
+                len(group) >= context.number_threads
+                or not memory_budget.fits(group_size + batch_size)
+            ):
+                yield group
+                group, group_size = [], 0
+            group.append(images_array)
+            group_size += batch_size
+        if group:
+            yield group
 
     async def process_images_upload(self, images_array):
         """Start uploading the images, threaded."""
-        images_to_upload = self.image_uploader_process.get_images_to_upload(
-            images_array
-        )
-        failed = self._upload_images(images_to_upload)
-        if failed:
-            self.failed_image_upload = True
-            asyncio.get_running_loop().close()
+        self._upload_batch(images_array)
 
     def run_threaded_uploader(self, spliced_images):
         """Run the threads for upload."""
@@ -210,30 +198,24 @@ class ChapterUploader(ChapterUploaderHandler):
         try:
             loop.run_until_complete(gathered)
         except KeyboardInterrupt as e:
-            print(translate_message['keyboard_interrupt_cancel'])
+            print(context.translate_message['keyboard_interrupt_cancel'])
             gathered.cancel()
             self.failed_image_upload = True
 
     def run_image_uploader(self, images):
         """Run the image mupl ."""
         for images_array in images:
-            images_to_upload = self.image_uploader_process.get_images_to_upload(
-                images_array
-            )
-            failed = self._upload_images(images_to_upload)
-            if failed:
-                self.failed_image_upload = True
+            self._upload_batch(images_array)
 
             # Don't upload rest of the chapter's images if the images before failed
             if self.failed_image_upload:
                 break
 
-            # self.tqdm.update(len(images_to_upload))
-
     def upload(self):
         """Process the zip for uploading."""
         logger.info(f"Uploading chapter: {repr(self.file_name_obj)}")
-        print(
+        emit_message(
+            str(self.to_upload),
             "Manga ID: {manga_series}\n"
             "{chapter_number_manga}: {chapter_number}\n"
             "{volume_number_manga}: {volume_number}\n"
@@ -243,27 +225,34 @@ class ChapterUploader(ChapterUploaderHandler):
             "{publish_date_manga}: {publish_date}".format(
                 manga_series=self.file_name_obj.manga_series,
                 chapter_number=self.file_name_obj.chapter_number,
-                volume_number=self.file_name_obj.volume_number if self.file_name_obj.volume_number is not None else translate_message['not_defined_value'],
-                chapter_title=self.file_name_obj.chapter_title if self.file_name_obj.chapter_title is not None else translate_message['not_defined_value'],
+                volume_number=self.file_name_obj.volume_number if self.file_name_obj.volume_number is not None else context.translate_message['not_defined_value'],
+                chapter_title=self.file_name_obj.chapter_title if self.file_name_obj.chapter_title is not None else context.translate_message['not_defined_value'],
                 language=self.file_name_obj.language.upper(),
-                groups=self.file_name_obj.groups if self.file_name_obj.groups is not None else translate_message['not_defined_value'],
-                publish_date=self.file_name_obj.publish_date if self.file_name_obj.publish_date is not None else translate_message['not_defined_value'],
-                chapter_number_manga=translate_message["chapter_number_manga"],
-                volume_number_manga=translate_message["volume_number_manga"],
-                chapter_title_manga=translate_message["chapter_title_manga"],
-                language_manga=translate_message["language_manga"],
-                groups_manga=translate_message["groups_manga"],
-                publish_date_manga=translate_message["publish_date_manga"]
+                groups=self.file_name_obj.groups if self.file_name_obj.groups is not None else context.translate_message['not_defined_value'],
+                publish_date=self.file_name_obj.publish_date if self.file_name_obj.publish_date is not None else context.translate_message['not_defined_value'],
+                chapter_number_manga=context.translate_message["chapter_number_manga"],
+                volume_number_manga=context.translate_message["volume_number_manga"],
+                chapter_title_manga=context.translate_message["chapter_title_manga"],
+                language_manga=context.translate_message["language_manga"],
+                groups_manga=context.translate_message["groups_manga"],
+                publish_date_manga=context.translate_message["publish_date_manga"]
             )
         )
 
+        self._set_job_state(JobState.PREPARING)
         if not self.image_uploader_process.valid_images_to_upload:
-            print(translate_message['invalid_images_to_upload'])
+            emit_message(str(self.to_upload), context.translate_message['invalid_images_to_upload'])
             logger.error(f"No valid images found for {self.zip_name}")
-            self.failed_uploads.append(self.to_upload)
+            self._upload_failed("No valid images to upload.")
             return
 
-        self.http_client.login()
+        try:
+            self.http_client.login()
+        except RequestError as e:
+            # The api is failing, the chapter is tried again once it works
+            logger.error(e)
+            self._upload_failed("Couldn't login.")
+            return
 
         upload_session_response_json = self._create_upload_session()
         if upload_session_response_json is None:
@@ -271,14 +260,19 @@ class ChapterUploader(ChapterUploaderHandler):
             return
 
         self.upload_session_id = upload_session_response_json["data"]["id"]
+        self._set_job_state(JobState.UPLOADING, session_id=self.upload_session_id)
 
         logger.info(
             "Created upload session: {self.upload_session_id}, {self.zip_name}."
         )
-        print(f"{translate_message['draft_create_session']}".format(self.upload_session_id))
-        if VERBOSE:
-            print(
-                f"{translate_message['images_to_upload']}".format(
+        emit_message(
+            str(self.to_upload),
+            f"{context.translate_message['draft_create_session']}".format(self.upload_session_id),
+        )
+        if context.verbose:
+            emit_message(
+                str(self.to_upload),
+                f"{context.translate_message['images_to_upload']}".format(
                     len(
                         [
                             item
@@ -289,44 +283,45 @@ class ChapterUploader(ChapterUploaderHandler):
                 )
             )
 
-        self.tqdm = tqdm(total=len(self.image_uploader_process.info_list))
+        emit(
+            EventType.SESSION_CREATED,
+            str(self.to_upload),
+            pages=len(self.image_uploader_process.info_list),
+            detail=self.upload_session_id,
+        )
 
         if self.threaded:
-            if VERBOSE:
-                print(translate_message['threaded_upload_runing'])
-
-            spliced_images_list = [
-                self.image_uploader_process.valid_images_to_upload[
-                    elem : elem + NUMBER_THREADS
-                ]
-                for elem in range(
-                    0,
-                    len(self.image_uploader_process.valid_images_to_upload),
-                    NUMBER_THREADS,
+            if context.verbose:
+                emit_message(
+                    str(self.to_upload),
+                    context.translate_message['threaded_upload_runing'],
                 )
-            ]
 
-            for spliced_images in spliced_images_list:
+            for spliced_images in self._batch_groups():
                 self.run_threaded_uploader(spliced_images)
                 if self.failed_image_upload:
                     break
         else:
-            if VERBOSE:
-                print(translate_message['threaded_upload_non_runing'])
+            if context.verbose:
+                emit_message(
+                    str(self.to_upload),
+                    context.translate_message['threaded_upload_non_runing'],
+                )
             self.run_image_uploader(self.image_uploader_process.valid_images_to_upload)
 
-        self.tqdm.close()
-        if not self.folder_upload:
-            self.myzip.close()
+        self.close()
 
         # Skip chapter upload and delete upload session
         if self.failed_image_upload:
-            print(translate_message['draft_deleting_failed_uplaod'])
+            emit_message(
+                str(self.to_upload),
+                context.translate_message['draft_deleting_failed_uplaod'],
+            )
             logger.error(
                 f"Deleting draft due to failed image upload: {self.upload_session_id}, {self.zip_name}."
             )
             self.remove_upload_session()
-            self.failed_uploads.append(self.to_upload)
+            self._upload_failed("Some images failed to upload.")
             return
 
         logger.info("Uploaded all of the chapter's images.")
@@ -1 +1 @@
-from mupl.utils.logs import setup_logs
+from mupl.utils.logs import setup_logs, start_logging
@@ -1,34 +1,42 @@
 import os
-import json
 import logging
 from pathlib import Path
+from typing import Optional
+
+from mupl.utils import json_codec
 
 logger = logging.getLogger("mupl")
 
-root_path = Path(os.path.join(Path.home(), 'MangaDex Uploader (APP)'))
+# MUPL_ROOT points the uploader at another config folder, e.g. for a local test api
+root_path = Path(os.environ.get("MUPL_ROOT", os.path.join(Path.home(), 'MangaDex Uploader (APP)')))
 
 
 def open_defaults_file(defaults_path: "Path") -> "dict":
     try:
-        with open(
-            defaults_path,
-            "r",
-            encoding="utf-8",
-        ) as json_file:
-            return json.load(json_file)
-    except (FileNotFoundError, json.JSONDecodeError):
+        return json_codec.load_file(defaults_path)
+    except (FileNotFoundError, json_codec.JSONDecodeError):
         return {}
 
 
+# Options where 0 is a valid value rather than a missing one
+ZERO_OPTIONS = ("upload_retry_passes", "retry_pass_delay")
+# Options that may have a fraction, e.g. 2.5, though their defaults are whole numbers
+FLOAT_OPTIONS = ("upload_bandwidth_limit",)
+
+
 def load_config_info(config: "dict", defaults: "dict"):
     """Check if the config file has the needed data, if not, use the default values."""
     for section in defaults:
         for option in defaults[section]:
-            if option not in config[section] or not config[section].get(option):
+            value = config[section].get(option)
+            if not value and not (option in ZERO_OPTIONS and value == 0):
                 logger.debug(f"Using default value for config {section}: {option}")
                 config[section][option] = defaults[section][option]
 
-            if type(config[section][option]) != type(defaults[section][option]):
+            value = config[section][option]
+            if option in FLOAT_OPTIONS and type(value) in (int, float):
+                pass
+            elif type(value) != type(defaults[section][option]):
                 config[section][option] = defaults[section][option]
 
             # Threads can't exceed default value
@@ -48,7 +56,7 @@ def open_config_file(root_path: "Path") -> "dict":
     defaults_file = open_defaults_file(defaults_path)
 
     if os.path.exists(config_file_path):
-        config = json.loads(config_file_path.read_bytes())
+        config = json_codec.loads(config_file_path.read_bytes())
     else:
         logger.critical("Config file not found, exiting.")
         raise FileNotFoundError("Config file not found.")
@@ -59,21 +67,108 @@ def open_config_file(root_path: "Path") -> "dict":
 
 def load_language(lang):
     defaults_path = Path(".").joinpath("mupl", "loc", lang).with_suffix(".json")
-    with open(
-            defaults_path,
-            "r",
-            encoding="utf-8",
-        ) as json_file:
-            return json.load(json_file)
-
-config = open_config_file(root_path)
-
-NUMBER_OF_IMAGES_UPLOAD = config["options"]["number_of_images_upload"]
-UPLOAD_RETRY = config["options"]["upload_retry"]
-RATELIMIT_TIME = config["options"]["ratelimit_time"]
-MAX_LOG_DAYS = config["options"]["max_log_days"]
-NUMBER_THREADS = config["options"]["number_threads"]
-mangadex_api_url = config["paths"]["mangadex_api_url"]
-mangadex_auth_url = config["paths"]["mangadex_auth_url"]
-translate_message = load_language(config['options']['language_default'])
-VERBOSE = False
+    return json_codec.load_file(defaults_path)
+
+
+class ConfigContext:
+    """Settings of the uploader, read from the config and translation files on first use,
+    so importing mupl doesn't touch the disk or fail without a config."""
+
+    # Option name to its default, for the options that may be missing from older configs
+    OPTIONS = {
+        "number_of_images_upload": None,
+        "upload_retry": None,
+        "ratelimit_time": None,
+        "max_log_days": None,
+        "number_threads": None,
+        "log_max_size": 10,
+        "log_backup_count": 5,
+        "log_request_sample_rate": 10,
+        "upload_retry_passes": 2,
+        "retry_pass_delay": 60,
+        "watch_settle_time": 10,
+        "watch_poll_interval": 30,
+        "watch_marker_file": ".ready",
+        "upload_bandwidth_limit": 0,
+        "upload_bandwidth_schedule": (),
+        "circuit_breaker_error_rate": 50,
+        "circuit_breaker_open_time": 60,
+        "retry_budget_percent": 20,
+        "id_cache_ttl": 86400,
+        "resolve_names": False,
+        "resolve_names_write_map": False,
+        "archive_pack_folders": False,
+        "shared_upload_folder": False,
+        "lease_time": 300,
+        "upload_order": ["priority"],
+        "memory_budget": 512,
+    }
+    # Path name to its default, relative to the root path
+    ROOT_PATHS = {
+        "scan_index_path": ".scan_index",
+        "job_queue_path": ".upload_jobs",
+        "upload_stats_path": ".upload_stats",
+        "id_cache_path": ".id_cache",
+        "resolver_cache_path": ".name_resolver",
+    }
+
+    def __init__(self, root_path: "Path") -> None:
+        self.root_path = root_path
+        self.verbose = False
+        self._config: "Optional[dict]" = None
+        self._translate_message: "Optional[dict]" = None
+
+    def reload(self):
+        """Read the config and translation files again on their next use."""
+        self._config = None
+        self._translate_message = None
+
+    @property
+    def config(self) -> "dict":
+        if self._config is None:
+            self._config = open_config_file(self.root_path)
+        return self._config
+
+    @property
+    def translate_message(self) -> "dict":
+        if self._translate_message is None:
+            self._translate_message = load_language(self.config["options"]["language_default"])
+        return self._translate_message
+
+    @property
+    def mangadex_api_url(self) -> "str":
+        return self.config["paths"]["mangadex_api_url"]
+
+    @property
+    def mangadex_auth_url(self) -> "str":
+        return self.config["paths"]["mangadex_auth_url"]
+
+    def __getattr__(self, name: "str"):
+        # Only called for the names that aren't regular attributes
+        if name in self.OPTIONS:
+            default = self.OPTIONS[name]
+            options = self.config["options"]
+            return options[name] if default is None else options.get(name, default)
+        if name in self.ROOT_PATHS:
+            return self.root_path.joinpath(self.config["paths"].get(name, self.ROOT_PATHS[name]))
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+
+context = ConfigContext(root_path)
+
+# Module constants of earlier versions, now read from the context when they are imported
+_CONTEXT_NAMES = {
+    "config": "config",
+    "translate_message": "translate_message",
+    "VERBOSE": "verbose",
+    "mangadex_api_url": "mangadex_api_url",
+    "mangadex_auth_url": "mangadex_auth_url",
+    **{name.upper(): name for name in ConfigContext.OPTIONS},
+    **{name.upper(): name for name in ConfigContext.ROOT_PATHS},
+}
+
+
+def __getattr__(name: "str"):
+    if name in _CONTEXT_NAMES:
+        return getattr(context, _CONTEXT_NAMES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,364 @@
+import abc
+import collections
+import enum
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+# Seconds between deliveries of the queued events to the sinks
+FLUSH_INTERVAL = 0.2
+# Queued events past which the frequent ones are summed or dropped, e.g. while a sink is stalled
+MAX_QUEUED = 10000
+
+
+class EventType(enum.Enum):
+    CHAPTER_QUEUED = "chapter_queued"
+    SESSION_CREATED = "session_created"
+    BYTES_SENT = "bytes_sent"
+    BATCH_SENT = "batch_sent"
+    PAGE_CONVERTED = "page_converted"
+    COMMIT_DONE = "commit_done"
+    FAILURE = "failure"
+    # Text for the user about the chapter, such as a failed batch
+    MESSAGE = "message"
+
+
+class Event(NamedTuple):
+    type: "EventType"
+    chapter: "Optional[str]"
+    time: "float"
+    # Pages of the chapter for queued and session created, of the batch for batch sent
+    pages: "int" = 0
+    size: "int" = 0
+    page: "Optional[str]" = None
+    # Session id, chapter id, new image format, error message or message text
+    detail: "Optional[str]" = None
+
+    def to_dict(self) -> "dict":
+        event = {"type": self.type.value, "chapter": self.chapter, "time": self.time}
+        for field in ("pages", "size", "page", "detail"):
+            value = getattr(self, field)
+            if value:
+                event[field] = value
+        return event
+
+    @classmethod
+    def from_dict(cls, event: "dict") -> "Event":
+        return cls(
+            type=EventType(event["type"]),
+            chapter=event.get("chapter"),
+            time=event.get("time", 0.0),
+            pages=event.get("pages", 0),
+            size=event.get("size", 0),
+            page=event.get("page"),
+            detail=event.get("detail"),
+        )
+
+
+# Summed per chapter past MAX_QUEUED, their totals are kept
+COALESCED_EVENTS = (EventType.BYTES_SENT, EventType.BATCH_SENT)
+# Dropped past MAX_QUEUED
+DROPPED_EVENTS = (EventType.PAGE_CONVERTED, EventType.MESSAGE)
+
+
+class EventSink(abc.ABC):
+    """Receives the events in batches, on the event bus thread."""
+
+    @abc.abstractmethod
+    def handle(self, events: "List[Event]"):
+        pass
+
+    def close(self):
+        pass
+
+
+class EventBus:
+    """Progress events of the upload.
+
+    Emitting only appends to a queue, a background thread hands the queued
+    events to the sinks a few times a second, so slow sinks such as the
+    terminal never hold up the upload.
+
+    A stalled sink can't grow the queue without bound: past max_queued
+    events, the sent bytes and batches are summed per chapter until the
+    queue is delivered, and the page conversions and messages are dropped
+    with a warning. The chapter events, a few per chapter, are always kept."""
+
+    def __init__(self, flush_interval: "float" = FLUSH_INTERVAL, max_queued: "int" = MAX_QUEUED) -> None:
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self.enabled = False
+        self.sinks: "List[EventSink]" = []
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        # Event type and chapter to the summed event, while the queue is full
+        self._coalesced: "Dict[tuple, Event]" = {}
+        self._dropped = 0
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: "Optional[threading.Thread]" = None
+
+    def add_sink(self, sink: "EventSink"):
+        self.sinks.append(sink)
+
+    def start(self):
+        if self._thread is not None or not self.sinks:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="mupl-events", daemon=True)
+        self._thread.start()
+        self.enabled = True
+
+    def stop(self):
+        """Deliver the remaining events and close the sinks."""
+        if self._thread is None:
+            return
+        self.enabled = False
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logger.error(f"Couldn't close the event sink {sink}: {e}")
+        self.sinks = []
+
+    def emit(self, event: "Event"):
+        if event.type in COALESCED_EVENTS or event.type in DROPPED_EVENTS:
+            if len(self._queue) < self.max_queued:
+                self._queue.append(event)
+                return
+            with self._lock:
+                if event.type in DROPPED_EVENTS:
+                    self._dropped += 1
+                    return
+                key = (event.type, event.chapter)
+                summed = self._coalesced.get(key)
+                if summed is not None:
+                    event = summed._replace(
+                        time=event.time, pages=summed.pages + event.pages, size=summed.size + event.size
+                    )
+                self._coalesced[key] = event
+            return
+
+        if self._coalesced:
+            # The summed events of the chapter go before its next event, e.g. its commit
+            with self._lock:
+                for key in [key for key in self._coalesced if key[1] == event.chapter]:
+                    self._queue.append(self._coalesced.pop(key))
+                self._queue.append(event)
+            return
+        self._queue.append(event)
+
+    def _release_coalesced(self):
+        """Queue the summed events, after every event queued before them."""
+        with self._lock:
+            self._queue.extend(self._coalesced.values())
+            self._coalesced.clear()
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            logger.warning(f"Dropped {dropped} progress events, the event sinks fell behind.")
+
+    def flush(self, timeout: "float" = 1.0):
+        """Wait until the events emitted so far reached the sinks."""
+        if self._thread is None:
+            return
+        delivered = threading.Event()
+        self._release_coalesced()
+        self._queue.append(delivered)
+        self._wake.set()
+        delivered.wait(timeout)
+
+    def _deliver(self):
+        self._release_coalesced()
+        events: "List[Event]" = []
+        while self._queue:
+            item = self._queue.popleft()
+            if isinstance(item, Event):
+                events.append(item)
+                continue
+
+            # A flush is waiting for the events before it
+            self._send(events)
+            events = []
+            item.set()
+        self._send(events)
+
+    def _send(self, events: "List[Event]"):
+        if not events:
+            return
+        for sink in self.sinks:
+            try:
+                sink.handle(events)
+            except Exception as e:
+                logger.exception(f"Event sink {sink} failed: {e}")
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._deliver()
+        self._deliver()
+
+
+class TerminalSink(EventSink):
+    """Progress bar of the pages of the chapter being uploaded, with the messages
+    of the upload written above it."""
+
+    def __init__(self) -> None:
+        self._bars: "Dict[str, object]" = {}
+
+    def handle(self, events: "List[Event]"):
+        from tqdm import tqdm
+
+        pages_sent: "Dict[str, int]" = {}
+        for event in events:
+            if event.type == EventType.SESSION_CREATED:
+                self._update(pages_sent)
+                self._bars[event.chapter] = tqdm(total=event.pages)
+            elif event.type == EventType.BATCH_SENT:
+                pages_sent[event.chapter] = pages_sent.get(event.chapter, 0) + event.pages
+            elif event.type in (EventType.COMMIT_DONE, EventType.FAILURE):
+                self._update(pages_sent)
+                bar = self._bars.pop(event.chapter, None)
+                if bar is not None:
+                    bar.close()
+            elif event.type == EventType.MESSAGE:
+                self._update(pages_sent)
+                tqdm.write(event.detail or "")
+        self._update(pages_sent)
+
+    def _update(self, pages_sent: "Dict[str, int]"):
+        # Batches sent within a delivery are drawn once
+        for chapter, pages in pages_sent.items():
+            bar = self._bars.get(chapter)
+            if bar is not None:
+                bar.update(pages)
+        pages_sent.clear()
+
+    def close(self):
+        for bar in self._bars.values():
+            bar.close()
+        self._bars = {}
+
+
+class JsonLinesSink(EventSink):
+    """Write every event as a json line, for other programs to follow the upload."""
+
+    def __init__(self, events_path: "Path") -> None:
+        self.events_path = events_path
+        self._events_file = open(events_path, "a", encoding="utf-8")
+
+    def handle(self, events: "List[Event]"):
+        self._events_file.write(
+            "".join(json_codec.dumps(event.to_dict()) + "\n" for event in events)
+        )
+        self._events_file.flush()
+
+    def close(self):
+        self._events_file.close()
+
+
+class ProgressState:
+    """Overall progress folded from the events, as shown in the web ui.
+    Chapters retried in a later pass are counted once."""
+
+    def __init__(self) -> None:
+        self.chapters: "Dict[str, int]" = {}
+        self.chapters_done: "set" = set()
+        self.chapters_failed: "set" = set()
+        self.pages_sent = 0
+        self.bytes_sent = 0
+        self.pages_converted = 0
+        self.current_chapter: "Optional[str]" = None
+        self.current_pages = 0
+        self.current_pages_sent = 0
+        self.last_error: "Optional[str]" = None
+        self.updated = 0.0
+
+    def apply(self, events: "Iterable[Event]"):
+        for event in events:
+            self.updated = event.time
+            if event.type == EventType.CHAPTER_QUEUED:
+                self.chapters[event.chapter] = event.pages
+            elif event.type == EventType.SESSION_CREATED:
+                self.current_chapter = event.chapter
+                self.current_pages = event.pages
+                self.current_pages_sent = 0
+            elif event.type == EventType.BYTES_SENT:
+                self.bytes_sent += event.size
+            elif event.type == EventType.BATCH_SENT:
+                self.pages_sent += event.pages
+                if event.chapter == self.current_chapter:
+                    self.current_pages_sent += event.pages
+            elif event.type == EventType.PAGE_CONVERTED:
+                self.pages_converted += 1
+            elif event.type == EventType.COMMIT_DONE:
+                self.chapters_done.add(event.chapter)
+                self.chapters_failed.discard(event.chapter)
+            elif event.type == EventType.FAILURE:
+                self.chapters_failed.add(event.chapter)
+                self.last_error = f"{event.chapter}: {event.detail}"
+
+    def to_dict(self) -> "dict":
+        return {
+            "chapters_total": len(self.chapters),
+            "chapters_done": len(self.chapters_done),
+            "chapters_failed": len(self.chapters_failed),
+            "pages_total": sum(self.chapters.values()),
+            "pages_sent": self.pages_sent,
+            "bytes_sent": self.bytes_sent,
+            "pages_converted": self.pages_converted,
+            "current_chapter": self.current_chapter,
+            "current_pages": self.current_pages,
+            "current_pages_sent": self.current_pages_sent,
+            "last_error": self.last_error,
+            "updated": self.updated,
+        }
+
+
+class ProgressSink(EventSink):
+    def __init__(self, progress: "Optional[ProgressState]" = None) -> None:
+        self.progress = progress or ProgressState()
+        self._lock = threading.Lock()
+
+    def handle(self, events: "List[Event]"):
+        with self._lock:
+            self.progress.apply(events)
+
+    def snapshot(self) -> "dict":
+        with self._lock:
+            return self.progress.to_dict()
+
+
+event_bus = EventBus()
+
+
+def emit(
+    event_type: "EventType",
+    chapter: "Optional[str]" = None,
+    pages: "int" = 0,
+    size: "int" = 0,
+    page: "Optional[str]" = None,
+    detail: "Optional[str]" = None,
+):
+    """Queue a progress event, doing nothing unless the event bus was started."""
+    if event_bus.enabled:
+        event_bus.emit(Event(event_type, chapter, time.time(), pages, size, page, detail))
+
+
+def emit_message(chapter: "Optional[str]", message: "str"):
+    """Show a message about the chapter in order with its progress bar,
+    printed straight away unless the event bus was started."""
+    if event_bus.enabled:
+        event_bus.emit(Event(EventType.MESSAGE, chapter, time.time(), detail=message))
+    else:
+        print(message)
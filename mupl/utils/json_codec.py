@@ -0,0 +1,80 @@
+import json
+import logging
+from typing import Callable, Dict, Optional, Union
+
+logger = logging.getLogger("mupl")
+
+# The decode errors of the json module and orjson are both ValueErrors
+JSONDecodeError = ValueError
+
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+
+class JsonCodec:
+    """Decoder and encoder used for the api responses and the json files."""
+
+    def __init__(
+        self,
+        name: "str",
+        loads: "Callable[[Union[bytes, str]], object]",
+        dumps: "Callable[..., str]",
+    ) -> None:
+        self.name = name
+        self._loads = loads
+        self._dumps = dumps
+
+    def loads(self, data: "Union[bytes, str]"):
+        # Files saved by some Windows editors start with a byte order mark
+        if isinstance(data, bytes) and data.startswith(_UTF8_BOM):
+            data = data[len(_UTF8_BOM) :]
+        return self._loads(data)
+
+    def dumps(self, obj, default: "Optional[Callable]" = None) -> "str":
+        """Compact json, for the files written line by line."""
+        return self._dumps(obj, default=default)
+
+    def __repr__(self) -> "str":
+        return f"JsonCodec({self.name!r})"
+
+
+def _json_dumps(obj, default: "Optional[Callable]" = None) -> "str":
+    return json.dumps(obj, default=default)
+
+
+codecs: "Dict[str, JsonCodec]" = {"json": JsonCodec("json", json.loads, _json_dumps)}
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+else:
+
+    def _orjson_dumps(obj, default: "Optional[Callable]" = None) -> "str":
+        return orjson.dumps(obj, default=default).decode("utf-8")
+
+    codecs["orjson"] = JsonCodec("orjson", orjson.loads, _orjson_dumps)
+
+# The fastest available codec
+codec = codecs.get("orjson", codecs["json"])
+
+
+def set_codec(name: "str"):
+    """Use another of the available codecs."""
+    global codec
+    if name not in codecs:
+        raise ValueError(f"Unknown or unavailable json codec {name}.")
+    codec = codecs[name]
+    logger.debug("Using the %s json codec.", name)
+
+
+def loads(data: "Union[bytes, str]"):
+    return codec.loads(data)
+
+
+def dumps(obj, default: "Optional[Callable]" = None) -> "str":
+    return codec.dumps(obj, default=default)
+
+
+def load_file(path) -> "object":
+    with open(path, "rb") as json_file:
+        return codec.loads(json_file.read())
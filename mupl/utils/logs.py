@@ -1,64 +1,116 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import threading
 from datetime import date, datetime, timedelta
 from pathlib import Path
 
-from mupl.utils.config import MAX_LOG_DAYS, root_path
+from typing import Optional
+
+from mupl.utils.config import context
+
+# Pass as extra to log only one in LOG_REQUEST_SAMPLE_RATE of the records with the same message
+SAMPLED = {"sampled": True}
+
+
+_logger = logging.getLogger("mupl")
+_listener: "Optional[logging.handlers.QueueListener]" = None
 
 
 def format_log_dir_path():
-    log_folder_path = root_path.joinpath("logs")
+    log_folder_path = context.root_path.joinpath("logs")
     log_folder_path.mkdir(parents=True, exist_ok=True)
     return log_folder_path
 
 
-log_folder_path = format_log_dir_path()
+class SamplingFilter(logging.Filter):
+    """Keep one in every `rate` of the records logged with SAMPLED, per message."""
+
+    def __init__(self, rate: "int") -> None:
+        super().__init__()
+        self.rate = max(rate, 1)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: "logging.LogRecord") -> "bool":
+        if self.rate == 1 or not getattr(record, "sampled", False):
+            return True
+        with self._lock:
+            count = self._counts.get(record.msg, 0)
+            self._counts[record.msg] = count + 1
+        return count % self.rate == 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue the record as it is, the message is formatted on the listener thread.
+    Arguments passed to the logger must not be changed after the call."""
+
+    def prepare(self, record: "logging.LogRecord") -> "logging.LogRecord":
+        return record
 
 
 def setup_logs(
     logger_name: "str",
-    path: Path = log_folder_path,
+    path: "Optional[Path]" = None,
     logger_filename: "str" = None,
-):
+) -> "logging.handlers.QueueListener":
+    """Log to a rotating file, written by a background thread so a slow disk never stalls the upload."""
+    if path is None:
+        path = format_log_dir_path()
     path.mkdir(exist_ok=True, parents=True)
     if logger_filename is None:
         logger_filename = logger_name
 
-    filename = f"{logger_filename}_{str(current_date)}.log"
+    filename = f"{logger_filename}_{str(date.today())}.log"
 
     logs_path = path.joinpath(filename)
-    fileh = logging.FileHandler(logs_path, "a")
+    fileh = logging.handlers.RotatingFileHandler(
+        logs_path,
+        "a",
+        maxBytes=context.log_max_size * 1024 * 1024,
+        backupCount=context.log_backup_count,
+        encoding="utf-8",
+    )
     formatter = logging.Formatter(
         "%(asctime)s %(levelname)-8s [%(filename)s:%(funcName)s:%(lineno)d] %(message)s"
     )
     fileh.setFormatter(formatter)
 
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(context.log_request_sample_rate))
+    listener = logging.handlers.QueueListener(log_queue, fileh, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
     log = logging.getLogger(logger_name)  # root logger
-    # for hdlr in log.handlers[:]:  # remove all old handlers
-    #     if isinstance(hdlr, logging.FileHandler):
-    #         log.removeHandler(hdlr)
-    log.addHandler(fileh)
+    log.addHandler(queue_handler)
     log.setLevel(logging.DEBUG)
-
-
-current_date = date.today()
-last_date_keep_logs = current_date - timedelta(days=MAX_LOG_DAYS)
-
-
-setup_logs(
-    logger_name="mupl",
-    path=log_folder_path,
-    logger_filename="mupl",
-)
-
-_logger = logging.getLogger("mupl")
+    return listener
 
 
 def clear_old_logs(folder_path: "Path"):
-    for log_file in folder_path.rglob("*.log"):
+    last_date_keep_logs = date.today() - timedelta(days=context.max_log_days)
+    # Rotated logs end with .log.1, .log.2...
+    for log_file in folder_path.rglob("*.log*"):
         file_date = datetime.fromtimestamp(log_file.stat().st_mtime).date()
         if file_date < last_date_keep_logs:
-            _logger.debug(f"{log_file.name} is over {MAX_LOG_DAYS} days old, deleting.")
+            _logger.debug(
+                "%s is over %s days old, deleting.", log_file.name, context.max_log_days
+            )
             log_file.unlink()
 
 
-clear_old_logs(log_folder_path)
+def start_logging() -> "logging.handlers.QueueListener":
+    """Log the uploader to the logs folder of the root path, only the first call sets it up."""
+    global _listener
+    if _listener is None:
+        log_folder_path = format_log_dir_path()
+        _listener = setup_logs(
+            logger_name="mupl",
+            path=log_folder_path,
+            logger_filename="mupl",
+        )
+        clear_old_logs(log_folder_path)
+    return _listener
@@ -0,0 +1,165 @@
+import contextlib
+import logging
+import os
+import sys
+import threading
+from typing import Dict, Optional
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger("mupl")
+
+# Seconds between the memory samples while a chapter uploads
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+class StageUsage:
+    __slots__ = ("current", "peak")
+
+    def __init__(self) -> None:
+        self.current = 0
+        self.peak = 0
+
+
+class Reservation:
+    """Bytes held by a stage, resized once the held bytes are known."""
+
+    __slots__ = ("_budget", "stage", "size")
+
+    def __init__(self, budget: "MemoryBudget", stage: "str", size: "int") -> None:
+        self._budget = budget
+        self.stage = stage
+        self.size = size
+
+    def resize(self, size: "int"):
+        """Account the bytes actually held, without waiting as they are in memory already."""
+        self._budget._resize(self, size)
+
+
+class MemoryBudget:
+    """Bytes of page data held in memory by each stage: pages being read,
+    converted images and batches waiting for their upload.
+
+    Batches wait for room once the budget is spent, so memory stays bounded
+    however many batches are sent at once. A batch is always let through when
+    nothing else is held, so a batch larger than the budget can't block."""
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        # 0 is no limit
+        self.limit = 0
+        self.in_use = 0
+        self.stages: "Dict[str, StageUsage]" = {}
+
+    def configure(self, limit_mb: "int"):
+        with self._condition:
+            self.limit = max(limit_mb, 0) * 1024 * 1024
+            self._condition.notify_all()
+
+    def fits(self, size: "int") -> "bool":
+        """Whether the bytes can be held now without waiting."""
+        with self._condition:
+            return not self.limit or not self.in_use or self.in_use + size <= self.limit
+
+    @contextlib.contextmanager
+    def reserve(self, stage: "str", size: "int", wait: "bool" = True):
+        """Account the bytes of a stage while they are held, waiting for room if asked."""
+        with self._condition:
+            if wait:
+                while self.limit and self.in_use and self.in_use + size > self.limit:
+                    self._condition.wait()
+            self.in_use += size
+            usage = self.stages.get(stage)
+            if usage is None:
+                usage = self.stages[stage] = StageUsage()
+            usage.current += size
+            usage.peak = max(usage.peak, usage.current)
+        reservation = Reservation(self, stage, size)
+        try:
+            yield reservation
+        finally:
+            with self._condition:
+                self.in_use -= reservation.size
+                usage.current -= reservation.size
+                self._condition.notify_all()
+
+    def _resize(self, reservation: "Reservation", size: "int"):
+        with self._condition:
+            change = size - reservation.size
+            reservation.size = size
+            self.in_use += change
+            usage = self.stages[reservation.stage]
+            usage.current += change
+            usage.peak = max(usage.peak, usage.current)
+            if change < 0:
+                self._condition.notify_all()
+
+    def take_peaks(self) -> "Dict[str, int]":
+        """Peak bytes of each stage since the last call."""
+        with self._condition:
+            peaks = {stage: usage.peak for stage, usage in self.stages.items()}
+            for usage in self.stages.values():
+                usage.peak = usage.current
+        return peaks
+
+
+memory_budget = MemoryBudget()
+
+
+def current_rss() -> "Optional[int]":
+    """Resident memory of the process in bytes, None if it can't be read."""
+    try:
+        with open("/proc/self/statm", "rb") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+
+    if sys.platform != "win32":
+        import resource
+
+        # The peak, not the current memory, is all that is left
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+    return None
+
+
+class PeakRss:
+    """Highest resident memory sampled while a chapter uploads."""
+
+    def __init__(self) -> None:
+        self.peak: "Optional[int]" = None
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        while not self._stop_event.wait(RSS_SAMPLE_INTERVAL):
+            self.sample()
+
+    @property
+    def peak_mb(self) -> "Optional[float]":
+        return None if self.peak is None else round(self.peak / (1024 * 1024), 1)
+
+
+@contextlib.contextmanager
+def sample_peak_rss():
+    """Sample the resident memory in the background while the block runs."""
+    peak_rss = PeakRss()
+    peak_rss.sample()
+    sampler = threading.Thread(target=peak_rss._run, name="rss-sampler", daemon=True)
+    sampler.start()
+    try:
+        yield peak_rss
+    finally:
+        peak_rss._stop_event.set()
+        sampler.join()
+        peak_rss.sample()
@@ -0,0 +1,188 @@
+import cProfile
+import collections
+import contextlib
+import logging
+import marshal
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Counter, Dict, Optional, Tuple
+
+logger = logging.getLogger("mupl")
+
+# Seconds between the stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.01
+PROFILE_MODES = ("cprofile", "sample")
+
+# Threads waiting in these modules are idle, not part of the chapter
+IDLE_MODULES = ("threading.py", "queue.py")
+# Other threads only count while running code of the package, e.g. the image uploads
+PACKAGE_FOLDER = str(Path(__file__).resolve().parents[1])
+
+# pstats function key: file, line of the definition and name
+FunctionKey = Tuple[str, int, str]
+
+
+def _frame_key(frame) -> "FunctionKey":
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class _Profile:
+    """Samples and, with cProfile, the deterministic profile of one chapter."""
+
+    def __init__(self, name: "str", deterministic: "bool") -> None:
+        self.name = name
+        self.start = time.perf_counter()
+        self.samples: "Counter[Tuple[str, Tuple[FunctionKey, ...]]]" = collections.Counter()
+        self.cprofile = cProfile.Profile() if deterministic else None
+
+
+class Profiler:
+    """CPU profiles of each chapter, saved as pstats and collapsed stack files.
+
+    A sampling thread records the stacks of every thread, including the image
+    upload threads waiting on sockets, for the collapsed stacks. The cprofile
+    mode also profiles the calls of the chapter's own thread exactly, at a
+    higher cost, for short runs; otherwise the pstats are built from the samples."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.folder: "Optional[Path]" = None
+        self.mode = "cprofile"
+        self.threshold = 0.0
+        self.interval = SAMPLE_INTERVAL
+        self.saved = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self._current: "Optional[_Profile]" = None
+        self._stop_event = threading.Event()
+        self._sampler: "Optional[threading.Thread]" = None
+
+    def start(self, folder: "Path", mode: "str" = "cprofile", threshold: "float" = 0.0):
+        self.folder = folder
+        self.mode = mode
+        self.threshold = threshold
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self._stop_event.clear()
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        self._stop_event.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def _sample(self):
+        sampler_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                profile = self._current
+            if profile is None:
+                continue
+
+            main_id = threading.main_thread().ident
+            thread_names = {x.ident: x.name for x in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                if thread_id != main_id and Path(frame.f_code.co_filename).name in IDLE_MODULES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_key(frame))
+                    frame = frame.f_back
+                if thread_id != main_id and not any(x[0].startswith(PACKAGE_FOLDER) for x in stack):
+                    continue
+                stack.reverse()
+                profile.samples[(thread_names.get(thread_id, str(thread_id)), tuple(stack))] += 1
+
+    @contextlib.contextmanager
+    def chapter(self, name: "str"):
+        """Profile the work of a chapter, doing nothing unless profiling was started."""
+        if not self.enabled:
+            yield
+            return
+
+        profile = _Profile(name, self.mode == "cprofile")
+        with self._lock:
+            self._current = profile
+        if profile.cprofile is not None:
+            try:
+                profile.cprofile.enable()
+            except ValueError as e:
+                # Another profiler, such as a debugger, is already running
+                logger.warning(f"Couldn't start cProfile, sampling only: {e}")
+                profile.cprofile = None
+        try:
+            yield
+        finally:
+            if profile.cprofile is not None:
+                profile.cprofile.disable()
+            with self._lock:
+                self._current = None
+            self._save(profile, time.perf_counter() - profile.start)
+
+    def _save(self, profile: "_Profile", duration: "float"):
+        if duration < self.threshold:
+            return
+
+        self._count += 1
+        safe_name = re.sub(r"[^\w\-. \[\]()]+", "_", profile.name).strip() or "chapter"
+        base_path = self.folder.joinpath(f"{self._count:04d} {safe_name[:150]}")
+        try:
+            if profile.cprofile is not None:
+                profile.cprofile.dump_stats(f"{base_path}.prof")
+            else:
+                with open(f"{base_path}.prof", "wb") as stats_file:
+                    marshal.dump(self._sampled_stats(profile), stats_file)
+            with open(f"{base_path}.collapsed", "w", encoding="utf-8") as collapsed_file:
+                for (thread_name, stack), count in profile.samples.most_common():
+                    frames = ";".join(f"{x[2]} ({Path(x[0]).name}:{x[1]})" for x in stack)
+                    collapsed_file.write(f"{thread_name};{frames} {count}\n")
+        except OSError as e:
+            logger.error(f"Couldn't save the profile of {profile.name}: {e}")
+            return
+
+        self.saved += 1
+        logger.debug(f"Saved the profile of {profile.name} ({duration:.1f}s) to {base_path}.")
+
+    def _sampled_stats(self, profile: "_Profile") -> "Dict[FunctionKey, tuple]":
+        """Samples as pstats entries, with the sample counts in place of the call counts."""
+        own_time: "Counter[FunctionKey]" = collections.Counter()
+        total_time: "Counter[FunctionKey]" = collections.Counter()
+        samples: "Counter[FunctionKey]" = collections.Counter()
+        callers: "Dict[FunctionKey, Counter[FunctionKey]]" = collections.defaultdict(collections.Counter)
+
+        for (_, stack), count in profile.samples.items():
+            if not stack:
+                continue
+            own_time[stack[-1]] += count
+            # Recursive functions count once per sample
+            for function in set(stack):
+                total_time[function] += count
+                samples[function] += count
+            for caller, callee in zip(stack, stack[1:]):
+                callers[callee][caller] += count
+
+        return {
+            function: (
+                samples[function],
+                samples[function],
+                own_time[function] * self.interval,
+                total_time[function] * self.interval,
+                {
+                    caller: (count, count, 0.0, count * self.interval)
+                    for caller, count in callers[function].items()
+                },
+            )
+            for function in total_time
+        }
+
+
+profiler = Profiler()
@@ -0,0 +1,150 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from mupl.utils import json_codec
+
+logger = logging.getLogger("mupl")
+
+
+class _NullSpan:
+    """Span used while tracing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        return None
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "name", "attributes", "start", "cpu_start")
+
+    def __init__(self, tracer: "Tracer", name: "str", attributes: "dict") -> None:
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter_ns()
+        self.cpu_start = time.thread_time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        duration = time.perf_counter_ns() - self.start
+        cpu_time = time.thread_time_ns() - self.cpu_start
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.record(self, duration, cpu_time)
+
+    def set(self, **attributes) -> None:
+        """Add attributes only known once the span is running."""
+        self.attributes.update(attributes)
+
+
+class StageSummary:
+    __slots__ = ("count", "total", "cpu", "max")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.cpu = 0
+        self.max = 0
+
+
+class Tracer:
+    """Timings of the upload stages.
+
+    Spans are written as Chrome trace complete events, one per line after the
+    opening bracket, so the file can be opened in chrome://tracing or Perfetto
+    while each line is still a json object followed by a comma."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._trace_file = None
+        self._origin = 0
+        self.stages: "Dict[str, StageSummary]" = {}
+
+    def start(self, trace_path: "Optional[Path]" = None):
+        self._origin = time.perf_counter_ns()
+        self.stages = {}
+        if trace_path is not None:
+            self._trace_file = open(trace_path, "w", encoding="utf-8")
+            self._trace_file.write("[\n")
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+
+    def record(self, span: "Span", duration: "int", cpu_time: "int"):
+        event = None
+        if self._trace_file is not None:
+            event = {
+                "name": span.name,
+                "cat": "mupl",
+                "ph": "X",
+                "ts": (span.start - self._origin) / 1000,
+                "dur": duration / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": dict(span.attributes, cpu_ms=cpu_time / 1000000),
+            }
+
+        with self._lock:
+            stage = self.stages.get(span.name)
+            if stage is None:
+                stage = self.stages[span.name] = StageSummary()
+            stage.count += 1
+            stage.total += duration
+            stage.cpu += cpu_time
+            stage.max = max(stage.max, duration)
+
+            if event is not None and self._trace_file is not None:
+                try:
+                    self._trace_file.write(json_codec.dumps(event, default=str) + ",\n")
+                except OSError as e:
+                    logger.error(f"Couldn't write the trace, stopping it: {e}")
+                    self._trace_file = None
+
+    def summary(self) -> "List[dict]":
+        """Stages sorted by their total time."""
+        with self._lock:
+            stages = list(self.stages.items())
+
+        return [
+            {
+                "name": name,
+                "count": stage.count,
+                "total": stage.total / 1e9,
+                "mean": stage.total / stage.count / 1e9,
+                "max": stage.max / 1e9,
+                "cpu": stage.cpu / stage.total if stage.total else 0.0,
+            }
+            for name, stage in sorted(stages, key=lambda x: x[1].total, reverse=True)
+        ]
+
+
+tracer = Tracer()
+
+
+def span(name: "str", **attributes):
+    """Time a stage, doing nothing unless tracing was started."""
+    if not tracer.enabled:
+        return _NULL_SPAN
+    return Span(tracer, name, attributes)
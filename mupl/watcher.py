@@ -0,0 +1,175 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mupl.file_validator import FileProcesser
+from mupl.scan_index import ScanIndex
+
+logger = logging.getLogger("mupl")
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_WATCH_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+
+
+class InotifyWatch:
+    """Minimal inotify wrapper that watches a folder tree for changes."""
+
+    def __init__(self, folder: "Path") -> None:
+        self.folder = folder
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watched: "Dict[str, int]" = {}
+        self.add_tree()
+
+    @classmethod
+    def create(cls, folder: "Path") -> "Optional[InotifyWatch]":
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            return cls(folder)
+        except (OSError, AttributeError, TypeError) as e:
+            logger.warning(f"Couldn't use inotify, polling the upload folder instead: {e}")
+            return
+
+    def add_tree(self):
+        """Watch the folder and every sub folder not watched yet."""
+        for root, dirs, _ in os.walk(self.folder):
+            if root in self._watched:
+                continue
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(root), IN_WATCH_MASK
+            )
+            if wd >= 0:
+                self._watched[root] = wd
+
+    def wait(self, timeout: "float") -> "bool":
+        """Wait for changes in the folder tree, return if any happened."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+
+        # Drain the queued events, only the fact something changed is used
+        changed = False
+        while True:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not buffer:
+                break
+            changed = True
+
+        self._watched = {
+            path: wd for path, wd in self._watched.items() if os.path.isdir(path)
+        }
+        self.add_tree()
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class UploadFolderWatcher:
+    """Watch the upload folder and report chapters once they stop changing.
+
+    A chapter is ready when its size and mtime stay the same for the settle time,
+    or straight away when its marker file exists (a file named after the marker
+    inside chapter folders, or a hidden `.<file name><marker>` next to chapter files)."""
+
+    def __init__(
+        self,
+        folder: "Path",
+        settle_time: "float",
+        poll_interval: "float",
+        marker_name: "str",
+    ) -> None:
+        self.folder = folder
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.marker_name = marker_name
+        self._inotify = InotifyWatch.create(folder)
+        # Chapter path to its last signature and since when it has been unchanged
+        self._pending: "Dict[Path, Tuple[Tuple[int, int], float]]" = {}
+
+    def _has_marker(self, to_upload: "Path") -> "bool":
+        if to_upload.is_dir():
+            return to_upload.joinpath(self.marker_name).exists()
+        return to_upload.with_name(f".{to_upload.name}{self.marker_name}").exists()
+
+    def settled(
+        self, zips_to_upload: "Iterable[FileProcesser]"
+    ) -> "List[FileProcesser]":
+        """Get the chapters that finished being copied to the upload folder."""
+        now = time.monotonic()
+        ready: "List[FileProcesser]" = []
+        pending: "Dict[Path, Tuple[Tuple[int, int], float]]" = {}
+
+        for file_name_obj in zips_to_upload:
+            to_upload = file_name_obj.to_upload
+            try:
+                signature = ScanIndex.signature(to_upload)
+            except OSError:
+                continue
+
+            if self._has_marker(to_upload):
+                ready.append(file_name_obj)
+                continue
+
+            last_signature, stable_since = self._pending.get(to_upload, (None, now))
+            if last_signature != signature:
+                stable_since = now
+
+            if now - stable_since >= self.settle_time:
+                ready.append(file_name_obj)
+            else:
+                pending[to_upload] = (signature, stable_since)
+
+        self._pending = pending
+        return ready
+
+    @property
+    def waiting(self) -> "int":
+        """Number of chapters still being copied."""
+        return len(self._pending)
+
+    def wait(self, stop_event) -> None:
+        """Wait for changes in the upload folder, or until a pending chapter might have settled."""
+        timeout = self.poll_interval
+        if self._pending:
+            timeout = min(timeout, self.settle_time)
+
+        if self._inotify is None:
+            stop_event.wait(timeout)
+            return
+
+        deadline = time.monotonic() + timeout
+        while not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # Wake up regularly to check the stop event
+            if self._inotify.wait(min(remaining, 1)):
+                # Give the copy a moment to produce the rest of its events
+                stop_event.wait(min(1, self.settle_time))
+                return
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
@@ -1,9 +1,12 @@
 import os
 import sys
 import json
+import time
+import tempfile
+import threading
 import webbrowser
 import subprocess
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 
 try:
     folder_executed = sys.argv[1]
@@ -16,7 +19,8 @@ app = Flask(__name__)
 temp_folder = os.environ.get('TEMP', '') if os.name == 'nt' else os.environ.get('TMPDIR', '')
 app_folder = os.path.join(temp_folder, "MangaDex Uploader (APP)")
 path_user = os.path.expanduser('~')
-mupl_app = os.path.join(app_folder, "mupl.py")
+# Next to run.py, in the folder of the installed release
+mupl_app = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mupl.py")
 config_path = os.path.join(app_folder, 'config.json')
 config_user = os.path.join(path_user, 'MangaDex Uploader (APP)')
 config_path_user = os.path.join(config_user, 'config.json')
@@ -27,6 +31,151 @@ uploaded_files = os.path.join(folder_executed, 'uploaded')
 
 default_url = 'http://127.0.0.1:5000'
 
+# Seconds to wait for mupl to finish the current chapter after a cancel before killing it
+cancel_timeout = 300
+# Seconds between keep-alive comments on the progress stream
+keepalive_interval = 15
+
+
+class UploadJob:
+    """mupl running in the background, with its progress read from the --events file."""
+
+    def __init__(self):
+        self.process = None
+        self.events_path = None
+        self.bandwidth_path = None
+        self.progress = None
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.version = 0
+        self.condition = threading.Condition()
+
+    @property
+    def running(self):
+        return self.process is not None and self.finished is None
+
+    def start(self):
+        # The events are folded with the uploader's own code, imported once the config exists
+        from mupl.utils.events import ProgressState
+
+        events_file, self.events_path = tempfile.mkstemp(prefix='mupl-events-', suffix='.jsonl')
+        os.close(events_file)
+        # mupl reads the upload bandwidth limit set in the page from this file
+        bandwidth_file, self.bandwidth_path = tempfile.mkstemp(prefix='mupl-bandwidth-', suffix='.json')
+        os.close(bandwidth_file)
+        self.set_bandwidth_limit(None)
+
+        if sys.platform.startswith('win'):
+            command = ['python', mupl_app, '--events', self.events_path, '--bandwidth-control', self.bandwidth_path]
+        else:
+            command = ['python3', mupl_app, '--events', self.events_path, '--bandwidth-control', self.bandwidth_path]
+
+        self.progress = ProgressState()
+        self.started = time.time()
+        self.process = subprocess.Popen(command, cwd=os.path.dirname(mupl_app) or None)
+        threading.Thread(target=self._follow_events, daemon=True).start()
+
+    def _follow_events(self):
+        from mupl.utils import json_codec
+        from mupl.utils.events import Event
+
+        with open(self.events_path, 'r', encoding='utf-8') as events_file:
+            pending = ''
+            while True:
+                exited = self.process.poll() is not None
+                pending += events_file.read()
+                lines = pending.split('\n')
+                # The last line may still be being written
+                pending = lines.pop()
+
+                events = []
+                for line in lines:
+                    try:
+                        events.append(Event.from_dict(json_codec.loads(line)))
+                    except (ValueError, KeyError):
+                        continue
+
+                with self.condition:
+                    if events:
+                        self.progress.apply(events)
+                        self.version += 1
+                    if exited:
+                        self.finished = time.time()
+                        self.version += 1
+                    self.condition.notify_all()
+
+                if exited:
+                    break
+                time.sleep(0.5)
+
+        for path in (self.events_path, self.bandwidth_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def set_bandwidth_limit(self, limit):
+        """Upload limit in KB/s while uploading, 0 for no limit, None for the limits of the config."""
+        temp_path = f"{self.bandwidth_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'limit': limit}, file)
+        os.replace(temp_path, self.bandwidth_path)
+
+    def cancel(self):
+        if not self.running or self.cancelled:
+            return False
+
+        self.cancelled = True
+        # mupl stops after the current chapter, Windows has no SIGTERM and stops right away
+        self.process.terminate()
+        threading.Thread(target=self._kill_after_timeout, daemon=True).start()
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+        return True
+
+    def _kill_after_timeout(self):
+        try:
+            self.process.wait(cancel_timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def status(self):
+        if self.process is None:
+            return {'state': 'idle'}
+
+        with self.condition:
+            progress = self.progress.to_dict()
+            end = self.finished or time.time()
+
+        elapsed = max(end - self.started, 1e-6)
+        pages_per_second = progress['pages_sent'] / elapsed
+        pages_left = max(progress['pages_total'] - progress['pages_sent'], 0)
+
+        if self.running:
+            state = 'cancelling' if self.cancelled else 'running'
+        elif self.cancelled:
+            state = 'cancelled'
+        elif self.process.returncode != 0 or progress['chapters_failed']:
+            state = 'failed'
+        else:
+            state = 'finished'
+
+        return dict(
+            progress,
+            state=state,
+            returncode=self.process.returncode,
+            elapsed=elapsed,
+            pages_per_second=pages_per_second,
+            mb_per_second=progress['bytes_sent'] / (1024 * 1024) / elapsed,
+            eta=pages_left / pages_per_second if pages_per_second and self.running else None,
+        )
+
+
+upload_job = UploadJob()
+job_lock = threading.Lock()
+
 
 def load_config(path):
     try:
@@ -254,20 +403,64 @@ def clear_folder1():
 
 @app.route('/start_process', methods=['POST'])
 def start_process():
-    try:
-        if sys.platform.startswith('win'):
-            command = ['python', mupl_app]
-        else:
-            command = ['python3', mupl_app]
-        subprocess.run(command)
-        return '', 200
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error mupl.py: {e}")
-        return '', 400
-    except Exception as e:
-        print(f"Error: {e}")
-        return '', 400
+    global upload_job
+
+    with job_lock:
+        if upload_job.running:
+            return jsonify(upload_job.status()), 409
+
+        try:
+            upload_job = UploadJob()
+            upload_job.start()
+        except Exception as e:
+            print(f"Error: {e}")
+            return jsonify({'error': str(e)}), 400
+    return jsonify(upload_job.status()), 202
+
+@app.route('/process_status', methods=['GET'])
+def process_status():
+    return jsonify(upload_job.status())
+
+@app.route('/cancel_process', methods=['POST'])
+def cancel_process():
+    job = upload_job
+    if not job.cancel():
+        return jsonify(job.status()), 409
+    return jsonify(job.status()), 202
+
+@app.route('/bandwidth_limit', methods=['POST'])
+def bandwidth_limit():
+    job = upload_job
+    limit = (request.get_json(silent=True) or {}).get('limit')
+    if limit is not None and (isinstance(limit, bool) or not isinstance(limit, (int, float)) or limit < 0):
+        return jsonify({'error': 'The limit must be a number of KB/s, 0 or more.'}), 400
+    if not job.running:
+        return jsonify(job.status()), 409
+    job.set_bandwidth_limit(limit)
+    return jsonify(job.status()), 202
+
+@app.route('/process_events')
+def process_events():
+    job = upload_job
+
+    def stream():
+        version = -1
+        while True:
+            with job.condition:
+                if job.version == version and job.running:
+                    job.condition.wait(keepalive_interval)
+                changed = job.version != version
+                version = job.version
+
+            if changed:
+                yield f"data: {json.dumps(job.status())}\n\n"
+            else:
+                yield ": keepalive\n\n"
+
+            if not job.running:
+                break
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
     
 
 
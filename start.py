@@ -1,11 +1,30 @@
 import os
+import re
+import json
+import time
+import shutil
+import hashlib
 import subprocess
-from io import BytesIO
 from zipfile import ZipFile
 
 
 namespace = "OneDefauter"
 
+# MUPL_RELEASE_URL points the update check at another server, e.g. a local stand-in
+release_url = os.environ.get(
+    "MUPL_RELEASE_URL", f"https://api.github.com/repos/{namespace}/mupl/releases/latest"
+)
+# Seconds before the latest release is checked again
+release_check_ttl = int(os.environ.get("MUPL_RELEASE_TTL", 3600))
+release_cache_name = ".release_cache.json"
+manifest_name = ".release_manifest.json"
+# Each release is installed in its own folder, the pointer file names the one in use
+releases_folder_name = ".releases"
+current_release_name = ".current_release.json"
+version_file_name = "__init__.py"
+chunk_size = 1024 * 1024
+
+
 def install_modules():
     required_modules = [
         'requests',
@@ -28,20 +47,219 @@ def install_modules():
 
     os.system('cls' if os.name == 'nt' else 'clear')
 
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_json(path, data):
+    """Write through a temporary file, so the file is never left half written."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=4)
+    os.replace(temp_path, path)
+
+
+def get_latest_release(app_folder):
+    """Latest release, checked at most once per release_check_ttl and only downloaded again when its ETag changed."""
+    cache_path = os.path.join(app_folder, release_cache_name)
+    cache = read_json(cache_path)
+    cached_release = cache.get("release")
+
+    if cached_release is not None and time.time() - cache.get("checked", 0) < release_check_ttl:
+        return cached_release
+
+    headers = {"Accept": "application/vnd.github+json"}
+    if cached_release is not None and cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+
+    try:
+        remote_release = requests.get(release_url, headers=headers, timeout=10)
+    except requests.RequestException as e:
+        print(f"Couldn't check for updates: {e}")
+        return cached_release
+
+    if remote_release.status_code == 304:
+        cache["checked"] = time.time()
+    elif remote_release.ok:
+        remote_release_json = remote_release.json()
+        cache = {
+            "etag": remote_release.headers.get("ETag"),
+            "checked": time.time(),
+            "release": {
+                "tag_name": remote_release_json["tag_name"],
+                "zipball_url": remote_release_json["zipball_url"],
+                # Only set by servers that publish the archive hash
+                "zipball_sha256": remote_release_json.get("zipball_sha256"),
+            },
+        }
+    else:
+        print(f"Couldn't check for updates: {remote_release.status_code}")
+        return cached_release
+
+    write_json(cache_path, cache)
+    return cache["release"]
+
+
+def download_release(release, download_path):
+    """Stream the release archive to disk, checking its hash and the crc of each file."""
+    sha256 = hashlib.sha256()
+    with requests.get(release["zipball_url"], stream=True, timeout=30) as zip_resp:
+        zip_resp.raise_for_status()
+        with open(download_path, "wb") as download_file:
+            for chunk in zip_resp.iter_content(chunk_size):
+                sha256.update(chunk)
+                download_file.write(chunk)
+
+    expected_hash = release.get("zipball_sha256")
+    if expected_hash and sha256.hexdigest() != expected_hash.lower():
+        raise ValueError(f"Release archive hash {sha256.hexdigest()} doesn't match {expected_hash}.")
+
+    with ZipFile(download_path) as myzip:
+        bad_file = myzip.testzip()
+    if bad_file is not None:
+        raise ValueError(f"Release archive file {bad_file} is corrupted.")
+
+
+def get_release_folder(app_folder):
+    """Folder of the installed release, the app folder itself for installs made before the release folders."""
+    folder_name = read_json(os.path.join(app_folder, current_release_name)).get("folder")
+    if folder_name:
+        release_folder = os.path.join(app_folder, releases_folder_name, folder_name)
+        if os.path.isdir(release_folder):
+            return release_folder
+    return app_folder
+
+
+def remove_old_releases(app_folder, keep):
+    """Remove the release folders other than the ones kept, a folder still in use is left for the next update."""
+    releases_folder = os.path.join(app_folder, releases_folder_name)
+    for folder_name in os.listdir(releases_folder):
+        if folder_name not in keep:
+            shutil.rmtree(os.path.join(releases_folder, folder_name), ignore_errors=True)
+
+
+def reuse_file(installed_path, staged_path):
+    """Link an unchanged file of the installed release into the new one, or copy it
+    where links aren't supported. False if it couldn't be reused."""
+    try:
+        os.link(installed_path, staged_path)
+        return True
+    except OSError:
+        pass
+    try:
+        shutil.copy2(installed_path, staged_path)
+        return True
+    except OSError:
+        return False
+
+
+def install_release(download_path, app_folder, tag_name):
+    """Install the release in a folder of its own and switch to it.
+
+    The release is staged in a new folder, renamed to its version folder
+    once complete, and the pointer to the current release is then replaced
+    in one step. Only the files whose hash changed are extracted, the others
+    are linked from the installed release. An interrupted or failed install
+    leaves the installed release in use, with none of its files touched."""
+    installed_folder = get_release_folder(app_folder)
+    installed_hashes = read_json(os.path.join(installed_folder, manifest_name))
+
+    folder_name = re.sub(r"[^\w.\-]+", "_", tag_name)
+    release_folder = os.path.join(app_folder, releases_folder_name, folder_name)
+    # The same version installed again, e.g. after its version file went missing
+    if os.path.abspath(release_folder) == os.path.abspath(installed_folder):
+        folder_name = f"{folder_name}-{int(time.time())}"
+        release_folder = os.path.join(app_folder, releases_folder_name, folder_name)
+    staging_folder = f"{release_folder}.staging"
+    shutil.rmtree(staging_folder, ignore_errors=True)
+
+    release_hashes = {}
+    changed_files = []
+    try:
+        with ZipFile(download_path) as myzip:
+            zip_root = [z for z in myzip.infolist() if z.is_dir()][0].filename
+            zip_files = [z for z in myzip.infolist() if not z.is_dir()]
+
+            for fileinfo in zip_files:
+                relative_path = fileinfo.filename.replace(zip_root, "", 1)
+                staged_path = os.path.join(staging_folder, relative_path)
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+
+                sha256 = hashlib.sha256()
+                with myzip.open(fileinfo) as zip_file:
+                    for chunk in iter(lambda: zip_file.read(chunk_size), b""):
+                        sha256.update(chunk)
+                release_hashes[relative_path] = sha256.hexdigest()
+
+                installed_path = os.path.join(installed_folder, relative_path)
+                installed_hash = installed_hashes.get(relative_path)
+                if installed_hash is None and os.path.exists(installed_path):
+                    installed_hash = file_hash(installed_path)
+                if installed_hash == release_hashes[relative_path] and reuse_file(installed_path, staged_path):
+                    continue
+
+                # Only the changed files are written
+                changed_files.append(relative_path)
+                with myzip.open(fileinfo) as zip_file, open(staged_path, "wb") as staged_file:
+                    shutil.copyfileobj(zip_file, staged_file, chunk_size)
+
+        write_json(os.path.join(staging_folder, manifest_name), release_hashes)
+        # Left by an install interrupted before the switch
+        shutil.rmtree(release_folder, ignore_errors=True)
+        os.replace(staging_folder, release_folder)
+        write_json(os.path.join(app_folder, current_release_name), {"folder": folder_name})
+    finally:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+    # The replaced release may still be running, e.g. the web ui of another launch
+    remove_old_releases(app_folder, {folder_name, os.path.basename(installed_folder)})
+    return changed_files
+
+
+def update_app(release, app_folder):
+    download_path = os.path.join(app_folder, ".release_download.zip")
+    try:
+        download_release(release, download_path)
+        changed_files = install_release(download_path, app_folder, release["tag_name"])
+    except (requests.RequestException, OSError, ValueError) as e:
+        print(f"Couldn't update MangaDex Uploader (APP): {e}")
+        return False
+    finally:
+        if os.path.exists(download_path):
+            os.remove(download_path)
+
+    print(f"Updated {len(changed_files)} files, the others were kept from the installed version.")
+    return True
+
+
 def download_and_execute():
     temp_folder = os.environ.get('TEMP', '') if os.name == 'nt' else os.environ.get('TMPDIR', '')
     app_folder = os.path.join(temp_folder, "MangaDex Uploader (APP)")
-    path_file = os.path.join(temp_folder, "MangaDex Uploader (APP)", "run.py")
     folder_executed = os.getcwd()
     
     os.makedirs(app_folder, exist_ok=True)
     os.makedirs(os.path.join(app_folder, "to_upload"), exist_ok=True)
     os.makedirs(os.path.join(app_folder, "uploaded"), exist_ok=True)
+    os.makedirs(os.path.join(app_folder, releases_folder_name), exist_ok=True)
     os.chdir(app_folder)
+    release_folder = get_release_folder(app_folder)
+    path_file = os.path.join(release_folder, "run.py")
     
     if os.path.exists(path_file):
-        if os.path.exists(os.path.join(app_folder, "__init__.py")):
-            with open(os.path.join(app_folder, "__init__.py"), 'r') as file:
+        if os.path.exists(os.path.join(release_folder, version_file_name)):
+            with open(os.path.join(release_folder, version_file_name), 'r') as file:
                 for line in file:
                     if line.startswith('__version__'):
                         __version__ = line.split('=')[1].strip().strip('"\'')
@@ -50,39 +268,19 @@ def download_and_execute():
     else:
         __version__ = "2.0.1" # Initial version
 
-    remote_release = requests.get(f"https://api.github.com/repos/{namespace}/mupl/releases/latest")
+    remote_release = get_latest_release(app_folder)
     local_version = version.parse(__version__)
     
-    if remote_release.ok:
-        remote_release_json = remote_release.json()
-        remote_version = version.parse(remote_release_json["tag_name"])
-        zip_resp = requests.get(remote_release_json["zipball_url"])
-        if zip_resp.ok:
-            myzip = ZipFile(BytesIO(zip_resp.content))
-            zip_root = [z for z in myzip.infolist() if z.is_dir()][0].filename
-            zip_files = [z for z in myzip.infolist() if not z.is_dir()]
-        
-        if not os.path.exists(path_file):
-            for fileinfo in zip_files:
-                filename = os.path.join(app_folder, fileinfo.filename.replace(zip_root, ""))
-                dirname = os.path.dirname(filename)
-                os.makedirs(dirname, exist_ok=True)
-                file_data = myzip.read(fileinfo)
+    if remote_release is not None:
+        remote_version = version.parse(remote_release["tag_name"])
 
-                with open(filename, "wb") as fopen:
-                    fopen.write(file_data)
-        else:
-            if remote_version > local_version:
-                print(f"MangaDex Uploader (APP) is up to date.\nVersion: {remote_version}\nLocal: {local_version}")
-                for fileinfo in zip_files:
-                    filename = os.path.join(app_folder, fileinfo.filename.replace(zip_root, ""))
-                    dirname = os.path.dirname(filename)
-                    os.makedirs(dirname, exist_ok=True)
-                    file_data = myzip.read(fileinfo)
-
-                    with open(filename, "wb") as fopen:
-                        fopen.write(file_data)
+        if not os.path.exists(path_file):
+            update_app(remote_release, app_folder)
+        elif remote_version > local_version:
+            print(f"MangaDex Uploader (APP) is up to date.\nVersion: {remote_version}\nLocal: {local_version}")
+            update_app(remote_release, app_folder)
     
+    path_file = os.path.join(get_release_folder(app_folder), "run.py")
     if os.path.exists(path_file):
         command = ['python', path_file, folder_executed] if os.name == 'nt' else ['python3', path_file, folder_executed]
 
@@ -93,4 +291,4 @@ if __name__ == "__main__":
     install_modules()
     import requests
     from packaging import version
-    download_and_execute()
+    download_and_execute()
\ No newline at end of file